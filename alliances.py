@@ -0,0 +1,200 @@
+# alliances.py
+# Alliance membership index. Membership lives in each player's alliance_id; this module keeps the
+# two-way index (alliance -> members, player -> alliance), tag uniqueness and per-alliance
+# aggregates in memory, so the dashboard and join/leave never scan the Players sheet.
+
+import logging
+import threading
+import uuid
+
+import constants
+import storage
+
+logger = logging.getLogger(__name__)
+
+class AllianceIndex:
+    """
+    Loaded once from the Alliances and Players sheets, then kept current from storage writes.
+    create/join/leave hold the index lock across their checks and the storage write, so two
+    players can never both take an alliance's last seat or the same tag. When worker processes
+    share the store, they also hold its 'alliances' lock and first re-read what they check,
+    since another worker's writes reach this index a little later through the change feed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._alliances = {}  # alliance_id -> alliance record
+        self._tags = {}  # upper-cased tag -> alliance_id
+        self._members = {}  # alliance_id -> set of user_ids
+        self._total_power = {}  # alliance_id -> summed member power
+        self._player_alliance = {}  # user_id -> alliance_id
+        self._players = {}  # user_id -> [power, commander_name]
+        self._orphans = set()  # alliance_ids dropped from the index whose row could not be deleted yet
+
+    # --- Loading & change feed ---
+
+    def load(self, alliance_records, player_records):
+        with self._lock:
+            self._alliances, self._tags, self._members, self._total_power, self._player_alliance, self._players = {}, {}, {}, {}, {}, {}
+            for record in alliance_records: self._register(record)
+            for record in player_records: self.observe(record.get(constants.FIELD_USER_ID), record)
+
+    def _register(self, record):
+        alliance_id = str(record.get('alliance_id') or '')
+        if not alliance_id or alliance_id in self._orphans: return
+        self._alliances[alliance_id] = {header: str(record.get(header, '')) for header in constants.ALLIANCES_SHEET_COLUMN_HEADERS}
+        self._tags[str(record.get('alliance_tag', '')).upper()] = alliance_id
+        self._members.setdefault(alliance_id, set())
+        self._total_power.setdefault(alliance_id, 0)
+
+    def _unregister(self, alliance_id):
+        record = self._alliances.pop(alliance_id, None)
+        if record and self._tags.get(record['alliance_tag'].upper()) == alliance_id: del self._tags[record['alliance_tag'].upper()]
+        if not self._members.get(alliance_id):
+            self._members.pop(alliance_id, None); self._total_power.pop(alliance_id, None)
+
+    def observe(self, user_id, changes: dict):
+        """Storage listener: follows alliance_id, power and name changes of committed player writes."""
+        if user_id in (None, '') or not ({'alliance_id', 'power', constants.FIELD_COMMANDER_NAME} & changes.keys()): return
+        user_id = str(user_id)
+        with self._lock:
+            player = self._players.setdefault(user_id, [0, ''])
+            alliance_id = self._player_alliance.get(user_id)
+            if 'power' in changes:
+                try: power = int(changes['power'] or 0)
+                except (TypeError, ValueError): power = player[0]
+                if alliance_id: self._total_power[alliance_id] += power - player[0]
+                player[0] = power
+            if constants.FIELD_COMMANDER_NAME in changes: player[1] = changes[constants.FIELD_COMMANDER_NAME]
+            if 'alliance_id' in changes and (new_alliance := str(changes['alliance_id'] or '')) != (alliance_id or ''):
+                if alliance_id: self._detach(user_id, alliance_id)
+                if new_alliance: self._attach(user_id, new_alliance)
+
+    def observe_alliance(self, alliance_id, record):
+        """Alliance change feed from other workers: `record` holds the created/updated fields, or is None on deletion."""
+        alliance_id = str(alliance_id or '')
+        with self._lock:
+            if record is None: self._unregister(alliance_id)
+            elif alliance_id in self._alliances: self._alliances[alliance_id].update({key: str(value) for key, value in record.items() if key in constants.ALLIANCES_SHEET_COLUMN_HEADERS})
+            else: self._register({**record, 'alliance_id': alliance_id})
+
+    def _refresh(self, alliance_id=None):
+        """Shared store only: re-reads the alliances, and `alliance_id`'s members, from storage. The caller holds both locks."""
+        current = {str(record['alliance_id']): record for record in storage.get_all_alliances() if record.get('alliance_id')}
+        for stale in set(self._alliances) - set(current): self._unregister(stale)
+        for record in current.values(): self._register(record)
+        if alliance_id:
+            members = storage.get_alliance_members(alliance_id)
+            for member in members: self.observe(member[constants.FIELD_USER_ID], member)
+            for user_id in self._members.get(str(alliance_id), set()) - {str(member[constants.FIELD_USER_ID]) for member in members}:
+                self.observe(user_id, {'alliance_id': ''})
+
+    def _discard(self, alliance_id):
+        """Removes an alliance from the index, then its row. A row that cannot be deleted now is retried by the next membership change. The caller holds both locks."""
+        self._unregister(alliance_id)
+        self._orphans.add(alliance_id)
+        self._delete_orphans()
+
+    def _delete_orphans(self):
+        for alliance_id in list(self._orphans):
+            try: deleted = storage.delete_alliance(alliance_id)
+            except Exception as e: deleted = False; logger.warning(f"Could not delete alliance {alliance_id} ({e}); retrying later.")
+            if deleted: self._orphans.discard(alliance_id)
+
+    def _attach(self, user_id, alliance_id):
+        self._player_alliance[user_id] = alliance_id
+        self._members.setdefault(alliance_id, set()).add(user_id)
+        self._total_power[alliance_id] = self._total_power.get(alliance_id, 0) + self._players[user_id][0]
+
+    def _detach(self, user_id, alliance_id):
+        self._player_alliance.pop(user_id, None)
+        self._members[alliance_id].discard(user_id)
+        self._total_power[alliance_id] -= self._players[user_id][0]
+
+    # --- Queries ---
+
+    def alliance_of(self, user_id):
+        with self._lock: return self._player_alliance.get(str(user_id))
+
+    def is_tag_taken(self, tag: str) -> bool:
+        with self._lock: return tag.upper() in self._tags
+
+    def get(self, alliance_id):
+        """The alliance record plus member_count and total_power, or None."""
+        with self._lock:
+            record = self._alliances.get(str(alliance_id))
+            if record is None: return None
+            return {**record, 'member_count': len(self._members.get(record['alliance_id'], ())), 'total_power': self._total_power.get(record['alliance_id'], 0)}
+
+    def members(self, alliance_id) -> list:
+        """(user_id, commander_name, power) for every member, strongest first."""
+        with self._lock:
+            rows = [(user_id, self._players[user_id][1], self._players[user_id][0]) for user_id in self._members.get(str(alliance_id), ())]
+        return sorted(rows, key=lambda row: (-row[2], row[0]))
+
+    def open_alliances(self, limit=10) -> list:
+        """Alliances with a free seat, by total power: summaries as returned by get()."""
+        with self._lock:
+            ids = [alliance_id for alliance_id in self._alliances if len(self._members.get(alliance_id, ())) < constants.ALLIANCE_CONFIG['max_members']]
+            ids.sort(key=lambda alliance_id: -self._total_power.get(alliance_id, 0))
+            return [self.get(alliance_id) for alliance_id in ids[:limit]]
+
+    # --- Membership changes ---
+
+    def create(self, leader_id, name: str, tag: str, description: str, player_updates: dict = None):
+        """Founds an alliance led by `leader_id` and applies `player_updates` (e.g. the fee) with the membership. Returns (alliance_id or None, error)."""
+        with storage.exclusive('alliances'), self._lock:
+            if self._orphans: self._delete_orphans()
+            if storage.is_shared(): self._refresh()
+            if self._player_alliance.get(str(leader_id)): return None, "You are already a member of an alliance."
+            if tag.upper() in self._tags: return None, f"The tag [{tag}] is already in use."
+            record = {'alliance_id': str(uuid.uuid4()), 'alliance_name': name, 'alliance_tag': tag, 'leader_id': str(leader_id), 'member_ids': '', 'description': description}
+            if not storage.create_alliance(record): return None, "A critical error occurred while forming your alliance."
+            self._register(record)
+            saved = False
+            try: saved = storage.update_player_data(leader_id, {**(player_updates or {}), 'alliance_id': record['alliance_id']})
+            finally:
+                # Roll back on a failed write and on a raised one (e.g. SheetsThrottled), which then propagates unchanged.
+                if not saved: self._discard(record['alliance_id'])
+            if not saved: return None, "A critical error occurred while forming your alliance."
+            return record['alliance_id'], None
+
+    def join(self, user_id, alliance_id):
+        """Returns (joined, error)."""
+        with storage.exclusive('alliances'), self._lock:
+            if self._orphans: self._delete_orphans()
+            if storage.is_shared(): self._refresh(alliance_id)
+            if self._player_alliance.get(str(user_id)): return False, "You are already a member of an alliance."
+            if str(alliance_id) not in self._alliances: return False, "That alliance no longer exists."
+            if len(self._members.get(str(alliance_id), ())) >= constants.ALLIANCE_CONFIG['max_members']: return False, "That alliance is full."
+            if not storage.update_player_data(user_id, {'alliance_id': str(alliance_id)}): return False, "A critical database error occurred."
+            return True, None
+
+    def leave(self, user_id):
+        """Leaves the player's alliance, handing leadership to the strongest member or disbanding it when empty. Returns (left, error)."""
+        with storage.exclusive('alliances'), self._lock:
+            if self._orphans: self._delete_orphans()
+            if storage.is_shared() and (alliance_id := self._player_alliance.get(str(user_id))): self._refresh(alliance_id)
+            if not (alliance_id := self._player_alliance.get(str(user_id))): return False, "You are not in an alliance."
+            if not storage.update_player_data(user_id, {'alliance_id': ''}): return False, "A critical database error occurred."
+            record = self._alliances.get(alliance_id)
+            if not self._members.get(alliance_id): self._discard(alliance_id)
+            elif record and record['leader_id'] == str(user_id):
+                successor = self.members(alliance_id)[0][0]
+                if storage.update_alliance(alliance_id, {'leader_id': successor}): record['leader_id'] = successor
+            return True, None
+
+_index = AllianceIndex()
+
+def get_index() -> AllianceIndex: return _index
+def load(alliance_records, player_records): _index.load(alliance_records, player_records)
+def observe(user_id, changes: dict): _index.observe(user_id, changes)
+def observe_alliance(alliance_id, record): _index.observe_alliance(alliance_id, record)
+def alliance_of(user_id): return _index.alliance_of(user_id)
+def is_tag_taken(tag: str): return _index.is_tag_taken(tag)
+def get(alliance_id): return _index.get(alliance_id)
+def members(alliance_id): return _index.members(alliance_id)
+def open_alliances(limit=10): return _index.open_alliances(limit)
+def create(leader_id, name, tag, description, player_updates=None): return _index.create(leader_id, name, tag, description, player_updates)
+def join(user_id, alliance_id): return _index.join(user_id, alliance_id)
+def leave(user_id): return _index.leave(user_id)
@@ -0,0 +1,83 @@
+# async_runtime.py
+# asyncio runtime (BOT_RUNTIME=asyncio): one event loop owns all Telegram I/O through the
+# library's AsyncTeleBot, while the handler flows run unchanged on the per-user shards.
+
+import asyncio
+import logging
+
+from telebot.async_telebot import AsyncTeleBot
+
+import constants
+import handlers
+import metrics
+from outbox import DispatchingBot, OutboundDispatcher
+
+logger = logging.getLogger(__name__)
+
+class SyncBotBridge:
+    """
+    A TeleBot-shaped object for the synchronous handler flows running on shard threads.
+    Each API call is scheduled as a coroutine on the event loop's AsyncTeleBot; the shard waits
+    for the result, which keeps one player's messages in order without a thread per request.
+    """
+
+    def __init__(self, async_bot, loop, timeout=60):
+        self._bot = async_bot
+        self._loop = loop
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+        if not asyncio.iscoroutinefunction(method): return method
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self._loop).result(self.timeout)
+        return call
+
+class AsyncRouter:
+    """Registers the (non-blocking, shard-dispatching) handlers from handlers.register_handlers on an AsyncTeleBot."""
+
+    def __init__(self, async_bot):
+        self._bot = async_bot
+
+    def _register(self, decorator):
+        def register(handler):
+            async def run(update): handler(update)
+            run.__name__ = handler.__name__
+            decorator(run)
+            return handler
+        return register
+
+    def message_handler(self, **filters): return self._register(self._bot.message_handler(**filters))
+    def callback_query_handler(self, **filters): return self._register(self._bot.callback_query_handler(**filters))
+
+async def _completion_loop(scheduler):
+    """Drives the completion engine from the event loop instead of its own timer thread."""
+    loop = asyncio.get_running_loop()
+    while True:
+        delay = scheduler.seconds_until_next_due()
+        await asyncio.sleep(scheduler.tick_seconds if delay is None else max(delay, 0) + scheduler.tick_seconds)
+        # Resolution waits on the shards, so it runs off the loop.
+        await loop.run_in_executor(None, scheduler.run_due)
+
+async def _serve(bot_token, scheduler, executor):
+    async_bot = AsyncTeleBot(bot_token)
+    bridge = SyncBotBridge(async_bot, asyncio.get_running_loop())
+    outbox = OutboundDispatcher(metrics.instrument_api('telegram', bridge), **constants.OUTBOX_CONFIG)
+    metrics.register_collector('skyhustle_outbox_depth', 'Telegram API calls waiting in the outbox.', outbox.depth)
+    handlers.register_handlers(DispatchingBot(bridge, outbox), scheduler, executor, router=AsyncRouter(async_bot))
+    logger.info("All system handlers have been registered on the asyncio runtime.")
+    timers = asyncio.create_task(_completion_loop(scheduler))
+    try:
+        await async_bot.infinity_polling(timeout=40)
+    finally:
+        timers.cancel()
+        # Handler flows still on the shards may queue more calls, so they finish first.
+        await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+        # The senders block on the loop, so drain them from a worker thread before closing the session.
+        await asyncio.get_running_loop().run_in_executor(None, outbox.shutdown)
+        await async_bot.close_session()
+
+def run(bot_token, scheduler, executor):
+    """Blocks running the asyncio runtime. `executor` is required: handler flows must never block the loop."""
+    if executor is None: raise ValueError("The asyncio runtime needs a ShardedExecutor for the blocking handler flows.")
+    asyncio.run(_serve(bot_token, scheduler, executor))
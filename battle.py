@@ -0,0 +1,84 @@
+# battle.py
+# Vectorized battle engine. Armies are unit-count vectors in UNIT_KEYS order and stats are
+# per-unit vectors with research modifiers applied, so a whole tick's battles resolve as
+# one set of array operations over a (battles x units) matrix.
+
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+import constants
+from player_record import is_true
+
+UNIT_KEYS = tuple(constants.UNIT_DATA)
+UNIT_FIELDS = tuple(constants.UNIT_DATA[key]['id'] for key in UNIT_KEYS)
+LOOT_RESOURCES = ('wood', 'stone', 'iron', 'food')
+STATS = ('attack', 'defense', 'health', 'power')
+
+BattleResult = namedtuple('BattleResult', ['attacker_wins', 'attacker_power', 'defender_power', 'attacker_survivors', 'defender_survivors', 'looted'])
+
+def _frozen(array):
+    array.setflags(write=False)
+    return array
+
+@lru_cache(maxsize=None)
+def unit_stats(unlocked_research: frozenset = frozenset()) -> dict:
+    """{stat: vector over UNIT_KEYS} with the unit_stat_bonus effects of `unlocked_research` added."""
+    stats = {stat: np.array([constants.UNIT_DATA[key]['stats'][stat] for key in UNIT_KEYS], dtype=np.float64) for stat in STATS}
+    for research_key in unlocked_research:
+        for effect in constants.RESEARCH_DATA[research_key]['effects']:
+            if effect['type'] == 'unit_stat_bonus' and effect['unit'] in constants.UNIT_DATA:
+                stats[effect['stat']][UNIT_KEYS.index(effect['unit'])] += effect['bonus']
+    return {stat: _frozen(vector) for stat, vector in stats.items()}
+
+def unlocked_research(player_data: dict) -> frozenset:
+    return frozenset(key for key, info in constants.RESEARCH_DATA.items() if is_true(player_data.get(info['id'])))
+
+def army_vector(army: dict) -> np.ndarray:
+    """{unit_key: count} -> count vector."""
+    return np.array([int(army.get(key, 0)) for key in UNIT_KEYS], dtype=np.int64)
+
+def garrison_vector(player_data: dict) -> np.ndarray:
+    return np.array([int(player_data.get(field, 0) or 0) for field in UNIT_FIELDS], dtype=np.int64)
+
+def army_power(vector) -> int:
+    """Power contributed by a count vector (research does not change unit power)."""
+    return int(np.dot(vector, unit_stats()['power']))
+
+def army_dict(vector) -> dict:
+    return {key: int(count) for key, count in zip(UNIT_KEYS, vector)}
+
+def battle_seed(attacker_id, defender_id, when) -> int:
+    """Stable per-battle seed, so a battle replays identically whatever else resolved in its tick."""
+    digest = hashlib.blake2b(f"{attacker_id}:{defender_id}:{when.isoformat()}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def resolve_battles(attackers, attack_stats, defenders, defense_stats, defender_resources, seeds=None, config=None) -> BattleResult:
+    """
+    Resolves B battles at once. `attackers`/`defenders` are (B, U) unit counts, `attack_stats`/
+    `defense_stats` the matching (B, U) per-unit attack and defense, `defender_resources` is
+    (B, len(LOOT_RESOURCES)). With a non-zero power_variance each side's power is scaled by a
+    roll drawn from that battle's seed, so results are reproducible from the seeds alone.
+    """
+    config = config or constants.COMBAT_CONFIG
+    attackers, defenders = np.asarray(attackers, dtype=np.int64), np.asarray(defenders, dtype=np.int64)
+    attacker_power = np.einsum('ij,ij->i', attackers, attack_stats)
+    defender_power = np.einsum('ij,ij->i', defenders, defense_stats)
+    if (variance := config.get('power_variance', 0.0)) and seeds is not None:
+        rolls = np.array([np.random.default_rng(seed).uniform(1 - variance, 1 + variance, 2) for seed in seeds]).reshape(-1, 2)
+        attacker_power, defender_power = attacker_power * rolls[:, 0], defender_power * rolls[:, 1]
+    attacker_wins = attacker_power > defender_power
+    win_cas, lose_cas = config['winner_casualty_percentage'], config['loser_casualty_percentage']
+    attacker_keep = np.where(attacker_wins, 1 - win_cas, 1 - lose_cas)[:, None]
+    defender_keep = np.where(attacker_wins, 1 - lose_cas, 1 - win_cas)[:, None]
+    looted = np.floor(np.asarray(defender_resources, dtype=np.float64) * config['loot_percentage']) * attacker_wins[:, None]
+    return BattleResult(
+        attacker_wins=attacker_wins,
+        attacker_power=attacker_power,
+        defender_power=defender_power,
+        attacker_survivors=np.floor(attackers * attacker_keep).astype(np.int64),
+        defender_survivors=np.floor(defenders * defender_keep).astype(np.int64),
+        looted=looted.astype(np.int64),
+    )
@@ -0,0 +1,73 @@
+# benchmarks/battle_bench.py
+# Micro-benchmark for the battle engine: one vectorized pass over N battles against the
+# per-battle Python loop it replaced. Run from the repository root:
+#   python -m benchmarks.battle_bench [--battles 10000] [--repeat 5] [--seed 7]
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+import battle
+import constants
+
+def scalar_reference(attackers, attack_stats, defenders, defense_stats, resources):
+    """The pre-vectorization algorithm, one battle at a time (stats already include research bonuses)."""
+    config = constants.COMBAT_CONFIG
+    win_cas, lose_cas = config['winner_casualty_percentage'], config['loser_casualty_percentage']
+    results = []
+    for army, atk, garrison, dfn, res in zip(attackers.tolist(), attack_stats.tolist(), defenders.tolist(), defense_stats.tolist(), resources.tolist()):
+        attacker_wins = sum(c * s for c, s in zip(army, atk)) > sum(c * s for c, s in zip(garrison, dfn))
+        attacker_survivors = [math.floor(c * (1 - (win_cas if attacker_wins else lose_cas))) for c in army]
+        defender_survivors = [math.floor(c * (1 - (lose_cas if attacker_wins else win_cas))) for c in garrison]
+        looted = [math.floor(r * config['loot_percentage']) if attacker_wins else 0 for r in res]
+        results.append((attacker_wins, attacker_survivors, defender_survivors, looted))
+    return results
+
+def synthetic_battles(n, seed):
+    rng = np.random.default_rng(seed)
+    units = len(battle.UNIT_KEYS)
+    research_sets = [frozenset(), frozenset(constants.RESEARCH_DATA)]
+    attackers = rng.integers(0, 5000, size=(n, units))
+    defenders = rng.integers(0, 5000, size=(n, units))
+    attack_stats = np.array([battle.unit_stats(research_sets[i])['attack'] for i in rng.integers(0, 2, size=n)])
+    defense_stats = np.array([battle.unit_stats(research_sets[i])['defense'] for i in rng.integers(0, 2, size=n)])
+    resources = rng.integers(0, 1_000_000, size=(n, len(battle.LOOT_RESOURCES)))
+    return attackers, attack_stats, defenders, defense_stats, resources
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter(); fn(); timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description='Battle engine micro-benchmark.')
+    parser.add_argument('--battles', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    inputs = synthetic_battles(args.battles, args.seed)
+    vectorized = battle.resolve_battles(*inputs)
+    reference = scalar_reference(*inputs)
+    assert vectorized.attacker_wins.tolist() == [r[0] for r in reference]
+    assert vectorized.attacker_survivors.tolist() == [r[1] for r in reference]
+    assert vectorized.defender_survivors.tolist() == [r[2] for r in reference]
+    assert vectorized.looted.tolist() == [r[3] for r in reference]
+
+    seeds = list(range(args.battles))
+    varied = {**constants.COMBAT_CONFIG, 'power_variance': 0.1}
+    first, second = (battle.resolve_battles(*inputs, seeds=seeds, config=varied) for _ in range(2))
+    assert (first.attacker_wins == second.attacker_wins).all(), "seeded battles must replay identically"
+
+    scalar_s = best_of(args.repeat, lambda: scalar_reference(*inputs))
+    vector_s = best_of(args.repeat, lambda: battle.resolve_battles(*inputs))
+    print(f"{args.battles} battles x {len(battle.UNIT_KEYS)} unit types (best of {args.repeat})")
+    print(f"  scalar loop : {scalar_s * 1000:9.2f} ms  ({scalar_s / args.battles * 1e6:.2f} us/battle)")
+    print(f"  vectorized  : {vector_s * 1000:9.2f} ms  ({vector_s / args.battles * 1e6:.2f} us/battle)")
+    print(f"  speedup     : {scalar_s / vector_s:9.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+# benchmarks/fakes.py
+# In-memory stand-ins for gspread and the Telegram Bot API, for benchmarks and load tests.
+# Every call is counted per method and can be slowed down by a fixed latency to mimic the network.
+
+import itertools
+import re
+import threading
+import time
+from collections import Counter
+
+import gspread
+import telebot
+from gspread.utils import a1_to_rowcol
+
+class CallRecorder:
+    """Thread-safe call counter shared by the fakes; snapshot() and diff() measure a slice of work."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def record(self, name):
+        with self._lock: self.calls[name] += 1
+
+    def snapshot(self) -> Counter:
+        with self._lock: return Counter(self.calls)
+
+    def diff(self, before: Counter) -> dict:
+        return {name: count for name, count in (self.snapshot() - before).items() if count}
+
+class FakeWorksheet:
+    """The subset of gspread.Worksheet the game uses, backed by a list of rows."""
+
+    def __init__(self, title, headers, recorder, latency=0.0):
+        self.title = title
+        self.rows = [list(headers)] if headers else [[]]
+        self.recorder, self.latency = recorder, latency
+        self._lock = threading.RLock()
+
+    def _call(self, name):
+        self.recorder.record(f"sheets.{name}")
+        if self.latency: time.sleep(self.latency)
+
+    def _cell(self, row, col, value):
+        while len(self.rows) < row: self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col: cells.append('')
+        cells[col - 1] = str(value)
+
+    def row_values(self, row):
+        self._call('row_values')
+        with self._lock:
+            values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == '': values.pop()
+        return values
+
+    def get_all_values(self):
+        self._call('get_all_values')
+        with self._lock:
+            width = max((len(row) for row in self.rows), default=0)
+            return [list(row) + [''] * (width - len(row)) for row in self.rows]
+
+    def batch_get(self, ranges, **kwargs):
+        self._call('batch_get')
+        result = []
+        with self._lock:
+            for a1 in ranges:
+                row = int(re.match(r'(\d+)', a1).group(1))
+                values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+                result.append([values] if values else [])
+        return result
+
+    def find(self, query, in_column=None, **kwargs):
+        self._call('find')
+        with self._lock:
+            for row_number, row in enumerate(self.rows, start=1):
+                columns = [in_column] if in_column else range(1, len(row) + 1)
+                for col in columns:
+                    if len(row) >= col and row[col - 1] == str(query): return gspread.Cell(row_number, col, row[col - 1])
+        return None
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._call('update')
+        row, col = a1_to_rowcol(range_name or 'A1')
+        with self._lock:
+            for r, row_values in enumerate(values or []):
+                for c, value in enumerate(row_values): self._cell(row + r, col + c, value)
+
+    def update_cells(self, cells, value_input_option=None):
+        self._call('update_cells')
+        with self._lock:
+            for cell in cells: self._cell(cell.row, cell.col, cell.value)
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        with self._lock:
+            for entry in data:
+                row, col = a1_to_rowcol(entry['range'])
+                self._cell(row, col, entry['values'][0][0])
+
+    def append_row(self, values, **kwargs):
+        self._call('append_row')
+        with self._lock:
+            self.rows.append([str(value) for value in values])
+            row = len(self.rows)
+        return {'updates': {'updatedRange': f"{self.title}!A{row}:{row}"}}
+
+    def delete_rows(self, index, end_index=None):
+        self._call('delete_rows')
+        with self._lock: del self.rows[index - 1:(end_index or index)]
+
+class FakeSpreadsheet:
+    def __init__(self, recorder, latency=0.0):
+        self.title = 'SkyHustle (benchmark)'
+        self.recorder, self.latency = recorder, latency
+        self.worksheets = {}
+
+    def worksheet(self, name):
+        self.recorder.record('sheets.worksheet')
+        if name not in self.worksheets: raise gspread.exceptions.WorksheetNotFound(name)
+        return self.worksheets[name]
+
+    def add_worksheet(self, title, rows, cols):
+        self.recorder.record('sheets.add_worksheet')
+        self.worksheets[title] = FakeWorksheet(title, [], self.recorder, self.latency)
+        return self.worksheets[title]
+
+class FakeTeleBot(telebot.TeleBot):
+    """
+    A real TeleBot (so handler registration and filter matching are the library's own) whose
+    outbound API methods only record the call. Dispatch is synchronous: threaded=False.
+    """
+    API_METHODS = ('send_message', 'edit_message_text', 'edit_message_reply_markup', 'answer_callback_query', 'delete_message', 'send_photo', 'set_webhook', 'remove_webhook')
+
+    def __init__(self, recorder, latency=0.0):
+        super().__init__('123456:BENCHMARK', threaded=False)
+        self.recorder, self.latency = recorder, latency
+        self.sent = []  # (method, args, kwargs) of every call, for inspection
+        for method in self.API_METHODS: setattr(self, method, self._recording(method))
+
+    def _recording(self, method):
+        def call(*args, **kwargs):
+            self.recorder.record(f"telegram.{method}")
+            self.sent.append((method, args, kwargs))
+            if self.latency: time.sleep(self.latency)
+            return True
+        return call
+
+# --- Synthetic updates ---
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+def _user(user_id): return {'id': user_id, 'is_bot': False, 'first_name': f'Bench{user_id}'}
+
+def _message_json(user_id, text):
+    return {'message_id': next(_message_ids), 'from': _user(user_id), 'chat': {'id': user_id, 'type': 'private'}, 'date': int(time.time()), 'text': text}
+
+def message_update(user_id, text) -> telebot.types.Update:
+    return telebot.types.Update.de_json({'update_id': next(_update_ids), 'message': _message_json(user_id, text)})
+
+def callback_update(user_id, data) -> telebot.types.Update:
+    return telebot.types.Update.de_json({'update_id': next(_update_ids), 'callback_query': {
+        'id': str(next(_update_ids)), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+        'message': _message_json(user_id, 'menu')}})
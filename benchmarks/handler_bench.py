@@ -0,0 +1,177 @@
+# benchmarks/handler_bench.py
+# Load test for the Telegram handler pipeline against in-memory Sheets and Bot API fakes.
+# Drives handlers.register_handlers with synthetic update streams per flow and reports
+# throughput, p50/p99 latency and the Sheets/Telegram calls each flow cost. Run from the
+# repository root:
+#   python -m benchmarks.handler_bench [--players 200] [--sheets-latency-ms 0] [--api-latency-ms 0] [--json out.json] [--sheets-quota] [--metrics]
+
+import argparse
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import alliances
+import callbacks
+import constants
+import conversation
+import google_sheets
+import handlers
+import leaderboard
+import matchmaking
+import metrics
+import storage
+from benchmarks.fakes import CallRecorder, FakeSpreadsheet, FakeTeleBot, FakeWorksheet, callback_update, message_update
+from completion_engine import CompletionEngine
+from sheets_client import QuotaClient
+
+SEED_OVERRIDES = {
+    'wood': 1_000_000, 'stone': 1_000_000, 'iron': 1_000_000, 'food': 1_000_000, 'diamonds': 1000, 'energy': 100,
+    'wood_storage_cap': 10_000_000, 'stone_storage_cap': 10_000_000, 'iron_storage_cap': 10_000_000, 'food_storage_cap': 10_000_000,
+    'building_barracks_level': 1, 'building_research_lab_level': 2, 'unit_infantry_count': 100, 'power': 150, 'shield_finish_time': '',
+}
+
+def commander_name(user_id): return f"Commander{user_id}"
+
+class World:
+    """A seeded game: fake spreadsheet with `players` commanders, a recording bot and the registered handlers."""
+
+    def __init__(self, players, sheets_latency=0.0, api_latency=0.0, sheets_quota=False, conversation_db=None):
+        self.recorder = CallRecorder()
+        spreadsheet = FakeSpreadsheet(self.recorder, sheets_latency)
+        players_ws = FakeWorksheet('Players', constants.SHEET_COLUMN_HEADERS, self.recorder, sheets_latency)
+        spreadsheet.worksheets['Players'] = players_ws
+        spreadsheet.worksheets['Alliances'] = FakeWorksheet('Alliances', constants.ALLIANCES_SHEET_COLUMN_HEADERS, self.recorder, sheets_latency)
+        for user_id in range(1, players + 1):
+            record = {**google_sheets.build_new_player_record({constants.FIELD_USER_ID: user_id, constants.FIELD_COMMANDER_NAME: commander_name(user_id)}), **SEED_OVERRIDES}
+            players_ws.rows.append([str(record.get(header, '')) for header in constants.SHEET_COLUMN_HEADERS])
+        google_sheets._spreadsheet = spreadsheet
+        # Measure handler cost, not quota waits, unless the real per-minute quota is asked for.
+        google_sheets._quota = QuotaClient(**constants.SHEETS_QUOTA_CONFIG) if sheets_quota else QuotaClient(reads_per_minute=1e9, writes_per_minute=1e9, burst=1e9)
+        google_sheets._worksheets.clear()
+        google_sheets.invalidate_player_cache()
+        conversation.configure(conversation_db)
+
+        self.players = players
+        self.scheduler = CompletionEngine()
+        self.bot = FakeTeleBot(self.recorder, api_latency)
+        handlers.register_handlers(metrics.instrument_api('telegram', self.bot), self.scheduler, router=self.bot)
+        records = storage.get_all_players()
+        leaderboard.load(records); matchmaking.load(records); alliances.load(storage.get_all_alliances(), records)
+        for index in (leaderboard.observe, matchmaking.observe, alliances.observe):
+            if index not in storage._listeners: storage.add_listener(index)
+
+# --- Flows: each yields (user_id, update factory) steps; factories run lazily so they can see earlier steps' results ---
+
+def registration_flow(world):
+    for user_id in range(world.players + 1, 2 * world.players + 1):
+        yield lambda: message_update(user_id, '/start')
+        yield lambda: message_update(user_id, f"Recruit{user_id}")
+
+def build_flow(world):
+    for user_id in range(1, world.players + 1):
+        yield lambda: message_update(user_id, constants.MENU_BUILD)
+        yield lambda: callback_update(user_id, callbacks.encode('build', 'sawmill'))
+
+def train_flow(world):
+    for user_id in range(1, world.players + 1):
+        yield lambda: message_update(user_id, constants.MENU_TRAIN)
+        yield lambda: callback_update(user_id, callbacks.encode('train', 'infantry'))
+        yield lambda: message_update(user_id, '5')
+
+def research_flow(world):
+    for user_id in range(1, world.players + 1):
+        yield lambda: message_update(user_id, constants.MENU_RESEARCH)
+        yield lambda: callback_update(user_id, callbacks.encode('research', 'logistics'))
+
+def alliance_flow(world):
+    """Every tenth commander founds an alliance; the rest browse and join their founder's."""
+    for user_id in range(1, world.players + 1):
+        founder = user_id - (user_id - 1) % 10
+        yield lambda: message_update(user_id, constants.MENU_ALLIANCE)
+        if user_id == founder:
+            yield lambda: callback_update(user_id, callbacks.encode('alliance_create'))
+            yield lambda: message_update(user_id, f"Alliance {user_id}")
+            yield lambda: message_update(user_id, f"A{user_id}"[:constants.ALLIANCE_CONFIG['tag_max_length']])
+        else:
+            yield lambda: callback_update(user_id, callbacks.encode('alliance_browse'))
+            yield lambda: callback_update(user_id, callbacks.encode('alliance_join', alliances.alliance_of(founder)))
+
+def battle_flow(world):
+    """Odd commanders attack the next even one, by name and then through the confirmation button."""
+    for attacker in range(1, world.players, 2):
+        yield lambda: message_update(attacker, f"/attack {commander_name(attacker + 1)}")
+        yield lambda: callback_update(attacker, callbacks.encode('confirm_attack', attacker + 1))
+
+FLOWS = {'registration': registration_flow, 'build': build_flow, 'train': train_flow, 'research': research_flow, 'alliance': alliance_flow, 'battle': battle_flow}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def summarize(name, latencies, elapsed, calls, errors):
+    latencies = sorted(latencies)
+    return {
+        'flow': name, 'updates': len(latencies), 'errors': errors, 'elapsed_s': round(elapsed, 4),
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3), 'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'sheets_calls': {k[len('sheets.'):]: v for k, v in sorted(calls.items()) if k.startswith('sheets.')},
+        'telegram_calls': {k[len('telegram.'):]: v for k, v in sorted(calls.items()) if k.startswith('telegram.')},
+    }
+
+def run_flow(world, name, flow):
+    latencies, errors = [], 0
+    before, started = world.recorder.snapshot(), time.perf_counter()
+    for make_update in flow(world):
+        update = make_update()
+        start = time.perf_counter()
+        try: world.bot.process_new_updates([update])
+        except Exception: errors += 1
+        latencies.append(time.perf_counter() - start)
+    return summarize(name, latencies, time.perf_counter() - started, world.recorder.diff(before), errors)
+
+def run_completions(world):
+    """Resolves everything the flows queued (builds, training, research, battles, then the armies' return) as engine ticks."""
+    latencies, resolved, errors = [], 0, 0
+    before, started = world.recorder.snapshot(), time.perf_counter()
+    for hours in (1, 2):
+        start = time.perf_counter()
+        try: resolved += world.scheduler.run_due(datetime.now(timezone.utc) + timedelta(hours=hours))
+        except Exception: errors += 1
+        latencies.append(time.perf_counter() - start)
+    result = summarize('completions', latencies, time.perf_counter() - started, world.recorder.diff(before), errors)
+    result['updates'] = resolved
+    result['throughput_per_s'] = round(resolved / result['elapsed_s'], 1) if result['elapsed_s'] else 0.0
+    return result
+
+def print_report(results):
+    print(f"{'flow':<13}{'updates':>8}{'err':>5}{'upd/s':>10}{'p50 ms':>9}{'p99 ms':>9}  sheets calls / telegram calls")
+    for r in results:
+        sheets = ', '.join(f"{k}={v}" for k, v in r['sheets_calls'].items()) or '-'
+        telegram = ', '.join(f"{k}={v}" for k, v in r['telegram_calls'].items()) or '-'
+        print(f"{r['flow']:<13}{r['updates']:>8}{r['errors']:>5}{r['throughput_per_s']:>10}{r['p50_ms']:>9}{r['p99_ms']:>9}  {sheets} / {telegram}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Handler pipeline load test with in-memory Sheets and Telegram.')
+    parser.add_argument('--players', type=int, default=200, help='seeded commanders (and new registrations)')
+    parser.add_argument('--sheets-latency-ms', type=float, default=0.0, help='added to every fake Sheets call')
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='added to every fake Bot API call')
+    parser.add_argument('--flows', default=','.join(FLOWS), help='comma-separated subset of: ' + ', '.join(FLOWS))
+    parser.add_argument('--json', help='also write the results to this file, e.g. to compare commits')
+    parser.add_argument('--sheets-quota', action='store_true', help='enforce the production Sheets quota (constants.SHEETS_QUOTA_CONFIG)')
+    parser.add_argument('--conversation-db', help='keep conversation state in this SQLite file instead of memory')
+    parser.add_argument('--metrics', action='store_true', help='run with instrumentation enabled and print the /metrics exposition')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    if args.metrics: metrics.enable()
+
+    world = World(args.players, args.sheets_latency_ms / 1000, args.api_latency_ms / 1000, args.sheets_quota, args.conversation_db)
+    results = [run_flow(world, name, FLOWS[name]) for name in args.flows.split(',') if name]
+    results.append(run_completions(world))
+    print_report(results)
+    if args.metrics: print(metrics.render())
+    if args.json:
+        with open(args.json, 'w') as f: json.dump({'players': args.players, 'sheets_latency_ms': args.sheets_latency_ms, 'api_latency_ms': args.api_latency_ms, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# benchmarks/worker_bench.py
+# Load test for the multi-process mode (workers.py): a real Dispatcher routes synthetic update
+# streams to N real worker processes, which run the handlers against one shared SQLite store and
+# a recording Bot API fake. Reports end-to-end updates/s for each worker count, and checks from
+# the store that every flow committed for every player. Run from the repository root:
+#   python -m benchmarks.worker_bench [--players 1000] [--workers 1,2,4] [--flows build,train,research,battle] [--api-latency-ms 0]
+# Handler work is CPU-bound, so throughput can only scale up to the number of cores available.
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import constants
+import conversation
+import google_sheets
+import storage
+import workers
+from benchmarks.fakes import CallRecorder, FakeTeleBot
+from benchmarks.handler_bench import FLOWS, SEED_OVERRIDES, commander_name
+
+# Flows whose updates can all be generated up front (the alliance flow needs the live alliance index).
+ROUTABLE_FLOWS = ('registration', 'build', 'train', 'research', 'battle')
+# Per flow: the column that is set for every player the flow completed for.
+COMMITTED = {'registration': None, 'build': 'build_queue_item_id', 'train': 'train_queue_item_id', 'research': 'research_queue_item_id', 'battle': 'attack_queue_target_id'}
+
+def seed(path, players):
+    store = storage.SQLiteBackend(path, shared=True)
+    store.import_players([{**google_sheets.build_new_player_record({constants.FIELD_USER_ID: user_id, constants.FIELD_COMMANDER_NAME: commander_name(user_id)}), **SEED_OVERRIDES}
+                          for user_id in range(1, players + 1)])
+    store.close()
+
+def worker_process(args):
+    """A worker started by the Dispatcher: the real Worker, with the fake bot and no Sheets mirror."""
+    logging.basicConfig(level=logging.CRITICAL)
+    index, count, connection = workers.connect()
+    storage.configure('sqlite', sqlite_path=args.db, mirror_to_sheets=False, shared=True)
+    conversation.configure()
+    recorder = CallRecorder()
+    worker = workers.Worker(index, count, connection, FakeTeleBot(recorder, args.api_latency_ms / 1000))
+    worker.start()
+    worker.serve_forever()
+    with open(os.path.join(args.stats, f'worker-{index}.json'), 'w') as f:
+        json.dump({'worker': index, 'telegram_calls': dict(recorder.snapshot())}, f)
+
+def run(count, template, args, flows):
+    workdir = tempfile.mkdtemp(prefix='worker-bench-')
+    try:
+        db = os.path.join(workdir, 'bench.db')
+        shutil.copy(template, db)
+        command = [sys.executable, '-m', 'benchmarks.worker_bench', '--worker', '--db', db, '--stats', workdir, '--api-latency-ms', str(args.api_latency_ms)]
+        dispatcher = workers.Dispatcher(count, lambda index: command)
+        dispatcher.start()
+        world = SimpleNamespace(players=args.players)
+        updates = [make_update() for name in flows for make_update in FLOWS[name](world)]
+        started = time.perf_counter()
+        for update in updates: dispatcher.route(update)
+        dispatcher.stop()  # returns once every worker has drained its queues and exited
+        elapsed = time.perf_counter() - started
+        with sqlite3.connect(db) as conn:
+            committed = {name: conn.execute(f'SELECT COUNT(*) FROM players WHERE "{COMMITTED[name]}" != \'\'').fetchone()[0] for name in flows if COMMITTED[name]}
+            if 'registration' in flows: committed['registration'] = conn.execute('SELECT COUNT(*) FROM players').fetchone()[0] - args.players
+        calls = [json.load(open(os.path.join(workdir, f'worker-{index}.json'))) for index in range(count) if os.path.exists(os.path.join(workdir, f'worker-{index}.json'))]
+        return {'workers': count, 'updates': len(updates), 'elapsed_s': round(elapsed, 3), 'throughput_per_s': round(len(updates) / elapsed, 1),
+                'routed': dispatcher.routed, 'committed': committed, 'telegram_calls': sum(sum(c['telegram_calls'].values()) for c in calls)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-process dispatcher/worker load test with a shared SQLite store and a fake Bot API.')
+    parser.add_argument('--players', type=int, default=1000, help='seeded commanders (and new registrations)')
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated worker counts to compare')
+    parser.add_argument('--flows', default='build,train,research,battle', help='comma-separated subset of: ' + ', '.join(ROUTABLE_FLOWS))
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='added to every fake Bot API call')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--stats', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker: return worker_process(args)
+    logging.basicConfig(level=logging.WARNING)
+    flows = [name for name in args.flows.split(',') if name]
+    if unknown := set(flows) - set(ROUTABLE_FLOWS): parser.error(f"unsupported flows: {', '.join(sorted(unknown))}")
+
+    template_dir = tempfile.mkdtemp(prefix='worker-bench-seed-')
+    try:
+        template = os.path.join(template_dir, 'seed.db')
+        seed(template, args.players)
+        results = [run(int(count), template, args, flows) for count in args.workers.split(',')]
+    finally:
+        shutil.rmtree(template_dir, ignore_errors=True)
+    print(f"{os.cpu_count()} CPU(s); {args.players} players; flows: {', '.join(flows)}")
+    print(f"{'workers':>7}{'updates':>9}{'elapsed s':>11}{'upd/s':>10}  routed per worker / committed per flow")
+    for r in results:
+        print(f"{r['workers']:>7}{r['updates']:>9}{r['elapsed_s']:>11}{r['throughput_per_s']:>10}  {r['routed']} / {r['committed']}")
+    if args.json:
+        with open(args.json, 'w') as f: json.dump({'players': args.players, 'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
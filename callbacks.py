@@ -0,0 +1,106 @@
+# callbacks.py
+# Inline-button routing. Buttons carry typed, versioned payloads - 'v1:<route>:<arg>:...' - built
+# by encode() from a route's declared argument types. Payloads of buttons sent before versioning
+# ('build_sawmill', 'confirm_attack_42', ...) are still parsed, through LEGACY_PAYLOADS.
+#
+# A route returns a Response describing the whole reply to the click: at most one combined edit
+# of the message (text and keyboard replaced together) and the callback answer, which carries the
+# route's result as a toast. A click therefore costs one or two Bot API calls.
+
+import logging
+import re
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+SEPARATOR = ':'
+MAX_PAYLOAD_BYTES = 64  # Telegram's limit for callback_data
+MAX_TOAST_LENGTH = 200
+
+# text=None leaves the message as it is. Otherwise it is replaced by `text` and `markup`, so a
+# markup of None removes the keyboard. `toast` is shown as a notification, or as a dialog if `alert`.
+Response = namedtuple('Response', ['text', 'markup', 'parse_mode', 'toast', 'alert'], defaults=(None, None, None, None, False))
+
+EXPIRED = Response(toast="This button has expired.")
+
+# Route argument types: the codec for each type a route may declare.
+_DECODERS = {int: int, str: str}
+
+# Pre-versioning payloads: full-match pattern -> route. The groups are the route's arguments.
+LEGACY_PAYLOADS = [
+    (re.compile(r'build_(\w+)'), 'build'),
+    (re.compile(r'train_(\w+)'), 'train'),
+    (re.compile(r'research_(\w+)'), 'research'),
+    (re.compile(r'alliance_create'), 'alliance_create'),
+    (re.compile(r'alliance_join'), 'alliance_browse'),
+    (re.compile(r'alliance_join_(.+)'), 'alliance_join'),
+    (re.compile(r'alliance_leave'), 'alliance_leave'),
+    (re.compile(r'target_(-?\d+)'), 'target'),
+    (re.compile(r'confirm_attack_(-?\d+)'), 'confirm_attack'),
+    (re.compile(r'back_to_base'), 'back_to_base'),
+]
+
+def encode(route: str, *args) -> str:
+    """The callback_data of a button for `route` with `args`."""
+    parts = [str(arg) for arg in args]
+    if any(SEPARATOR in part for part in parts): raise ValueError(f"callback argument contains '{SEPARATOR}': {parts}")
+    data = SEPARATOR.join([f'v{VERSION}', route, *parts])
+    if len(data.encode()) > MAX_PAYLOAD_BYTES: raise ValueError(f"callback payload over {MAX_PAYLOAD_BYTES} bytes: {data}")
+    return data
+
+def decode(data: str):
+    """(route, raw args) of a payload, versioned or legacy; (None, ()) if it is neither."""
+    if data and data.startswith('v') and SEPARATOR in data:
+        version, route, *args = data.split(SEPARATOR)
+        if version == f'v{VERSION}': return route, tuple(args)
+        return None, ()
+    for pattern, route in LEGACY_PAYLOADS:
+        if match := pattern.fullmatch(data or ''): return route, match.groups()
+    return None, ()
+
+class CallbackRouter:
+    """
+    The routing table for callback queries. Routes are registered with their argument types;
+    handle() decodes the payload, runs the route with (call, *typed args) and sends its Response.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._routes = {}  # route -> (handler, argument types)
+
+    def route(self, name: str, *types):
+        def register(handler):
+            if name in self._routes: raise ValueError(f"callback route '{name}' is already registered")
+            self._routes[name] = (handler, types)
+            return handler
+        return register
+
+    def resolve(self, data: str):
+        """(handler, typed args) for a payload, or None if it names no route or its arguments do not fit."""
+        name, raw = decode(data)
+        if name not in self._routes: return None
+        handler, types = self._routes[name]
+        if len(raw) != len(types): return None
+        try: return handler, tuple(_DECODERS[kind](value) for kind, value in zip(types, raw))
+        except ValueError: return None
+
+    def handle(self, call):
+        """Runs the route for `call`. The callback is answered even if the route raises."""
+        response = None
+        try:
+            if (target := self.resolve(call.data)) is None:
+                logger.warning("Unroutable callback payload from user %s: %r", call.from_user.id, call.data)
+                response = EXPIRED
+            else:
+                handler, args = target
+                response = handler(call, *args)
+        finally: self.respond(call, response or Response())
+
+    def respond(self, call, response: Response):
+        """The answer with the toast (it stops the button's spinner), then the combined edit if any: one or two API calls."""
+        toast = response.toast[:MAX_TOAST_LENGTH] if response.toast else None
+        self.bot.answer_callback_query(call.id, text=toast, show_alert=response.alert or None)
+        if response.text is not None:
+            try: self.bot.edit_message_text(response.text, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode=response.parse_mode, reply_markup=response.markup)
+            except Exception as e: logger.warning(f"Could not edit message for callback {call.data!r}: {e}")
@@ -0,0 +1,146 @@
+# completion_engine.py
+# Batched queue-completion engine: one timer thread and a min-heap instead of one scheduler job per action.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+Completion = namedtuple('Completion', ['kind', 'user_id', 'due', 'payload'])
+
+class CompletionEngine:
+    """
+    Holds every pending build/train/research/attack/return completion in a heap keyed by due time.
+    Each tick pops everything that has come due and hands the whole group to `resolver`
+    (a callable taking a list of Completion), so completions that line up are resolved
+    with one bulk read and one batched write. At most one completion per (kind, user_id)
+    is pending; scheduling the same pair again replaces it.
+    The resolver returns the completions it could not commit; they are retried after `retry_seconds`.
+    """
+
+    def __init__(self, resolver=None, tick_seconds=1.0, retry_seconds=30):
+        self.resolver = resolver
+        self.tick_seconds = tick_seconds
+        self.retry_seconds = retry_seconds
+        self._heap = []  # (due timestamp, sequence, key); stale keys are skipped lazily
+        self._entries = {}  # (kind, user_id) -> (sequence, Completion)
+        self._by_user = {}  # user_id -> set of kinds pending
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    # --- Scheduling API ---
+
+    def schedule(self, kind: str, user_id: int, due: datetime, payload: dict = None):
+        completion = Completion(kind, user_id, due, payload or {})
+        sequence = next(self._sequence)
+        with self._cond:
+            self._entries[(kind, user_id)] = (sequence, completion)
+            self._by_user.setdefault(user_id, set()).add(kind)
+            heapq.heappush(self._heap, (due.timestamp(), sequence, (kind, user_id)))
+            if self._heap[0][1] == sequence: self._cond.notify()
+        return completion
+
+    def cancel(self, kind: str, user_id: int) -> bool:
+        """Removes a pending completion. Its heap slot is discarded when it surfaces."""
+        with self._cond:
+            if self._entries.pop((kind, user_id), None) is None: return False
+            self._forget_kind(kind, user_id)
+            return True
+
+    def get(self, kind: str, user_id: int):
+        entry = self._entries.get((kind, user_id))
+        return entry[1] if entry else None
+
+    def next_due(self, user_id: int, kinds=None):
+        """Returns the earliest pending Completion for a player (optionally limited to `kinds`), or None."""
+        with self._cond:
+            pending = [self._entries[(kind, user_id)][1] for kind in self._by_user.get(user_id, ()) if kinds is None or kind in kinds]
+        return min(pending, key=lambda completion: completion.due, default=None)
+
+    def pending_count(self) -> int:
+        return len(self._entries)
+
+    def seconds_until_next_due(self):
+        """Seconds until the earliest heap entry (negative if overdue), or None when idle."""
+        with self._cond:
+            return self._heap[0][0] - time.time() if self._heap else None
+
+    def next_due_at(self):
+        """Due time of the earliest heap entry (possibly a cancelled one), or None when idle. Lets a virtual clock jump ahead."""
+        with self._cond:
+            return datetime.fromtimestamp(self._heap[0][0], timezone.utc) if self._heap else None
+
+    # --- Execution ---
+
+    def _forget_kind(self, kind, user_id):
+        kinds = self._by_user.get(user_id)
+        if kinds is not None:
+            kinds.discard(kind)
+            if not kinds: del self._by_user[user_id]
+
+    def pop_due(self, now: datetime = None) -> list:
+        """Removes and returns every completion due at or before `now`, oldest first."""
+        cutoff = (now or datetime.now(timezone.utc)).timestamp()
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= cutoff:
+                _, sequence, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != sequence: continue  # cancelled or rescheduled
+                del self._entries[key]
+                self._forget_kind(*key)
+                due.append(entry[1])
+        return due
+
+    def run_due(self, now: datetime = None) -> int:
+        """Resolves one tick's worth of due completions. Returns how many were handed to the resolver."""
+        batch = self.pop_due(now)
+        if not batch: return 0
+        try:
+            failed = self.resolver(batch) or []
+        except Exception as e:
+            logger.error(f"Completion batch of {len(batch)} failed: {e}")
+            failed = batch
+        self.retry(failed)
+        return len(batch)
+
+    def retry(self, completions):
+        """Puts completions that were not committed back on the heap, due in `retry_seconds` (unless that kind is pending again for the player)."""
+        if not completions: return
+        retry_at = datetime.fromtimestamp(time.time() + self.retry_seconds, timezone.utc)
+        logger.warning(f"Retrying {len(completions)} completions at {retry_at.isoformat()}.")
+        for completion in completions:
+            if self.get(completion.kind, completion.user_id) is None:
+                self.schedule(completion.kind, completion.user_id, retry_at, completion.payload)
+
+    def start(self):
+        if self._running: return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='completion-engine', daemon=True)
+        self._thread.start()
+        logger.info(f"Completion engine started ({self.tick_seconds}s tick).")
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread: self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running: return
+                wait = self._heap[0][0] - time.time() if self._heap else None
+                if wait is None or wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+            # Let completions falling within the same tick accumulate into one batch.
+            time.sleep(self.tick_seconds)
+            self.run_due()
@@ -21,11 +21,41 @@ SHEET_COLUMN_HEADERS = [
     'shield_finish_time',
     'attack_queue_target_id', 'attack_queue_finish_time',
     'return_queue_army_data', 'return_queue_finish_time',
-    'created_at', 'last_seen'
+    'created_at', 'last_seen',
+    'defended_battles'
 ]
 FIELD_USER_ID = 'user_id'
 FIELD_COMMANDER_NAME = 'commander_name'
 
+# --- CACHE CONFIGURATION ---
+# Upper bound on fully cached player records; the user_id -> row index covers every player.
+PLAYER_CACHE_MAX_SIZE = 5000
+# Write-behind batching (enabled with SHEETS_WRITE_BEHIND=1): flush window and buffer bounds.
+WRITE_BEHIND_CONFIG = {'flush_interval_ms': 500, 'max_batch_cells': 1000, 'max_pending_cells': 10000}
+# Sheets API quota (per user per project: 60 reads and 60 writes a minute), how long a caller may queue for it, and 429/5xx backoff.
+SHEETS_QUOTA_CONFIG = {'reads_per_minute': 60, 'writes_per_minute': 60, 'burst': 10, 'max_wait_seconds': 20,
+                       'max_retries': 5, 'backoff_base_seconds': 1.0, 'backoff_max_seconds': 32.0}
+
+# Cold-start snapshots (Sheets backend): file, how often a periodic one is written, and the columns the in-memory indexes load.
+SNAPSHOT_CONFIG = {'path': 'skyhustle.snapshot', 'interval_seconds': 300,
+                   'index_fields': ['user_id', 'commander_name', 'alliance_id', 'power', 'shield_finish_time']}
+
+# --- EXECUTION CONFIGURATION ---
+# Worker shards for per-user serialized handling of Telegram updates and queue completions.
+EXECUTOR_SHARDS = 8
+# Outbound Telegram limits: ~30 messages/s per bot and ~1 message/s per chat, with small bursts.
+OUTBOX_CONFIG = {'global_per_second': 30, 'per_chat_per_second': 1, 'per_chat_burst': 3, 'senders': 4}
+# Pending multi-step chat flows: how long an unanswered step stays valid, and how many players may have one.
+CONVERSATION_CONFIG = {'ttl_seconds': 900, 'max_entries': 10000}
+# Multi-process mode (BOT_WORKERS=N): updates buffered per unreachable worker, how soon a worker that
+# exited is restarted, and how long a cross-worker battle may wait for its result before it is re-sent.
+WORKER_CONFIG = {'update_buffer': 10000, 'restart_delay_seconds': 1.0, 'battle_retry_seconds': 30, 'battle_results_kept': 10000}
+# Building levels covered by the precomputed cost/time tables, and how many rendered menus are kept.
+TABLE_MAX_LEVEL = 50
+MENU_CACHE_SIZE = 1024
+# Local metrics endpoint (enabled with METRICS_PORT); SLOW_REQUEST_MS additionally profiles calls slower than that.
+METRICS_CONFIG = {'host': '127.0.0.1', 'profile_interval_ms': 5, 'slow_requests_kept': 20}
+
 # --- PLAYER & ALLIANCE CONFIGURATION ---
 NEW_PLAYER_SHIELD_HOURS = 24
 ALLIANCE_CONFIG = {
@@ -36,7 +66,12 @@ ALLIANCE_CONFIG = {
     'create_cost': {'diamonds': 100}
 }
 
+# --- MATCHMAKING CONFIGURATION ---
+# Map screen targets: players whose power is within [band_low, band_high] x the attacker's (+ band_floor, so new players find someone).
+MATCHMAKING_CONFIG = {'band_low': 0.5, 'band_high': 1.5, 'band_floor': 100, 'targets': 5}
+
 # --- ALLIANCE SCHEMA ---
+# Membership is each player's alliance_id (indexed in memory by alliances.py); member_ids is a legacy column left blank.
 ALLIANCES_SHEET_COLUMN_HEADERS = [
     'alliance_id', 'alliance_name', 'alliance_tag',
     'leader_id', 'member_ids', 'description', 'created_at'
@@ -65,5 +100,5 @@ INITIAL_PLAYER_STATS = {
 MENU_BASE = "🏠 Base"; MENU_BUILD = "⚒️ Build"; MENU_TRAIN = "🪖 Train"; MENU_RESEARCH = "🔬 Research"; MENU_ATTACK = "⚔️ Attack"; MENU_QUESTS = "🎖 Quests"; MENU_SHOP = "🛒 Shop"; MENU_PREMIUM = "💎 Premium"; MENU_MAP = "🌍 Map"; MENU_ALLIANCE = "👥 Alliance"
 BUILDING_DATA = {'hq': {'id': 'building_hq_level', 'name': 'Command HQ', 'emoji': '🏛️', 'description': 'The heart of your base. Upgrading unlocks new buildings and features.', 'base_cost': {'wood': 100, 'stone': 100}, 'cost_multiplier': 2.5, 'base_time_seconds': 60, 'time_multiplier': 2, 'effects': {}}, 'barracks': {'id': 'building_barracks_level', 'name': 'Barracks', 'emoji': '🪖', 'description': 'Allows training of military units.', 'base_cost': {'wood': 200, 'stone': 100}, 'cost_multiplier': 2.0, 'base_time_seconds': 90, 'time_multiplier': 1.8, 'effects': {}}, 'research_lab': {'id': 'building_research_lab_level', 'name': 'Research Lab', 'emoji': '🔬', 'description': 'Unlocks new technologies to enhance your empire.', 'base_cost': {'wood': 300, 'stone': 400}, 'cost_multiplier': 2.2, 'base_time_seconds': 120, 'time_multiplier': 1.9, 'effects': {}}, 'warehouse': {'id': 'building_warehouse_level', 'name': 'Warehouse', 'emoji': '📦', 'description': 'Increases resource storage capacity.', 'base_cost': {'wood': 200, 'stone': 150}, 'cost_multiplier': 2.2, 'base_time_seconds': 45, 'time_multiplier': 1.8, 'effects': {'type': 'storage', 'value_per_level': 500}}, 'sawmill': {'id': 'building_sawmill_level', 'name': 'Sawmill', 'emoji': '🌲', 'description': 'Produces Wood over time.', 'base_cost': {'wood': 50, 'stone': 100}, 'cost_multiplier': 1.8, 'base_time_seconds': 30, 'time_multiplier': 1.6, 'effects': {'type': 'production', 'resource': 'wood_prod_rate', 'value_per_level': 20}}, 'quarry': {'id': 'building_quarry_level', 'name': 'Stone Quarry', 'emoji': '🪨', 'description': 'Produces Stone over time.', 'base_cost': {'wood': 100, 'stone': 50}, 'cost_multiplier': 1.8, 'base_time_seconds': 30, 'time_multiplier': 1.6, 'effects': {'type': 'production', 'resource': 'stone_prod_rate', 'value_per_level': 20}}, 'ironmine': {'id': 'building_ironmine_level', 'name': 'Iron Mine', 'emoji': '🔩', 'description': 'Produces Iron over time.', 'base_cost': {'wood': 150, 'stone': 150}, 'cost_multiplier': 2.0, 'base_time_seconds': 40, 'time_multiplier': 1.7, 'effects': {'type': 'production', 'resource': 'iron_prod_rate', 'value_per_level': 10}}}
 UNIT_DATA = {'infantry': {'id': 'unit_infantry_count', 'name': 'Infantry', 'emoji': '🪖', 'description': 'Basic frontline soldiers.', 'stats': {'attack': 5, 'defense': 3, 'health': 10, 'power': 1}, 'cost': {'food': 50, 'iron': 10}, 'train_time_seconds': 20, 'required_barracks_level': 1}}
-COMBAT_CONFIG = {'energy_cost_per_attack': 10, 'base_travel_time_seconds': 300, 'loot_percentage': 0.25, 'winner_casualty_percentage': 0.10, 'loser_casualty_percentage': 0.50}
+COMBAT_CONFIG = {'energy_cost_per_attack': 10, 'base_travel_time_seconds': 300, 'loot_percentage': 0.25, 'winner_casualty_percentage': 0.10, 'loser_casualty_percentage': 0.50, 'power_variance': 0.0, 'defended_battles_kept': 20}
 RESEARCH_DATA = {'logistics': {'id': 'research_logistics_unlocked', 'name': 'Advanced Logistics', 'emoji': '📈', 'description': 'Permanently increases all non-food resource production by 10%.', 'cost': {'wood': 1000, 'stone': 1000, 'iron': 500}, 'research_time_seconds': 600, 'required_lab_level': 1, 'effects': [{'type': 'production_multiplier', 'resource': 'wood_prod_rate', 'multiplier': 1.10}, {'type': 'production_multiplier', 'resource': 'stone_prod_rate', 'multiplier': 1.10}, {'type': 'production_multiplier', 'resource': 'iron_prod_rate', 'multiplier': 1.10},]}, 'weaponry': {'id': 'research_weaponry_unlocked', 'name': 'Improved Weaponry', 'emoji': '⚔️', 'description': 'Permanently increases the attack power of all Infantry units by 2 points.', 'cost': {'iron': 1500}, 'research_time_seconds': 900, 'required_lab_level': 2, 'effects': [{'type': 'unit_stat_bonus', 'unit': 'infantry', 'stat': 'attack', 'bonus': 2}]}}
\ No newline at end of file
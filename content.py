@@ -3,7 +3,8 @@
 # Hotfix applied to correctly display the Food resource line in the base panel.
 
 import constants
-from datetime import datetime
+import economy
+from datetime import datetime, timedelta, timezone
 
 def get_welcome_new_player_text():
     """Returns the initial message for a new commander."""
@@ -23,10 +24,17 @@ def get_new_player_welcome_success_text(commander_name):
         "Below is your command dashboard. Use the menu to survey your options."
     )
 
-def get_base_panel_text(player_data: dict) -> str:
+def get_throttled_text():
+    """Shown when the game database is over its request quota: the player's data is fine, just not reachable right now."""
+    return "📡 Command network is congested, Commander. Your base is safe; please repeat your order in a moment."
+
+COMPLETION_LABELS = {'upgrade': 'Construction', 'train': 'Training', 'research': 'Research', 'attack': 'Battle', 'return': 'Army return'}
+
+def get_base_panel_text(player_data: dict, next_completion=None, rank=None) -> str:
     """
     Generates the dynamic, HTML-formatted text for the main base panel.
-    Now includes total army size.
+    Now includes total army size and, when given, the player's next queue completion
+    and their (rank, total players) on the power leaderboard.
     """
     # Safely retrieve data using .get() to prevent errors if a key is missing.
     name = player_data.get(constants.FIELD_COMMANDER_NAME, "N/A")
@@ -39,31 +47,49 @@ def get_base_panel_text(player_data: dict) -> str:
     for unit_key in constants.UNIT_DATA:
         total_units += int(player_data.get(constants.UNIT_DATA[unit_key]['id'], 0))
 
-    # Resource retrieval
-    wood = int(player_data.get('wood', 0))
-    stone = int(player_data.get('stone', 0))
-    iron = int(player_data.get('iron', 0))
-    food = int(player_data.get('food', 0))
+    # Resource retrieval: stockpiles include production accrued since last_seen.
+    resources = economy.current_resources(player_data)
+    rates = economy.effective_rates(player_data)
+    wood, stone, iron, food = resources['wood'], resources['stone'], resources['iron'], resources['food']
     wood_cap = int(player_data.get('wood_storage_cap', 0))
     stone_cap = int(player_data.get('stone_storage_cap', 0))
     iron_cap = int(player_data.get('iron_storage_cap', 0))
     food_cap = int(player_data.get('food_storage_cap', 0))
-    wood_prod = int(player_data.get('wood_prod_rate', 0))
-    stone_prod = int(player_data.get('stone_prod_rate',0))
-    iron_prod = int(player_data.get('iron_prod_rate', 0))
-    food_prod = int(player_data.get('food_prod_rate', 0))
+    wood_prod = int(rates['wood'])
+    stone_prod = int(rates['stone'])
+    iron_prod = int(rates['iron'])
+    food_prod = int(rates['food'])
     
+    status = "<i>Status: All systems nominal. ✅</i>"
+    if next_completion:
+        remaining = max(0, int((next_completion.due - datetime.now(timezone.utc)).total_seconds()))
+        status = f"<i>Next: {COMPLETION_LABELS.get(next_completion.kind, next_completion.kind)} completes in {timedelta(seconds=remaining)} ⏳</i>"
+
     # Construct the message with superior formatting and visual cues.
     text = (
         f"<b><u>🏠 Commander {name}'s Base (Lv. {base_level})</u></b>\n\n"
         f"<b>Power:</b> 💪 {power:,}  |  <b>Army:</b> 🪖 {total_units:,}\n"
-        f"<b>Diamonds:</b> 💎 {diamonds:,}\n"
+        f"<b>Diamonds:</b> 💎 {diamonds:,}"
+        f"{f'  |  <b>Rank:</b> 🏆 #{rank[0]:,} of {rank[1]:,}' if rank else ''}\n"
         f"────────────────────\n"
         f"<b><u>Resources (Production/hr):</u></b>\n"
         f"🌲 Wood:  {wood:,} / {wood_cap:,} <i>( +{wood_prod:,} )</i>\n"
         f"🪨 Stone: {stone:,} / {stone_cap:,} <i>( +{stone_prod:,} )</i>\n"
         f"🔩 Iron:  {iron:,} / {iron_cap:,} <i>( +{iron_prod:,} )</i>\n"
         f"🍞 Food:  {food:,} / {food_cap:,} <i>( +{food_prod:,} )</i>\n\n"
-        f"<i>Status: All systems nominal. ✅</i>"
+        f"{status}"
     )
-    return text
\ No newline at end of file
+    return text
+
+def get_leaderboard_text(title: str, top_rows: list, user_id=None, neighbour_rows=None) -> str:
+    """Renders leaderboard rows of (rank, user_id, commander_name, power); the player's own row is highlighted."""
+    def line(row):
+        rank, row_user_id, name, power = row
+        medal = {1: '🥇', 2: '🥈', 3: '🥉'}.get(rank, f"#{rank}")
+        text = f"{medal} {name or 'Unknown'} — 💪 {power:,}"
+        return f"<b>{text}</b>" if str(row_user_id) == str(user_id) else text
+    text = f"<b><u>🏆 {title}</u></b>\n\n" + ("\n".join(line(row) for row in top_rows) or "<i>No commanders ranked yet.</i>")
+    shown = {row[1] for row in top_rows}
+    if neighbour_rows and not all(row[1] in shown for row in neighbour_rows):
+        text += "\n⋯\n" + "\n".join(line(row) for row in neighbour_rows)
+    return text
@@ -0,0 +1,118 @@
+# conversation.py
+# State of multi-step chat flows (naming a commander, a training quantity, alliance name then tag).
+# A player's pending step is a small serializable record - flow id, step, JSON params - rather than
+# a closure, so it expires, is bounded, and can live in a SQLite file shared by several bot processes.
+#
+# Entries expire `ttl_seconds` after they were set; an abandoned flow simply stops matching. The
+# in-memory store also evicts its least recently set entries beyond `max_entries`; the SQLite store
+# prunes expired and excess rows every `prune_every` writes.
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+Conversation = namedtuple('Conversation', ['flow', 'step', 'params'])
+
+class MemoryConversations:
+    """Process-local store: an OrderedDict by insertion, so the oldest entries are evicted first."""
+    name = 'memory'
+
+    def __init__(self, ttl_seconds=900, max_entries=10000):
+        self.ttl, self.max_entries = ttl_seconds, max_entries
+        self._entries = OrderedDict()  # user_id -> (expires_at, Conversation)
+        self._lock = threading.Lock()
+
+    def start(self, user_id, flow, step, params=None, ttl=None):
+        key, now = str(user_id), time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + (ttl or self.ttl), Conversation(flow, step, dict(params or {})))
+            # Entries are mostly set with the default TTL, so the expired ones collect at the front.
+            while self._entries and (len(self._entries) > self.max_entries or next(iter(self._entries.values()))[0] <= now):
+                self._entries.popitem(last=False)
+
+    def get(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if entry[0] <= time.time():
+                del self._entries[key]; return None
+            return entry[1]
+
+    def clear(self, user_id):
+        with self._lock: self._entries.pop(str(user_id), None)
+
+    def size(self) -> int: return len(self._entries)
+
+    def close(self): pass
+
+class SQLiteConversations:
+    """
+    Store in a SQLite file (WAL mode) that several bot processes can share, so whichever process
+    receives a player's next message finds their pending step.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, ttl_seconds=900, max_entries=10000, prune_every=500):
+        self.path, self.ttl, self.max_entries, self.prune_every = path, ttl_seconds, max_entries, prune_every
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS conversations (user_id TEXT PRIMARY KEY, flow TEXT NOT NULL, step TEXT NOT NULL, params TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_conversations_expiry ON conversations (expires_at)')
+        logger.info(f"Conversation state shared through SQLite at '{path}'.")
+
+    def start(self, user_id, flow, step, params=None, ttl=None):
+        row = (str(user_id), flow, step, json.dumps(params or {}), time.time() + (ttl or self.ttl))
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)', row)
+            self._writes += 1
+            if self._writes % self.prune_every == 0: self._prune()
+
+    def _prune(self):
+        self._conn.execute('DELETE FROM conversations WHERE expires_at <= ?', (time.time(),))
+        self._conn.execute('DELETE FROM conversations WHERE user_id IN (SELECT user_id FROM conversations ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute('SELECT flow, step, params FROM conversations WHERE user_id = ? AND expires_at > ?', (str(user_id), time.time())).fetchone()
+        return Conversation(row[0], row[1], json.loads(row[2])) if row else None
+
+    def clear(self, user_id):
+        with self._lock: self._conn.execute('DELETE FROM conversations WHERE user_id = ?', (str(user_id),))
+
+    def size(self) -> int:
+        with self._lock: return self._conn.execute('SELECT COUNT(*) FROM conversations WHERE expires_at > ?', (time.time(),)).fetchone()[0]
+
+    def close(self):
+        with self._lock: self._conn.close()
+
+# --- Module-level API ---
+
+_store = MemoryConversations(**constants.CONVERSATION_CONFIG)
+
+def configure(sqlite_path: str = None):
+    """Keeps conversation state in memory, or with `sqlite_path` in a file shared between processes."""
+    global _store
+    _store.close()
+    _store = SQLiteConversations(sqlite_path, **constants.CONVERSATION_CONFIG) if sqlite_path else MemoryConversations(**constants.CONVERSATION_CONFIG)
+    return _store
+
+def start(user_id, flow: str, step: str, params: dict = None, ttl: float = None):
+    """Records that `user_id`'s next text message answers `step` of `flow`. `params` must be JSON-serializable."""
+    _store.start(user_id, flow, step, params, ttl)
+
+def get(user_id): return _store.get(user_id)
+def clear(user_id): _store.clear(user_id)
+def size() -> int: return _store.size()
+def close(): _store.close()
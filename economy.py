@@ -0,0 +1,56 @@
+# economy.py
+# Lazy, closed-form resource accrual. Nothing ticks in the background: a player's stockpile is
+# derived on demand from the stored amounts, production rates, storage caps and the time
+# elapsed since 'last_seen', and is only written back ("settled") when a write happens anyway.
+
+import math
+from datetime import datetime, timezone
+
+RESOURCES = ('wood', 'stone', 'iron', 'food')
+
+def _parse_timestamp(value):
+    if not value: return None
+    if isinstance(value, datetime): parsed = value
+    else:
+        try: parsed = datetime.fromisoformat(str(value))
+        except ValueError: return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def effective_rates(player_data: dict) -> dict:
+    """Hourly production per resource. Stored rates already include research multipliers: complete_research applies them once."""
+    return {res: int(player_data.get(f'{res}_prod_rate', 0)) for res in RESOURCES}
+
+def production_between(rate: float, since: datetime, until: datetime) -> int:
+    """
+    Whole units an hourly `rate` yields from `since` to `until`. Units are counted on the absolute
+    clock (floor(rate * hours since the epoch)), so consecutive intervals add up exactly: settling
+    often does not drop the fractional unit of each interval.
+    """
+    if not since or until <= since: return 0
+    return math.floor(rate * until.timestamp() / 3600) - math.floor(rate * since.timestamp() / 3600)
+
+def current_resources(player_data: dict, now: datetime = None) -> dict:
+    """
+    Computes the stockpile at `now` in O(1): stored + production since 'last_seen', clamped to the storage cap.
+    Amounts already above the cap (e.g. from loot) are kept but do not grow further.
+    """
+    now = now or datetime.now(timezone.utc)
+    last_seen = _parse_timestamp(player_data.get('last_seen'))
+    rates = effective_rates(player_data)
+    resources = {}
+    for res in RESOURCES:
+        stored = int(player_data.get(res, 0))
+        cap = int(player_data.get(f'{res}_storage_cap', 0))
+        resources[res] = stored if stored >= cap else min(cap, stored + production_between(rates[res], last_seen, now))
+    return resources
+
+def settle(player_data: dict, now: datetime = None) -> dict:
+    """
+    Returns the updates that persist accrued production up to `now` and move the accrual anchor.
+    Callers merge these into their own write; player_data is updated in place so later
+    calculations in the same request see the settled amounts.
+    """
+    now = now or datetime.now(timezone.utc)
+    updates = {**current_resources(player_data, now), 'last_seen': now.isoformat()}
+    player_data.update(updates)
+    return updates
@@ -0,0 +1,84 @@
+# executor.py
+# Per-user serialized execution: every operation for a user_id runs on that user's shard, in order.
+
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class _Shard:
+    def __init__(self, index):
+        self.index = index
+        self.queue = queue.Queue()
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.thread = None
+
+class ShardedExecutor:
+    """
+    A fixed pool of single-threaded shards, each draining its own FIFO queue.
+    Work is routed by user_id, so one player's updates and completions never overlap
+    (no lost read-modify-write updates), while different players run in parallel.
+    """
+
+    def __init__(self, num_shards=8):
+        self._shards = [_Shard(index) for index in range(num_shards)]
+        for shard in self._shards:
+            shard.thread = threading.Thread(target=self._run, args=(shard,), name=f'shard-{shard.index}', daemon=True)
+            shard.thread.start()
+        logger.info(f"Sharded executor started with {num_shards} shards.")
+
+    @property
+    def num_shards(self): return len(self._shards)
+
+    def shard_for(self, user_id) -> int:
+        try: return int(user_id) % len(self._shards)
+        except (TypeError, ValueError): return zlib.crc32(str(user_id).encode()) % len(self._shards)
+
+    def partition(self, items, key) -> dict:
+        """Groups items by the shard of key(item): {shard index: [items]}, preserving order."""
+        groups = {}
+        for item in items: groups.setdefault(self.shard_for(key(item)), []).append(item)
+        return groups
+
+    def submit(self, user_id, fn, *args, **kwargs) -> Future:
+        return self.submit_to_shard(self.shard_for(user_id), fn, *args, **kwargs)
+
+    def submit_to_shard(self, index, fn, *args, **kwargs) -> Future:
+        future = Future()
+        self._shards[index].queue.put((time.monotonic(), future, fn, args, kwargs))
+        return future
+
+    def stats(self) -> list:
+        """Per-shard queue depth and queueing delay, e.g. for logging or a metrics endpoint."""
+        return [{
+            'shard': shard.index,
+            'depth': shard.queue.qsize(),
+            'processed': shard.processed,
+            'avg_wait_ms': (shard.total_wait / shard.processed * 1000) if shard.processed else 0.0,
+            'max_wait_ms': shard.max_wait * 1000,
+        } for shard in self._shards]
+
+    def shutdown(self, wait=True):
+        """Lets every shard finish the work already queued, then stops it."""
+        for shard in self._shards: shard.queue.put(None)
+        if wait:
+            for shard in self._shards: shard.thread.join()
+
+    def _run(self, shard):
+        while True:
+            item = shard.queue.get()
+            if item is None: return
+            enqueued_at, future, fn, args, kwargs = item
+            wait = time.monotonic() - enqueued_at
+            shard.processed += 1; shard.total_wait += wait; shard.max_wait = max(shard.max_wait, wait)
+            if not future.set_running_or_notify_cancel(): continue
+            try: future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                logger.error(f"Shard {shard.index} task {getattr(fn, '__name__', fn)} failed: {e}", exc_info=True)
+                future.set_exception(e)
@@ -1,17 +1,42 @@
 # google_sheets.py
-# Hotfix: Corrects the shield calculation logic in create_player_row.
+# Write-through player cache: the Players sheet is bulk-loaded once and served from memory.
 
 import os
+import re
+import threading
 import gspread
 import json
 import base64
 import logging
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 import constants
+import metrics
+from player_record import PlayerRecord
+from sheets_client import QuotaClient, SheetsThrottled
+from write_behind import WriteBehindQueue
+from name_index import NameIndex
 
 logger = logging.getLogger(__name__)
 _sheet_client = None
 _spreadsheet = None
+_worksheets = {}
+_write_behind = None
+# Every Sheets call goes through the quota client; SheetsThrottled propagates to callers instead of reading as "not found".
+_quota = QuotaClient(**constants.SHEETS_QUOTA_CONFIG)
+
+# --- PLAYER CACHE ---
+# _row_index maps every known user_id (as the string stored in column A) to its sheet row.
+# _player_cache holds full records for the most recently used commanders, bounded by
+# constants.PLAYER_CACHE_MAX_SIZE and evicted least-recently-used first.
+_cache_lock = threading.RLock()
+_cache_loaded = False
+_player_headers = []
+_row_index = {}
+_player_cache = OrderedDict()
+_name_index = NameIndex()
+# Keys written since a snapshot cold start; the background reconcile leaves them alone. None otherwise.
+_local_writes = None
 
 def _get_spreadsheet():
     global _sheet_client, _spreadsheet
@@ -37,7 +62,8 @@ def _get_spreadsheet():
         raise
 
 def _get_or_create_worksheet(name: str, headers: list):
-    spreadsheet = _get_spreadsheet()
+    if name in _worksheets: return _worksheets[name]
+    spreadsheet = _quota.wrap(_get_spreadsheet())
     try:
         worksheet = spreadsheet.worksheet(name)
         logger.info(f"Found existing '{name}' worksheet.")
@@ -45,11 +71,13 @@ def _get_or_create_worksheet(name: str, headers: list):
         logger.warning(f"'{name}' worksheet not found. Creating it...")
         worksheet = spreadsheet.add_worksheet(title=name, rows=1, cols=len(headers))
         logger.info(f"Successfully created '{name}' worksheet.")
+    worksheet = _quota.wrap(metrics.instrument_api('sheets', worksheet))
     current_headers = worksheet.row_values(1)
     if current_headers != headers:
         logger.info(f"'{name}' worksheet headers are missing or incorrect. Setting headers...")
         worksheet.update(range_name='A1', values=[headers])
         logger.info(f"Successfully set '{name}' worksheet headers.")
+    _worksheets[name] = worksheet
     return worksheet
 
 def get_players_worksheet():
@@ -57,80 +85,430 @@ def get_players_worksheet():
 def get_alliances_worksheet():
     return _get_or_create_worksheet('Alliances', constants.ALLIANCES_SHEET_COLUMN_HEADERS)
 
+def configure_quota(share: float = 1.0):
+    """Sizes the quota client for `share` of the project's Sheets quota, e.g. 1/N in each of N worker processes. Call before the first sheet access."""
+    global _quota
+    config = dict(constants.SHEETS_QUOTA_CONFIG)
+    for key in ('reads_per_minute', 'writes_per_minute'): config[key] *= share
+    config['burst'] = max(1, config['burst'] * share)
+    _quota = QuotaClient(**config)
+
+# --- SECTION: WRITE-BEHIND MODE ---
+
+def enable_write_behind(**options):
+    """Routes player updates through a WriteBehindQueue; options override constants.WRITE_BEHIND_CONFIG."""
+    global _write_behind
+    if _write_behind: return _write_behind
+    _write_behind = WriteBehindQueue(**{**constants.WRITE_BEHIND_CONFIG, **options})
+    _write_behind.start()
+    return _write_behind
+
+def flush_writes() -> int:
+    """
+    Pushes any buffered writes to the sheet, retrying a failed batch once. A no-op when write-behind is disabled.
+    Cells that still could not be written are logged with their values, since nothing else holds them. Returns their count.
+    """
+    if not _write_behind or not _write_behind.flush() or not _write_behind.flush(): return 0
+    unflushed = _write_behind.pending_cells()
+    logger.error(f"Write-behind could not flush {len(unflushed)} cells; they are lost on exit: " + ', '.join(f"'{title}'!{a1}={value!r}" for title, a1, value in unflushed))
+    return len(unflushed)
+
+def pending_writes() -> int:
+    """Cells buffered by write-behind and not yet flushed (0 when disabled)."""
+    return _write_behind.pending_count() if _write_behind else 0
+
+# --- SECTION: CACHE MAINTENANCE ---
+
+def _row_to_record(headers: list, row: list) -> dict:
+    """Mirrors row_values(): trailing empty cells are absent from the record."""
+    end = len(row)
+    while end and row[end - 1] == '': end -= 1
+    return dict(zip(headers, row[:end]))
+
+def _remember_player(key: str, record: PlayerRecord):
+    _player_cache[key] = record
+    _player_cache.move_to_end(key)
+    excess = len(_player_cache) - constants.PLAYER_CACHE_MAX_SIZE
+    if excess <= 0: return
+    # Rows with write-behind cells the sheet does not hold yet stay pinned: re-reading one would return stale values.
+    title = get_players_worksheet().title if _write_behind else None
+    evicted = []
+    for old_key in _player_cache:
+        if len(evicted) == excess or old_key == key: break
+        if title is None or not _write_behind.is_pending(title, _row_index.get(old_key)): evicted.append(old_key)
+    for old_key in evicted: del _player_cache[old_key]
+
+def _ensure_player_cache():
+    """Loads the whole Players sheet with a single bulk read on first use."""
+    global _cache_loaded, _player_headers
+    if _cache_loaded: return
+    with _cache_lock:
+        if _cache_loaded: return
+        worksheet = get_players_worksheet()
+        values = worksheet.get_all_values()
+        _player_headers = values[0] if values else list(constants.SHEET_COLUMN_HEADERS)
+        _row_index.clear(); _player_cache.clear()
+        name_col = _player_headers.index(constants.FIELD_COMMANDER_NAME)
+        names = []
+        for row_number, row in enumerate(values[1:], start=2):
+            if not row or not row[0]: continue
+            _row_index[row[0]] = row_number
+            _remember_player(row[0], PlayerRecord.from_row(_player_headers, row))
+            if len(row) > name_col: names.append((row[0], row[name_col]))
+        _name_index.load(names)
+        _cache_loaded = True
+        logger.info(f"Player cache loaded: {len(_row_index)} commanders indexed, {len(_player_cache)} records cached.")
+
+def _get_cached_player(key: str):
+    """Returns (row, record) for a user_id key, fetching an evicted record with one row read."""
+    _ensure_player_cache()
+    with _cache_lock:
+        row_index = _row_index.get(key)
+        if not row_index: return None, None
+        record = _player_cache.get(key)
+        if metrics.enabled: metrics.CACHE_REQUESTS.inc('players', 'miss' if record is None else 'hit')
+        if record is not None:
+            _player_cache.move_to_end(key)
+            return row_index, record
+    record = PlayerRecord.from_row(_player_headers, get_players_worksheet().row_values(row_index))
+    with _cache_lock:
+        if _row_index.get(key) == row_index: _remember_player(key, record)
+    return row_index, record
+
+def _row_from_append_response(response):
+    """Extracts the row number from an append response such as {'updates': {'updatedRange': 'Players!A7:AV7'}}."""
+    try:
+        match = re.search(r'![A-Z]+(\d+)', response['updates']['updatedRange'])
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+def cache_size() -> dict:
+    """Indexed players and fully cached records, e.g. for a metrics endpoint."""
+    return {'indexed': len(_row_index), 'cached': len(_player_cache)}
+
+def invalidate_player(user_id: int):
+    """Drops one cached record; the next read re-fetches that row."""
+    with _cache_lock:
+        _player_cache.pop(str(user_id), None)
+
+def invalidate_player_cache():
+    """Discards the whole cache. Call after editing or deleting rows by hand in the sheet."""
+    global _cache_loaded
+    with _cache_lock:
+        _cache_loaded = False
+        _row_index.clear(); _player_cache.clear()
+
+# --- SECTION: PLAYER & ALLIANCE ACCESS ---
+
 def find_player_row(user_id: int):
     try:
-        worksheet = get_players_worksheet()
-        cell = worksheet.find(str(user_id), in_column=1)
-        if cell:
-            headers = worksheet.row_values(1); player_data = worksheet.row_values(cell.row)
-            return cell.row, dict(zip(headers, player_data))
-        return None, None
+        row_index, record = _get_cached_player(str(user_id))
+        if record is None: return None, None
+        return row_index, record.as_dict()
+    except SheetsThrottled: raise
+    except Exception as e:
+        logger.error(f"Error finding player {user_id}: {e}"); return None, None
+
+def find_player_record(user_id: int):
+    """Like find_player_row, but returns a private, typed PlayerRecord copy."""
+    try:
+        row_index, record = _get_cached_player(str(user_id))
+        if record is None: return None, None
+        with _cache_lock: return row_index, record.copy()
+    except SheetsThrottled: raise
     except Exception as e:
         logger.error(f"Error finding player {user_id}: {e}"); return None, None
 
 def find_player_by_name(commander_name: str):
+    """Case-insensitive exact match, served from the name index."""
     try:
-        worksheet = get_players_worksheet()
-        headers = worksheet.row_values(1)
-        name_col_index = headers.index(constants.FIELD_COMMANDER_NAME) + 1
-        cell = worksheet.find(commander_name, in_column=name_col_index)
-        if cell:
-            player_data = worksheet.row_values(cell.row)
-            return cell.row, dict(zip(headers, player_data))
-        return None, None
+        _ensure_player_cache()
+        user_id = _name_index.lookup(commander_name)
+        if user_id is None: return None, None
+        return find_player_row(user_id)
+    except SheetsThrottled: raise
     except Exception as e:
         logger.error(f"Error finding player by name '{commander_name}': {e}"); return None, None
 
+def find_players_by_name_prefix(prefix: str, limit: int = 10):
+    """Returns up to `limit` (commander_name, user_id) pairs for autocomplete."""
+    _ensure_player_cache()
+    return _name_index.prefix(prefix, limit)
+
+def is_commander_name_taken(commander_name: str) -> bool:
+    _ensure_player_cache()
+    return _name_index.is_taken(commander_name)
+
+def find_player_rows(user_ids) -> dict:
+    """
+    Returns {user_id: record} for several players at once. Cached records cost nothing;
+    evicted ones are fetched together with a single batch_get.
+    """
+    _ensure_player_cache()
+    found, missing = {}, []
+    with _cache_lock:
+        for user_id in user_ids:
+            key = str(user_id)
+            if (row_index := _row_index.get(key)) is None: continue
+            if (record := _player_cache.get(key)) is not None: found[user_id] = record.as_dict()
+            else: missing.append((user_id, key, row_index))
+    if metrics.enabled:
+        metrics.CACHE_REQUESTS.inc('players', 'hit', amount=len(found)); metrics.CACHE_REQUESTS.inc('players', 'miss', amount=len(missing))
+    if missing:
+        try:
+            ranges = get_players_worksheet().batch_get([f'{row_index}:{row_index}' for _, _, row_index in missing])
+            with _cache_lock:
+                for (user_id, key, row_index), value_range in zip(missing, ranges):
+                    record = PlayerRecord.from_row(_player_headers, value_range[0] if value_range else [])
+                    if _row_index.get(key) == row_index: _remember_player(key, record)
+                    found[user_id] = record.as_dict()
+        except SheetsThrottled: raise
+        except Exception as e:
+            logger.error(f"Error bulk-reading {len(missing)} players: {e}")
+    return found
+
+def _player_cells(key: str, user_id, updates: dict):
+    """
+    Validates one player's updates and converts the ones that change a value into cells.
+    Returns (cells, changed fields as sheet strings), or (None, None) if the player does not exist.
+    """
+    row_index, current = _get_cached_player(key)
+    if not row_index: return None, None
+    with _cache_lock: changed = current.changed_fields(updates)
+    new_name = changed.get(constants.FIELD_COMMANDER_NAME)
+    if new_name is not None and not _name_index.rename(key, current.get(constants.FIELD_COMMANDER_NAME, ''), new_name):
+        logger.warning(f"Rename of player {user_id} to '{new_name}' rejected: name already taken."); return None, None
+    return [gspread.Cell(row_index, _player_headers.index(field) + 1, value) for field, value in changed.items() if field in _player_headers], changed
+
 def update_player_data(user_id: int, updates: dict):
+    return update_players_data({user_id: updates}).get(user_id, False)
+
+def update_players_data(updates_by_user: dict) -> dict:
+    """Writes updates for several players with one update_cells call. Returns {user_id: success}."""
+    results, cell_updates, staged = {}, [], {}
+    for user_id, updates in updates_by_user.items():
+        try: cells, changed = _player_cells(str(user_id), user_id, updates)
+        except SheetsThrottled: raise
+        except Exception as e:
+            logger.error(f"Error updating data for player {user_id}: {e}"); cells = None
+        if cells is None: results[user_id] = False; continue
+        cell_updates.extend(cells); staged[user_id] = changed
     try:
-        worksheet = get_players_worksheet()
-        row_index, _ = find_player_row(user_id)
-        if not row_index: return False
-        headers = worksheet.row_values(1)
-        cell_updates = []
-        for key, value in updates.items():
-            if key in headers:
-                col_index = headers.index(key) + 1
-                cell_updates.append(gspread.Cell(row_index, col_index, str(value)))
-        if cell_updates: worksheet.update_cells(cell_updates, value_input_option='USER_ENTERED')
-        logger.info(f"Successfully updated player data for user {user_id}: {updates}")
-        return True
+        if cell_updates:
+            worksheet = get_players_worksheet()
+            if _write_behind: _write_behind.enqueue(worksheet, cell_updates)
+            else: worksheet.update_cells(cell_updates, value_input_option='USER_ENTERED')
     except Exception as e:
-        logger.error(f"Error updating data for player {user_id}: {e}"); return False
+        for user_id in staged:
+            invalidate_player(user_id); results[user_id] = False
+            logger.error(f"Error updating data for player {user_id}: {e}")
+        if isinstance(e, SheetsThrottled): raise
+        return results
+    with _cache_lock:
+        for user_id in staged:
+            record = _player_cache.get(str(user_id))
+            if record is not None:
+                record.update(staged[user_id]); record.clear_dirty()
+            if _local_writes is not None: _local_writes.add(str(user_id))
+    for user_id, changed in staged.items():
+        results[user_id] = True
+        logger.info("Successfully updated player data for user %s: %s", user_id, changed)
+    return results
+
+def build_new_player_record(player_data_dict: dict) -> dict:
+    """Fills in starting stats, the new-player shield and timestamps for a registration."""
+    now_utc = datetime.now(timezone.utc)
+
+    # --- THIS IS THE CORRECTED LOGIC ---
+    # Calculate the shield time dynamically using the duration from constants.
+    shield_duration_hours = constants.NEW_PLAYER_SHIELD_HOURS
+    shield_finish_time = now_utc + timedelta(hours=shield_duration_hours)
+
+    return {
+        **constants.INITIAL_PLAYER_STATS,
+        **player_data_dict,
+        'shield_finish_time': shield_finish_time.isoformat(),
+        'created_at': now_utc.isoformat(),
+        'last_seen': now_utc.isoformat(),
+    }
 
 def create_player_row(player_data_dict: dict):
+    return append_player_record(build_new_player_record(player_data_dict))
+
+def append_player_record(full_player_data: dict):
+    """Appends an already complete player record as a new row."""
+    key = str(full_player_data.get(constants.FIELD_USER_ID))
+    name = str(full_player_data.get(constants.FIELD_COMMANDER_NAME, ''))
     try:
+        _ensure_player_cache()
+        if not _name_index.add(key, name):
+            logger.warning(f"Registration of '{name}' for user_id {key} rejected: name already taken."); return False
         worksheet = get_players_worksheet()
-        now_utc = datetime.now(timezone.utc)
-        
-        # --- THIS IS THE CORRECTED LOGIC ---
-        # Calculate the shield time dynamically using the duration from constants.
-        shield_duration_hours = constants.NEW_PLAYER_SHIELD_HOURS
-        shield_finish_time = now_utc + timedelta(hours=shield_duration_hours)
-        
-        full_player_data = {
-            **constants.INITIAL_PLAYER_STATS,
-            **player_data_dict,
-            'shield_finish_time': shield_finish_time.isoformat(),
-            'created_at': now_utc.isoformat(),
-            'last_seen': now_utc.isoformat(),
-        }
-
         row_to_append = [full_player_data.get(header, '') for header in constants.SHEET_COLUMN_HEADERS]
-        worksheet.append_row(row_to_append)
-        logger.info(f"Successfully created new player row for user_id {player_data_dict.get('user_id')}.")
+        try: response = worksheet.append_row(row_to_append)
+        except Exception:
+            _name_index.remove(name, key); raise
+        row_index = _row_from_append_response(response)
+        if row_index and _cache_loaded:
+            with _cache_lock:
+                _row_index[key] = row_index
+                _remember_player(key, PlayerRecord.from_row(_player_headers, [str(v) for v in row_to_append]))
+                if _local_writes is not None: _local_writes.add(key)
+        elif _cache_loaded:
+            invalidate_player_cache()
+        logger.info(f"Successfully created new player row for user_id {full_player_data.get('user_id')}.")
         return True
+    except SheetsThrottled: raise
     except Exception as e:
-        logger.error(f"Error creating new player row for {player_data_dict.get('user_id')}: {e}")
+        logger.error(f"Error creating new player row for {full_player_data.get('user_id')}: {e}")
         return False
 
+def get_all_players():
+    """Returns every player record from one bulk read, overlaid with cached (possibly unflushed) state."""
+    values = get_players_worksheet().get_all_values()
+    if not values: return []
+    headers, records = values[0], []
+    with _cache_lock:
+        for row in values[1:]:
+            if not row or not row[0]: continue
+            cached = _player_cache.get(row[0])
+            records.append(cached.as_dict() if cached is not None else _row_to_record(headers, row))
+    return records
+
+# --- SECTION: SNAPSHOT COLD START ---
+# A snapshot (snapshot.py) stands in for the startup get_all_values: the row and name indexes, and
+# for a clean snapshot the record cache, are filled from it, then reconciled against the sheet later.
+
+def prime_from_snapshot(snap):
+    """
+    Fills the player indexes from a snapshot instead of the sheet. A clean snapshot (written at
+    shutdown) also fills the record cache; after an unclean stop the sheet may be newer, so each
+    player's record is read from the sheet on first use instead.
+    """
+    global _cache_loaded, _player_headers, _local_writes
+    headers = snap.headers('players')[1:]
+    # Columns added since the snapshot was written are appended to the sheet's headers, as get_players_worksheet() does.
+    headers += [header for header in constants.SHEET_COLUMN_HEADERS if header not in headers]
+    keys, rows = snap.values('players', constants.FIELD_USER_ID), snap.values('players', '_row')
+    names = snap.values('players', constants.FIELD_COMMANDER_NAME)
+    with _cache_lock:
+        _player_headers = headers
+        _row_index.clear(); _player_cache.clear()
+        _row_index.update((key, int(row)) for key, row in zip(keys, rows) if key)
+        if snap.clean:
+            for row in snap.rows('players', slice(max(0, len(keys) - constants.PLAYER_CACHE_MAX_SIZE), None)):
+                if row[1]: _remember_player(row[1], PlayerRecord.from_row(headers, row[1:]))
+        _name_index.load([(key, name) for key, name in zip(keys, names) if key])
+        _local_writes = set()
+        _cache_loaded = True
+    logger.info(f"Player cache primed from snapshot: {len(_row_index)} commanders indexed, {len(_player_cache)} records cached.")
+
+def snapshot_tables() -> dict:
+    """
+    Every player (with its sheet row) and alliance, as snapshot.write expects. When every player is
+    cached the cache is the source (including unflushed writes); otherwise one bulk read, overlaid with it.
+    """
+    _ensure_player_cache()
+    with _cache_lock:
+        headers = list(_player_headers)
+        complete = len(_player_cache) == len(_row_index)
+        if complete: cached = [(row, key, _player_cache[key].as_dict()) for key, row in _row_index.items()]
+    if not complete:
+        values = get_players_worksheet().get_all_values()
+        with _cache_lock:
+            cached = [(row_number, row[0], (_player_cache[row[0]].as_dict() if row[0] in _player_cache else _row_to_record(headers, row)))
+                      for row_number, row in enumerate(values[1:], start=2) if row and row[0]]
+    players = [[str(row), *(record.get(header, '') for header in headers)] for row, _, record in sorted(cached, key=lambda entry: entry[0])]
+    alliance_headers = constants.ALLIANCES_SHEET_COLUMN_HEADERS
+    alliances = [[str(record.get(header, '')) for header in alliance_headers] for record in get_all_alliances()]
+    return {'players': (['_row'] + headers, players), 'alliances': (alliance_headers, alliances)}
+
+def reconcile_with_snapshot(snap):
+    """
+    Brings a snapshot-primed cache in line with the sheet with one bulk read. Each row is compared
+    with the snapshot's; what differs (hand edits, writes after an unclean snapshot, new rows) is
+    applied to the indexes and any cached record. Players written here since the cold start are
+    skipped: the cache already holds their newest state.
+    Returns (every player's current record, {user_id: fields that differed from the snapshot}).
+    """
+    global _local_writes
+    values = get_players_worksheet().get_all_values()
+    headers = values[0] if values else []
+    if headers != snap.headers('players')[1:]:
+        logger.warning("Players sheet columns differ from the snapshot's; reloading the cache from the sheet.")
+        invalidate_player_cache()
+        with _cache_lock: _local_writes = None
+        records = get_all_players()
+        return records, {record[constants.FIELD_USER_ID]: record for record in records if record.get(constants.FIELD_USER_ID)}
+    baseline = {row[1]: row for row in snap.rows('players')}
+    name_col = headers.index(constants.FIELD_COMMANDER_NAME)
+    records, changes, seen = [], {}, set()
+    with _cache_lock:
+        for row_number, row in enumerate(values[1:], start=2):
+            if not row or not row[0]: continue
+            key = row[0]; seen.add(key)
+            if key in _local_writes:
+                cached = _player_cache.get(key)
+                records.append(cached.as_dict() if cached is not None else _row_to_record(headers, row)); continue
+            row = row + [''] * (len(headers) - len(row))
+            old = baseline.get(key)
+            _row_index[key] = row_number
+            diff = {header: value for header, value in zip(headers, row) if value} if old is None else \
+                   {header: value for header, before, value in zip(headers, old[1:], row) if before != value}
+            if diff:
+                changes[key] = diff
+                if old is None: _name_index.add(key, row[name_col])
+                elif constants.FIELD_COMMANDER_NAME in diff: _name_index.rename(key, old[1 + name_col], row[name_col])
+                if (cached := _player_cache.get(key)) is not None:
+                    cached.update(diff); cached.clear_dirty()
+            records.append(_row_to_record(headers, row))
+        for key in baseline.keys() - seen - _local_writes:
+            logger.warning(f"Player {key} is in the snapshot but no longer in the sheet; dropping it from the cache.")
+            _row_index.pop(key, None); _player_cache.pop(key, None); _name_index.remove(baseline[key][1 + name_col], key)
+        _local_writes = None
+    return records, changes
+
 def create_alliance(alliance_data: dict):
     try:
         worksheet = get_alliances_worksheet()
-        alliance_data['created_at'] = datetime.now(timezone.utc).isoformat()
+        alliance_data.setdefault('created_at', datetime.now(timezone.utc).isoformat())
         row_to_append = [alliance_data.get(header, '') for header in constants.ALLIANCES_SHEET_COLUMN_HEADERS]
         worksheet.append_row(row_to_append)
         logger.info(f"Successfully created new alliance: {alliance_data.get('alliance_name')}")
         return True
+    except SheetsThrottled: raise
+    except Exception as e:
+        logger.error(f"Error creating new alliance: {e}"); return False
+
+def get_all_alliances():
+    """Returns every alliance record from one bulk read of the Alliances sheet."""
+    values = get_alliances_worksheet().get_all_values()
+    if not values: return []
+    return [_row_to_record(values[0], row) for row in values[1:] if row and row[0]]
+
+def _find_alliance_row(worksheet, alliance_id: str):
+    cell = worksheet.find(str(alliance_id), in_column=1)
+    return cell.row if cell else None
+
+def update_alliance(alliance_id: str, updates: dict):
+    try:
+        worksheet = get_alliances_worksheet()
+        if not (row := _find_alliance_row(worksheet, alliance_id)): return False
+        headers = constants.ALLIANCES_SHEET_COLUMN_HEADERS
+        cells = [gspread.Cell(row, headers.index(key) + 1, value) for key, value in updates.items() if key in headers]
+        if cells: worksheet.update_cells(cells, value_input_option='USER_ENTERED')
+        return True
+    except SheetsThrottled: raise
+    except Exception as e:
+        logger.error(f"Error updating alliance {alliance_id}: {e}"); return False
+
+def delete_alliance(alliance_id: str):
+    try:
+        worksheet = get_alliances_worksheet()
+        if row := _find_alliance_row(worksheet, alliance_id): worksheet.delete_rows(row)
+        logger.info(f"Disbanded alliance {alliance_id}.")
+        return True
+    except SheetsThrottled: raise
     except Exception as e:
-        logger.error(f"Error creating new alliance: {e}"); return False
\ No newline at end of file
+        logger.error(f"Error deleting alliance {alliance_id}: {e}"); return False
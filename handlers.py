@@ -3,27 +3,32 @@
 
 import logging
 import math
-import time
 import json
-import uuid
 from datetime import datetime, timedelta, timezone
 from telebot.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from functools import partial
+from functools import partial, wraps
 
 import constants
+import alliances
+import battle
+import callbacks
 import content
-import google_sheets
+import conversation
+import economy
+import leaderboard
+import matchmaking
+import menus
+import metrics
+import outbox
+import storage
+import tables
+from completion_engine import Completion
+from sheets_client import SheetsThrottled
 
 logger = logging.getLogger(__name__)
-user_state = {}
 
 # --- SECTION 1: UTILITY & CALCULATION HELPERS ---
-
-def calculate_cost(base_cost, multiplier, level):
-    return {res: math.floor(amount * (multiplier ** (level - 1))) for res, amount in base_cost.items()}
-
-def calculate_time(base_time, multiplier, level):
-    return math.floor(base_time * (multiplier ** (level - 1)))
+# Cost/time tables live in tables.py; the idle Build/Train/Research screens are rendered by menus.py.
 
 def get_main_menu_keyboard():
     markup = ReplyKeyboardMarkup(row_width=3, resize_keyboard=True)
@@ -32,18 +37,18 @@ def get_main_menu_keyboard():
     return markup
 
 
-# --- SECTION 2: SCHEDULER COMPLETION JOBS ---
+# --- SECTION 2: QUEUE COMPLETIONS ---
+# Each complete_* function is pure: it takes the current player record and returns the updates to
+# write plus the notification text. resolve_completions applies a whole tick's worth of them with
+# one bulk read and one batched write. Completion kinds: upgrade, train, research, attack, return.
 
-def complete_upgrade_job(bot, user_id, building_key):
-    logger.info(f"Executing complete_upgrade_job for user {user_id}, building: {building_key}")
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data: return
-    
+def complete_upgrade(player_data, building_key, now=None):
     building_info = constants.BUILDING_DATA[building_key]
     building_level_field = building_info['id']
-    
+
     current_level = int(player_data.get(building_level_field, 0))
-    updates = { building_level_field: current_level + 1, 'build_queue_item_id': '', 'build_queue_finish_time': '' }
+    # Settle production at the old rate/cap before the upgrade changes them.
+    updates = { **economy.settle(player_data, now), building_level_field: current_level + 1, 'build_queue_item_id': '', 'build_queue_finish_time': '' }
     effect = building_info.get('effects', {})
     if effect.get('type') == 'production':
         updates[effect['resource']] = int(player_data.get(effect['resource'], 0)) + effect['value_per_level']
@@ -51,320 +56,658 @@ def complete_upgrade_job(bot, user_id, building_key):
         value = effect['value_per_level']
         for res in ['wood', 'stone', 'iron', 'food']:
             updates[f'{res}_storage_cap'] = int(player_data.get(f'{res}_storage_cap', 0)) + value
-    if google_sheets.update_player_data(user_id, updates):
-        bot.send_message(user_id, f"✅ Construction complete! Your **{building_info['name']}** has been upgraded to **Level {current_level + 1}**.")
+    return updates, f"✅ Construction complete! Your **{building_info['name']}** has been upgraded to **Level {current_level + 1}**."
 
-def complete_training_job(bot, user_id, unit_key, quantity):
-    logger.info(f"Executing complete_training_job for user {user_id}, unit: {unit_key}, quantity: {quantity}")
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data: return
-    
+def complete_training(player_data, unit_key, quantity, now=None):
     unit_info = constants.UNIT_DATA[unit_key]
     unit_count_field = unit_info['id']
-
     updates = {
         unit_count_field: int(player_data.get(unit_count_field, 0)) + quantity,
         'power': int(player_data.get('power', 0)) + (unit_info['stats']['power'] * quantity),
         'train_queue_item_id': '', 'train_queue_quantity': '', 'train_queue_finish_time': ''
     }
-    if google_sheets.update_player_data(user_id, updates):
-        bot.send_message(user_id, f"✅ Training complete! **{quantity}x {unit_info['name']}** {unit_info['emoji']} have joined your army.")
-        
-def complete_research_job(bot, user_id, research_key):
-    logger.info(f"Executing complete_research_job for user {user_id}, research: {research_key}")
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data: return
+    return updates, f"✅ Training complete! **{quantity}x {unit_info['name']}** {unit_info['emoji']} have joined your army."
+
+def complete_research(player_data, research_key, now=None):
     research_info = constants.RESEARCH_DATA[research_key]
-    updates = { research_info['id']: 'TRUE', 'research_queue_item_id': '', 'research_queue_finish_time': '' }
+    # Production up to now accrues at the old rates; production_multiplier effects are then written into the stored rates.
+    updates = { **economy.settle(player_data, now), research_info['id']: 'TRUE', 'research_queue_item_id': '', 'research_queue_finish_time': '' }
     for effect in research_info.get('effects', []):
         if effect.get('type') == 'production_multiplier':
-            rate_field, multiplier = effect['resource'], effect['multiplier']
-            current_rate = int(player_data.get(rate_field, 0))
-            updates[rate_field] = math.floor(current_rate * multiplier)
-    if google_sheets.update_player_data(user_id, updates):
-        bot.send_message(user_id, f"✅ Research complete! You have successfully developed **{research_info['name']}**.")
-
-def battle_resolution_job(bot, scheduler, attacker_id, defender_id):
-    logger.info(f"Executing battle_resolution_job: Attacker {attacker_id} vs Defender {defender_id}")
-    _, attacker_data = google_sheets.find_player_row(attacker_id); _, defender_data = google_sheets.find_player_row(defender_id)
-    if not attacker_data or not defender_data: return
-    attacker_power = sum(int(attacker_data.get(u['id'], 0)) * u['stats']['attack'] for u in constants.UNIT_DATA.values())
-    defender_power = sum(int(defender_data.get(u['id'], 0)) * u['stats']['defense'] for u in constants.UNIT_DATA.values())
-    attacker_wins = attacker_power > defender_power
-    win_cas, lose_cas = constants.COMBAT_CONFIG['winner_casualty_percentage'], constants.COMBAT_CONFIG['loser_casualty_percentage']
-    attacker_survivors = {k: math.floor(int(attacker_data.get(u['id'], 0)) * (1-(win_cas if attacker_wins else lose_cas))) for k,u in constants.UNIT_DATA.items()}
-    defender_survivors = {k: math.floor(int(defender_data.get(u['id'], 0)) * (1-(lose_cas if attacker_wins else win_cas))) for k,u in constants.UNIT_DATA.items()}
-    looted = {res: math.floor(int(defender_data.get(res, 0)) * constants.COMBAT_CONFIG['loot_percentage']) for res in ['wood','stone','iron','food']} if attacker_wins else {}
-    return_time = datetime.now(timezone.utc) + timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds'])
-    attacker_updates = {'attack_queue_target_id':'', 'attack_queue_finish_time':'', 'return_queue_army_data':json.dumps(attacker_survivors), 'return_queue_finish_time':return_time.isoformat(), **{u['id']:0 for u in constants.UNIT_DATA.values()}}
-    if attacker_wins:
-        for res, amount in looted.items(): attacker_updates[res] = int(attacker_data.get(res, 0)) + amount
-    defender_updates = {u['id']: defender_survivors[k] for k, u in constants.UNIT_DATA.items()}
-    if attacker_wins:
+            updates[effect['resource']] = math.floor(int(player_data.get(effect['resource'], 0)) * effect['multiplier'])
+    return updates, f"✅ Research complete! You have successfully developed **{research_info['name']}**."
+
+def resolve_defenses(battles, now=None):
+    """
+    Defender's half of a batch of battles, resolved in one vectorized pass. `battles` is a list of
+    (defender_data, attacking_army, attacker_research, seed) with distinct defenders; each army is
+    {unit_key: count} and attacker_research the attacker's unlocked research keys.
+    Returns [(defender_updates, outcome)]; outcome carries what the attacker's half needs.
+    """
+    now = now or datetime.now(timezone.utc)
+    settled = [economy.settle(defender_data, now) for defender_data, _, _, _ in battles]
+    garrisons = [battle.garrison_vector(defender_data) for defender_data, _, _, _ in battles]
+    result = battle.resolve_battles(
+        [battle.army_vector(army) for _, army, _, _ in battles],
+        [battle.unit_stats(frozenset(research))['attack'] for _, _, research, _ in battles],
+        garrisons,
+        [battle.unit_stats(battle.unlocked_research(defender_data))['defense'] for defender_data, _, _, _ in battles],
+        [[int(defender_data.get(res, 0)) for res in battle.LOOT_RESOURCES] for defender_data, _, _, _ in battles],
+        seeds=[seed for _, _, _, seed in battles] if all(seed is not None for _, _, _, seed in battles) else None)
+    resolved = []
+    for i, (defender_data, army, _, seed) in enumerate(battles):
+        attacker_wins = bool(result.attacker_wins[i])
+        looted = dict(zip(battle.LOOT_RESOURCES, map(int, result.looted[i]))) if attacker_wins else {}
+        defender_updates = {**settled[i], **dict(zip(battle.UNIT_FIELDS, map(int, result.defender_survivors[i])))}
+        defender_updates['power'] = max(0, int(defender_data.get('power', 0)) - battle.army_power(garrisons[i] - result.defender_survivors[i]))
         for res, amount in looted.items(): defender_updates[res] = int(defender_data.get(res, 0)) - amount
-    google_sheets.update_player_data(attacker_id, attacker_updates); google_sheets.update_player_data(defender_id, defender_updates)
-    report = f"<b>--- BATTLE REPORT ---</b>\nOutcome: {'Attacker Victory' if attacker_wins else 'Defender Victory'}!\nLooted: {' | '.join([f'{v:,} {k.capitalize()}' for k, v in looted.items()]) if attacker_wins else 'None'}"
-    bot.send_message(attacker_id, report, parse_mode='HTML'); bot.send_message(defender_id, report, parse_mode='HTML')
-    scheduler.add_job(army_return_job, 'date', run_date=return_time, args=[bot, attacker_id, attacker_survivors], id=f'return_{attacker_id}_{time.time()}')
-
-def army_return_job(bot, user_id, surviving_army):
-    logger.info(f"Executing army_return_job for user {user_id}")
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data: return
+        report = f"<b>--- BATTLE REPORT ---</b>\nOutcome: {'Attacker Victory' if attacker_wins else 'Defender Victory'}!\nLooted: {' | '.join([f'{v:,} {k.capitalize()}' for k, v in looted.items()]) if attacker_wins else 'None'}"
+        outcome = {'attacker_wins': attacker_wins, 'survivors': battle.army_dict(result.attacker_survivors[i]), 'looted': looted, 'report': report}
+        if seed is not None: defender_updates['defended_battles'] = _record_defense(defender_data, seed, army, outcome)
+        resolved.append((defender_updates, outcome))
+    return resolved
+
+def defended_battles(defender_data) -> dict:
+    """The defender's recent battles, {str(seed): {'army', 'outcome'}}, oldest first."""
+    value = defender_data.get('defended_battles') or {}
+    if isinstance(value, str):
+        try: value = json.loads(value)
+        except ValueError: return {}
+    return value if isinstance(value, dict) else {}
+
+def _record_defense(defender_data, seed, army, outcome) -> str:
+    """
+    The defended_battles value after this battle, written with the defender's losses. A battle whose
+    defender half is committed but whose attacker half never was (a crash in between) is re-armed from
+    the attacker's queue with the same seed; the record lets that 'defend' replay instead of fight again.
+    """
+    battles = {**defended_battles(defender_data), str(seed): {'army': army, 'outcome': outcome}}
+    return json.dumps(dict(list(battles.items())[-constants.COMBAT_CONFIG['defended_battles_kept']:]))
+
+def resolve_defense(defender_data, attacking_army, now=None, attacker_research=(), seed=None):
+    """Single-battle form of resolve_defenses. Returns (defender_updates, outcome)."""
+    return resolve_defenses([(defender_data, attacking_army, attacker_research, seed)], now)[0]
+
+def conclude_attack(attacker_data, attacking_army, outcome, now=None):
+    """
+    Attacker's half of a battle: the units that marched leave the garrison, survivors start
+    marching home and any loot is credited. Returns (attacker_updates, return_time).
+    """
+    now = now or datetime.now(timezone.utc)
+    return_time = now + timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds'])
+    attacker_updates = {**economy.settle(attacker_data, now), 'attack_queue_target_id':'', 'attack_queue_finish_time':'', 'return_queue_army_data':json.dumps(outcome['survivors']), 'return_queue_finish_time':return_time.isoformat()}
+    for k, u in constants.UNIT_DATA.items(): attacker_updates[u['id']] = max(0, int(attacker_data.get(u['id'], 0)) - attacking_army.get(k, 0))
+    # Marching survivors still count towards power; only the casualties are lost.
+    casualties = battle.army_vector(attacking_army) - battle.army_vector(outcome['survivors'])
+    attacker_updates['power'] = max(0, int(attacker_data.get('power', 0)) - battle.army_power(casualties))
+    for res, amount in outcome['looted'].items(): attacker_updates[res] = int(attacker_data.get(res, 0)) + amount
+    return attacker_updates, return_time
+
+def complete_army_return(player_data, surviving_army, now=None):
     updates = {'return_queue_army_data': '', 'return_queue_finish_time': ''}
     for key, count in surviving_army.items():
         updates[constants.UNIT_DATA[key]['id']] = int(player_data.get(constants.UNIT_DATA[key]['id'], 0)) + count
-    if google_sheets.update_player_data(user_id, updates):
-        bot.send_message(user_id, "✅ Your surviving troops have returned to base.")
+    return updates, "✅ Your surviving troops have returned to base."
+
+COMPLETION_HANDLERS = {
+    'upgrade': lambda player_data, payload, now: complete_upgrade(player_data, payload['building'], now),
+    'train': lambda player_data, payload, now: complete_training(player_data, payload['unit'], payload['quantity'], now),
+    'research': lambda player_data, payload, now: complete_research(player_data, payload['research'], now),
+    'return': lambda player_data, payload, now: complete_army_return(player_data, payload['army'], now),
+}
+
+def battle_in_flight(attacker_id, attacker_data, target, seed=None) -> bool:
+    """Whether the attacker's queued attack is still the battle on `target` identified by `seed`, i.e. its result is not applied yet."""
+    if str(attacker_data.get('attack_queue_target_id') or '') != str(target): return False
+    if seed is None: return True
+    try: return battle.battle_seed(attacker_id, target, datetime.fromisoformat(attacker_data.get('attack_queue_finish_time'))) == seed
+    except (TypeError, ValueError): return False
+
+def _stage_updates(records, pending_updates, user_id, updates):
+    """Merges updates into the batch and into the in-memory record, so a later completion for the same player in this tick sees them."""
+    records[user_id].update(updates)
+    pending_updates.setdefault(user_id, {}).update(updates)
+
+def resolve_completions(bot, scheduler, completions):
+    """
+    Resolves a batch of completions for players owned by one worker: one bulk read of the
+    players, one batched write, then the notifications. Battles touch two players, so they run
+    as a chain of follow-ups, each executed by the worker that owns the player it writes:
+    'attack' (attacker: snapshot the marching army) -> 'defend' (defender: fight, lose units and
+    loot) -> 'attack_result' (attacker: casualties, loot, march home).
+    Returns (completions to retry on the engine, follow-up completions to route).
+    """
+    now = datetime.now(timezone.utc)
+    try: records = storage.find_player_rows({c.user_id for c in completions})
+    except SheetsThrottled as e:
+        logger.warning("Deferring %d completions: %s", len(completions), e)
+        return [_as_retry(c) for c in completions], []
+    pending_updates, notices, returns, follow_ups, defends = {}, [], [], [], []
+    for completion in sorted(completions, key=lambda c: c.due):
+        logger.info("Resolving %s completion for user %s", completion.kind, completion.user_id)
+        if metrics.enabled: metrics.COMPLETIONS.inc(completion.kind)
+        player_data, payload = records.get(completion.user_id), completion.payload
+        if not player_data: continue
+        if completion.kind == 'attack':
+            if 'seed' in payload and not battle_in_flight(completion.user_id, player_data, payload['target'], payload['seed']): continue  # a retried battle that has meanwhile concluded
+            army = {k: int(player_data.get(u['id'], 0)) for k, u in constants.UNIT_DATA.items()}
+            follow_ups.append((None, Completion('defend', payload['target'], now, {
+                'attacker': completion.user_id, 'army': army, 'research': battle.unlocked_research(player_data),
+                'seed': payload.get('seed') or battle.battle_seed(completion.user_id, payload['target'], completion.due)})))
+        elif completion.kind == 'defend':
+            defends.append(completion)
+        elif completion.kind == 'attack_result':
+            if 'target' in payload and not battle_in_flight(completion.user_id, player_data, payload['target'], payload.get('seed')):
+                logger.info("Battle result for user %s already applied; ignoring the duplicate.", completion.user_id); continue
+            attacker_updates, return_time = conclude_attack(player_data, payload['army'], payload['outcome'], now)
+            _stage_updates(records, pending_updates, completion.user_id, attacker_updates)
+            notices.append((completion.user_id, payload['outcome']['report'], 'HTML'))
+            returns.append((completion.user_id, return_time, payload['outcome']['survivors']))
+        else:
+            updates, notice = COMPLETION_HANDLERS[completion.kind](player_data, payload, now)
+            _stage_updates(records, pending_updates, completion.user_id, updates)
+            notices.append((completion.user_id, notice, None))
+    # All battles of the tick resolve together; a defender hit twice fights again in the next wave, with its losses applied.
+    # A battle the defender's record already holds (re-armed after a crash, or a duplicate) is replayed, not fought again.
+    while defends:
+        wave, deferred, seen = [], [], set()
+        for completion in defends:
+            if (recorded := defended_battles(records[completion.user_id]).get(str(completion.payload.get('seed')))) is not None:
+                logger.info("Battle %s on user %s was already fought; replaying its result.", completion.payload['seed'], completion.user_id)
+                # Only staged this tick (a duplicate), the record must commit before the attacker acts on it.
+                follow_ups.append((completion.user_id if completion.user_id in pending_updates else None, Completion('attack_result', completion.payload['attacker'], now, {
+                    'army': recorded['army'], 'outcome': recorded['outcome'], 'target': completion.user_id, 'seed': completion.payload['seed']})))
+                continue
+            (deferred if completion.user_id in seen else wave).append(completion); seen.add(completion.user_id)
+        battles = [(records[c.user_id], c.payload['army'], c.payload.get('research', ()), c.payload.get('seed')) for c in wave]
+        for completion, (defender_updates, outcome) in zip(wave, resolve_defenses(battles, now) if battles else ()):
+            _stage_updates(records, pending_updates, completion.user_id, defender_updates)
+            notices.append((completion.user_id, outcome['report'], 'HTML'))
+            follow_ups.append((completion.user_id, Completion('attack_result', completion.payload['attacker'], now, {
+                'army': completion.payload['army'], 'outcome': outcome, 'target': completion.user_id, 'seed': completion.payload.get('seed')})))
+        defends = deferred
+    try: results = storage.update_players_data(pending_updates) if pending_updates else {}
+    except SheetsThrottled as e:
+        logger.warning("Completion writes for %d players throttled: %s", len(pending_updates), e); results = {}
+    for user_id, return_time, survivors in returns:
+        if results.get(user_id): scheduler.schedule('return', user_id, return_time, {'army': survivors})
+    with outbox.notifications():
+        for user_id, text, parse_mode in notices:
+            if results.get(user_id):
+                try: bot.send_message(user_id, text, parse_mode=parse_mode)
+                except Exception as e: logger.warning(f"Could not notify user {user_id}: {e}")
+    failed = [_as_retry(c) for c in completions if c.user_id in pending_updates and not results.get(c.user_id)]
+    return failed, [f for writer, f in follow_ups if writer is None or results.get(writer)]
+
+def _as_retry(completion):
+    """
+    What to put back on the engine for a completion that was not committed. The engine holds one
+    completion per (kind, player) and a defender may be hit by several battles at once, so a failed
+    'defend' is retried as its attacker's 'attack', with the same battle seed.
+    """
+    if completion.kind != 'defend': return completion
+    return Completion('attack', completion.payload['attacker'], completion.due, {'target': completion.user_id, 'seed': completion.payload.get('seed')})
+
+def run_completions(bot, scheduler, executor, completions, partition=None):
+    """
+    The completion engine's resolver. The batch and then each wave of its follow-ups resolve
+    inline without an executor; with one, each shard resolves its own players' part so completions
+    are serialized with that player's Telegram updates. In a worker process (`partition`),
+    follow-ups for players of other workers are handed off to them. Returns the completions to
+    retry, follow-ups included.
+    """
+    failed = []
+    while completions:
+        if executor is None: batch_failed, completions = resolve_completions(bot, scheduler, completions)
+        else:
+            futures = [executor.submit_to_shard(shard, resolve_completions, bot, scheduler, batch)
+                       for shard, batch in executor.partition(completions, key=lambda c: c.user_id).items()]
+            batch_failed, completions = [], []
+            for future in futures:
+                wave_failed, follow_ups = future.result()
+                batch_failed += wave_failed; completions += follow_ups
+        failed += batch_failed
+        completions = _keep_local(completions, partition)
+    return failed
+
+def dispatch_completions(bot, scheduler, executor, completions, partition=None):
+    """Queues completions (e.g. handed off by another worker) on their players' shards without waiting for them; failures go back on the engine."""
+    for shard, batch in executor.partition(_keep_local(completions, partition), key=lambda c: c.user_id).items():
+        executor.submit_to_shard(shard, _resolve_on_shard, bot, scheduler, executor, batch, partition)
+
+def _keep_local(completions, partition):
+    """Hands off the completions owned by other workers; returns this process's own."""
+    if partition is None: return completions
+    local = []
+    for completion in completions:
+        if partition.owns(completion.user_id): local.append(completion)
+        else: partition.hand_off(completion)
+    return local
+
+def _resolve_on_shard(bot, scheduler, executor, completions, partition=None):
+    failed, follow_ups = resolve_completions(bot, scheduler, completions)
+    scheduler.retry(failed)
+    dispatch_completions(bot, scheduler, executor, follow_ups, partition)
+
+QUEUE_KINDS = ('upgrade', 'train', 'research', 'attack', 'return')
+
+def rehydrate_queues(scheduler, players=None, replace=False):
+    """
+    Restores every pending build/train/research/attack/return queue after a restart.
+    All players are fetched with one bulk read (or taken from `players`) and every queue is
+    re-armed on the engine; overdue ones are simply due immediately and resolve together in the first tick.
+    With `replace`, queues already armed for these players are cancelled first (e.g. after a reconcile).
+    """
+    armed = 0
+    for player in (storage.get_all_players() if players is None else players):
+        try: user_id = int(player.get(constants.FIELD_USER_ID))
+        except (TypeError, ValueError): continue
+        if replace:
+            for kind in QUEUE_KINDS: scheduler.cancel(kind, user_id)
+        pending = []
+        if (item := player.get('build_queue_item_id')) and item in constants.BUILDING_DATA:
+            pending.append(('upgrade', player.get('build_queue_finish_time'), {'building': item}))
+        if (item := player.get('train_queue_item_id')) and item in constants.UNIT_DATA:
+            pending.append(('train', player.get('train_queue_finish_time'), {'unit': item, 'quantity': int(player.get('train_queue_quantity') or 0)}))
+        if (item := player.get('research_queue_item_id')) and item in constants.RESEARCH_DATA:
+            pending.append(('research', player.get('research_queue_finish_time'), {'research': item}))
+        if target := player.get('attack_queue_target_id'):
+            pending.append(('attack', player.get('attack_queue_finish_time'), {'target': int(target)}))
+        if army := player.get('return_queue_army_data'):
+            pending.append(('return', player.get('return_queue_finish_time'), {'army': json.loads(army)}))
+        for kind, finish, payload in pending:
+            try: run_date = datetime.fromisoformat(finish)
+            except (TypeError, ValueError):
+                logger.warning(f"Skipping {kind} queue for user {user_id}: unreadable finish time {finish!r}."); continue
+            scheduler.schedule(kind, user_id, run_date, payload); armed += 1
+    logger.info(f"Queue rehydration: {armed} pending completions re-armed.")
+    return armed
 
 
 # --- SECTION 3: UI-GENERATING & CORE LOGIC FUNCTIONS ---
 
-def send_base_panel(bot, user_id, player_data):
-    base_panel_text = content.get_base_panel_text(player_data)
+def _rank_of(user_id):
+    rank = leaderboard.rank(user_id)
+    return (rank, leaderboard.size()) if rank else None
+
+def send_base_panel(bot, user_id, player_data, scheduler=None):
+    next_completion = scheduler.next_due(user_id) if scheduler else None
+    base_panel_text = content.get_base_panel_text(player_data, next_completion, _rank_of(user_id))
     markup = get_main_menu_keyboard()
     bot.send_message(user_id, base_panel_text, parse_mode='HTML', reply_markup=markup)
 
 def send_build_menu(bot, user_id):
-    _, player_data = google_sheets.find_player_row(user_id)
+    _, player_data = storage.find_player_row(user_id)
     if not player_data: return
     if build_item_id := player_data.get('build_queue_item_id'):
         finish_time = datetime.fromisoformat(player_data.get('build_queue_finish_time'))
         remaining = finish_time - datetime.now(timezone.utc)
         building_name = constants.BUILDING_DATA[build_item_id]['name']
         text = f"<b><u>⚒️ Construction Yard (Busy)</u></b>\n\nYour **{building_name}** is upgrading. Time left: {str(timedelta(seconds=int(remaining.total_seconds())))}."
-        markup = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
-    else:
-        text = "<b><u>⚒️ Construction Yard (Idle)</u></b>\nSelect a building to upgrade:\n"
-        markup = InlineKeyboardMarkup(row_width=1)
-        for key, info in constants.BUILDING_DATA.items():
-            level = int(player_data.get(info['id'], 0))
-            cost = calculate_cost(info['base_cost'], info['cost_multiplier'], level + 1)
-            cost_str = " | ".join([f"{v:,} {k.capitalize()}" for k, v in cost.items()])
-            text += f"\n{info['emoji']} <b>{info['name']}</b> (Level {level})"
-            markup.add(InlineKeyboardButton(f"Upgrade - Cost: {cost_str}", callback_data=f"build_{key}"))
-        markup.add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
+        markup = menus.back_to_base_markup()
+    else: text, markup = menus.render_build_menu(menus.building_levels(player_data))
     bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
 
 def send_train_menu(bot, user_id):
-    _, player_data = google_sheets.find_player_row(user_id)
+    _, player_data = storage.find_player_row(user_id)
     if not player_data: return
     if int(player_data.get('building_barracks_level', 0)) < 1:
         bot.send_message(user_id, "A 🪖 **Barracks** is required for training.", parse_mode="Markdown"); return
-    markup = InlineKeyboardMarkup(row_width=1)
     if train_item_id := player_data.get('train_queue_item_id'):
         finish_time, quantity = datetime.fromisoformat(player_data.get('train_queue_finish_time')), player_data.get('train_queue_quantity')
         remaining, unit_name = finish_time - datetime.now(timezone.utc), constants.UNIT_DATA[train_item_id]['name']
         text = f"<b><u>🪖 Barracks (Training)</u></b>\n\nTraining **{quantity}x {unit_name}**. Time left: {str(timedelta(seconds=int(remaining.total_seconds())))}."
-        markup.add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
-    else:
-        text = f"<b><u>🪖 Barracks (Idle)</u></b>\nSelect a unit to train:\n"
-        for key, info in constants.UNIT_DATA.items():
-            if int(player_data.get('building_barracks_level', 0)) >= info['required_barracks_level']:
-                cost_str = " | ".join([f"{v:,} {res.capitalize()}" for res, v in info['cost'].items()])
-                text += f"\n{info['emoji']} <b>{info['name']}</b> (ATK:{info['stats']['attack']}/DEF:{info['stats']['defense']})"
-                markup.add(InlineKeyboardButton(f"Train - {cost_str} / unit", callback_data=f"train_{key}"))
-        markup.add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
+        markup = menus.back_to_base_markup()
+    else: text, markup = menus.render_train_menu(int(player_data.get('building_barracks_level', 0)))
     bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
 
 def send_research_menu(bot, user_id):
-    _, player_data = google_sheets.find_player_row(user_id)
+    _, player_data = storage.find_player_row(user_id)
     if not player_data: return
     lab_level = int(player_data.get('building_research_lab_level', 0))
     if lab_level < 1:
         bot.send_message(user_id, "A 🔬 **Research Lab** is required.", parse_mode="Markdown"); return
-    markup = InlineKeyboardMarkup(row_width=1)
     if research_item_id := player_data.get('research_queue_item_id'):
         finish_time, research_name = datetime.fromisoformat(player_data.get('research_queue_finish_time')), constants.RESEARCH_DATA[research_item_id]['name']
         remaining = finish_time - datetime.now(timezone.utc)
         text = f"<b><u>🔬 Research Lab (In Progress)</u></b>\n\nResearching **{research_name}**. Time remaining: {str(timedelta(seconds=int(remaining.total_seconds())))}."
-        markup.add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
-    else:
-        text = f"<b><u>🔬 Research Lab (Idle)</u></b>\nSelect a technology to research:\n"
-        for key, info in constants.RESEARCH_DATA.items():
-            text += f"\n{info['emoji']} <b>{info['name']}</b>\n<i>{info['description']}</i>\n"
-            if player_data.get(info['id']) == 'TRUE': text += "<b>Status:</b> ✅ Researched\n"
-            elif lab_level < info['required_lab_level']: text += f"<b>Status:</b> 🔒 Locked (Req. Lab Lv. {info['required_lab_level']})\n"
-            else:
-                cost_str = " | ".join([f"{v:,} {k.capitalize()}" for k, v in info['cost'].items()])
-                research_time = timedelta(seconds=info['research_time_seconds'])
-                markup.add(InlineKeyboardButton(f"Begin Research ({cost_str} | {research_time})", callback_data=f"research_{key}"))
-        markup.add(InlineKeyboardButton("⬅️ Back to Base", callback_data='back_to_base'))
+        markup = menus.back_to_base_markup()
+    else: text, markup = menus.render_research_menu(lab_level, menus.unlocked_research(player_data))
     bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
 
-def send_alliance_menu(bot, user_id):
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data: return
-    if not (alliance_id := player_data.get('alliance_id')):
+def render_alliance_menu(user_id):
+    """(text, markup) of the Alliance screen: the player's alliance, or the create/join choice."""
+    markup = InlineKeyboardMarkup(row_width=1)
+    if not (alliance := alliances.get(alliances.alliance_of(user_id))):
         text = "You are a lone wolf, operating without the support of an alliance.\n\nForge your own destiny or join a cause greater than yourself."
-        markup = InlineKeyboardMarkup(row_width=1)
         create_cost = constants.ALLIANCE_CONFIG['create_cost']['diamonds']
-        markup.add(InlineKeyboardButton(f"Forge Alliance (Cost: {create_cost} 💎)", callback_data='alliance_create'))
-        markup.add(InlineKeyboardButton("Join an Alliance", callback_data='alliance_join'))
+        markup.add(InlineKeyboardButton(f"Forge Alliance (Cost: {create_cost} 💎)", callback_data=callbacks.encode('alliance_create')))
+        markup.add(InlineKeyboardButton("Join an Alliance", callback_data=callbacks.encode('alliance_browse')))
     else:
-        text = f"You are a member of an alliance (ID: {alliance_id}).\n\nDashboard coming soon!"
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton("Leave Alliance (Coming Soon)", callback_data='alliance_leave'))
+        members = alliances.members(alliance['alliance_id'])
+        leader = next((name for member_id, name, _ in members if member_id == alliance['leader_id']), 'Unknown')
+        text = (f"<b><u>🛡️ {alliance['alliance_name']} [{alliance['alliance_tag']}]</u></b>\n<i>{alliance['description']}</i>\n\n"
+                f"<b>Leader:</b> 👑 {leader}\n"
+                f"<b>Members:</b> 👥 {alliance['member_count']}/{constants.ALLIANCE_CONFIG['max_members']}  |  <b>Total Power:</b> 💪 {alliance['total_power']:,}\n"
+                f"────────────────────\n")
+        text += "\n".join(f"{i}. {name} — 💪 {power:,}" for i, (_, name, power) in enumerate(members[:10], start=1))
+        if len(members) > 10: text += f"\n… and {len(members) - 10} more"
+        markup.add(InlineKeyboardButton("Leave Alliance", callback_data=callbacks.encode('alliance_leave')))
+    return text, markup
+
+def send_alliance_menu(bot, user_id):
+    text, markup = render_alliance_menu(user_id)
     bot.send_message(user_id, text, reply_markup=markup, parse_mode='HTML')
 
-def send_attack_confirmation_menu(bot, user_id, attacker_data, defender_data):
+def render_alliance_browser():
+    markup = InlineKeyboardMarkup(row_width=1)
+    if open_alliances := alliances.open_alliances(limit=10):
+        text = "<b><u>👥 Alliances Recruiting</u></b>\nChoose an alliance to join:\n"
+        for alliance in open_alliances:
+            text += f"\n🛡️ <b>{alliance['alliance_name']} [{alliance['alliance_tag']}]</b> — 👥 {alliance['member_count']}/{constants.ALLIANCE_CONFIG['max_members']} | 💪 {alliance['total_power']:,}"
+            markup.add(InlineKeyboardButton(f"Join [{alliance['alliance_tag']}]", callback_data=callbacks.encode('alliance_join', alliance['alliance_id'])))
+    else: text = "No alliance is recruiting right now. Why not forge your own?"
+    markup.add(menus.back_button())
+    return text, markup
+
+def send_leaderboard(bot, user_id, alliance_only=False):
+    alliance_id = None
+    if alliance_only:
+        _, player_data = storage.find_player_row(user_id)
+        if not player_data or not (alliance_id := player_data.get('alliance_id')):
+            bot.send_message(user_id, "You are not in an alliance, so there is no alliance leaderboard to show."); return
+    title = "Alliance Leaderboard" if alliance_id else "Power Leaderboard"
+    text = content.get_leaderboard_text(title, leaderboard.top(10, alliance_id), user_id, leaderboard.neighbours(user_id, 2, alliance_id))
+    bot.send_message(user_id, text, parse_mode='HTML')
+
+def send_map_menu(bot, user_id):
+    targets = matchmaking.find_targets(user_id)
+    markup = InlineKeyboardMarkup(row_width=1)
+    if targets:
+        text = "<b><u>🌍 World Map</u></b>\nScouts report these unshielded bases within striking range:\n"
+        for target_id, name, power in targets:
+            text += f"\n🎯 <b>{name}</b> — 💪 {power:,}"
+            markup.add(InlineKeyboardButton(f"⚔️ Scout {name}", callback_data=callbacks.encode('target', target_id)))
+    else: text = "<b><u>🌍 World Map</u></b>\n\nScouts found no unshielded bases near your power. Try again later."
+    markup.add(menus.back_button())
+    bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
+
+def render_attack_confirmation(attacker_data, defender_data):
+    """(text, markup) asking to confirm an attack, or None if the attacker has no troops."""
     target_name, target_id = defender_data[constants.FIELD_COMMANDER_NAME], defender_data[constants.FIELD_USER_ID]
     army_comp, total_units = "", 0
     for key, unit in constants.UNIT_DATA.items():
         if count := int(attacker_data.get(unit['id'], 0)): army_comp += f"{count}x {unit['name']} {unit['emoji']}, "; total_units += count
-    if total_units == 0: bot.send_message(user_id, "You have no troops to attack with."); return
+    if total_units == 0: return None
     energy_cost, travel_time = constants.COMBAT_CONFIG['energy_cost_per_attack'], timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds'])
     text = f"<b><u>⚔️ Attack Confirmation</u></b>\n\n<b>Target:</b> {target_name}\n<b>Your Army:</b> {army_comp.strip(', ')}\n<b>Energy Cost:</b> {energy_cost} ⚡️\n<b>Travel Time:</b> {travel_time}\n\nLaunch attack?"
-    markup = InlineKeyboardMarkup(row_width=2).add(InlineKeyboardButton("✅ Launch", callback_data=f"confirm_attack_{target_id}"), InlineKeyboardButton("❌ Abort", callback_data='back_to_base'))
-    bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
+    markup = InlineKeyboardMarkup(row_width=2).add(InlineKeyboardButton("✅ Launch", callback_data=callbacks.encode('confirm_attack', target_id)), InlineKeyboardButton("❌ Abort", callback_data=callbacks.encode('back_to_base')))
+    return text, markup
 
-def handle_upgrade_request(bot, scheduler, user_id, building_key, message):
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data or player_data.get('build_queue_item_id'):
-        bot.answer_callback_query(message.id, "Your construction yard is already busy.", show_alert=True); return
+def send_attack_confirmation_menu(bot, user_id, attacker_data, defender_data):
+    if confirmation := render_attack_confirmation(attacker_data, defender_data): bot.send_message(user_id, confirmation[0], parse_mode='HTML', reply_markup=confirmation[1])
+    else: bot.send_message(user_id, "You have no troops to attack with.")
+
+def handle_upgrade_request(scheduler, user_id, building_key):
+    """Starts an upgrade from the Build menu; returns the callbacks.Response to the click."""
+    if building_key not in constants.BUILDING_DATA: return callbacks.EXPIRED
+    _, player = storage.find_player_record(user_id)
+    if not player: return callbacks.Response()
+    if player.build_queue_item_id: return callbacks.Response(toast="Your construction yard is already busy.", alert=True)
+    economy.settle(player)
     building_info = constants.BUILDING_DATA[building_key]
-    level = int(player_data.get(building_info['id'], 0))
-    cost = calculate_cost(building_info['base_cost'], building_info['cost_multiplier'], level + 1)
+    level = player.get(building_info['id'], 0)
+    cost = tables.building_cost(building_key, level + 1)
     for res, amount in cost.items():
-        if int(player_data.get(res, 0)) < amount:
-            bot.answer_callback_query(message.id, f"⚠️ Insufficient resources: You need {amount:,} {res.capitalize()}.", show_alert=True); return
-    new_resources = player_data.copy()
-    for res, amount in cost.items(): new_resources[res] = int(new_resources.get(res, 0)) - amount
-    construction_time = calculate_time(building_info['base_time_seconds'], building_info['time_multiplier'], level + 1)
+        if player.get(res, 0) < amount: return callbacks.Response(toast=f"⚠️ Insufficient resources: You need {amount:,} {res.capitalize()}.", alert=True)
+    for res, amount in cost.items(): setattr(player, res, player.get(res, 0) - amount)
+    construction_time = tables.building_time(building_key, level + 1)
     finish_time = datetime.now(timezone.utc) + timedelta(seconds=construction_time)
-    db_updates = {**new_resources, 'build_queue_item_id': building_key, 'build_queue_finish_time': finish_time.isoformat()}
-    if google_sheets.update_player_data(user_id, db_updates):
-        scheduler.add_job(complete_upgrade_job, 'date', run_date=finish_time, args=[bot, user_id, building_key], id=f'upgrade_{user_id}_{time.time()}')
-        bot.edit_message_text(f"✅ Upgrade started! Your **{building_info['name']}** will reach **Level {level + 1}** in {timedelta(seconds=construction_time)}.", chat_id=message.chat.id, message_id=message.message_id, parse_mode='HTML')
-    else: bot.edit_message_text("A critical database error occurred.", chat_id=message.chat.id, message_id=message.message_id)
+    player.build_queue_item_id, player.build_queue_finish_time = building_key, finish_time
+    if storage.update_player_data(user_id, player.changes()):
+        scheduler.schedule('upgrade', user_id, finish_time, {'building': building_key})
+        return callbacks.Response(f"✅ Upgrade started! Your <b>{building_info['name']}</b> will reach <b>Level {level + 1}</b> in {timedelta(seconds=construction_time)}.", parse_mode='HTML', toast="✅ Upgrade started!")
+    return callbacks.Response("A critical database error occurred.")
 
 def handle_train_quantity(bot, scheduler, unit_key, message):
     user_id = message.from_user.id
     try: quantity = int(message.text)
     except ValueError: bot.send_message(user_id, "Invalid quantity."); return
-    finally:
-        if user_id in user_state: del user_state[user_id]
+    finally: conversation.clear(user_id)
     if quantity <= 0: return
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data or player_data.get('train_queue_item_id'): return
+    _, player = storage.find_player_record(user_id)
+    if not player or player.train_queue_item_id: return
+    economy.settle(player)
     unit_info = constants.UNIT_DATA[unit_key]
     total_cost = {res: amount * quantity for res, amount in unit_info['cost'].items()}
     for res, amount in total_cost.items():
-        if int(player_data.get(res, 0)) < amount: bot.send_message(user_id, "⚠️ Insufficient resources."); return
+        if player.get(res, 0) < amount: bot.send_message(user_id, "⚠️ Insufficient resources."); return
     total_time = unit_info['train_time_seconds'] * quantity
     finish_time = datetime.now(timezone.utc) + timedelta(seconds=total_time)
-    new_res = {res: int(player_data.get(res, 0)) - amount for res, amount in total_cost.items()}
-    updates = {**new_res, 'train_queue_item_id': unit_key, 'train_queue_quantity': quantity, 'train_queue_finish_time': finish_time.isoformat()}
-    if google_sheets.update_player_data(user_id, updates):
-        scheduler.add_job(complete_training_job, 'date', run_date=finish_time, args=[bot, user_id, unit_key, quantity], id=f'train_{user_id}_{time.time()}')
+    for res, amount in total_cost.items(): setattr(player, res, player.get(res, 0) - amount)
+    player.train_queue_item_id, player.train_queue_quantity, player.train_queue_finish_time = unit_key, quantity, finish_time
+    if storage.update_player_data(user_id, player.changes()):
+        scheduler.schedule('train', user_id, finish_time, {'unit': unit_key, 'quantity': quantity})
         bot.send_message(user_id, f"✅ Training started! **{quantity}x {unit_info['name']}** {unit_info['emoji']} will be ready in {timedelta(seconds=total_time)}.")
 
-def handle_research_request(bot, scheduler, user_id, research_key, message):
-    _, player_data = google_sheets.find_player_row(user_id)
-    if not player_data or player_data.get('research_queue_item_id'): return
+def handle_research_request(scheduler, user_id, research_key):
+    """Starts research from the Research menu; returns the callbacks.Response to the click."""
+    if research_key not in constants.RESEARCH_DATA: return callbacks.EXPIRED
+    _, player = storage.find_player_record(user_id)
+    if not player: return callbacks.Response()
+    if player.research_queue_item_id: return callbacks.Response(toast="Your research lab is already busy.", alert=True)
     research_info = constants.RESEARCH_DATA[research_key]
-    if player_data.get(research_info['id']) == 'TRUE': return
-    if int(player_data.get('building_research_lab_level', 0)) < research_info['required_lab_level']: return
+    if player.get(research_info['id']): return callbacks.Response(toast="That technology is already researched.")
+    if player.get('building_research_lab_level', 0) < research_info['required_lab_level']: return callbacks.Response(toast=f"🔒 Requires Research Lab level {research_info['required_lab_level']}.", alert=True)
+    economy.settle(player)
     cost = research_info['cost']
     for res, amount in cost.items():
-        if int(player_data.get(res, 0)) < amount: bot.answer_callback_query(message.id, "⚠️ Insufficient resources.", show_alert=True); return
+        if player.get(res, 0) < amount: return callbacks.Response(toast="⚠️ Insufficient resources.", alert=True)
     finish_time = datetime.now(timezone.utc) + timedelta(seconds=research_info['research_time_seconds'])
-    new_res = {res: int(player_data.get(res, 0)) - amount for res, amount in cost.items()}
-    updates = { **new_res, 'research_queue_item_id': research_key, 'research_queue_finish_time': finish_time.isoformat() }
-    if google_sheets.update_player_data(user_id, updates):
-        scheduler.add_job(complete_research_job, 'date', run_date=finish_time, args=[bot, user_id, research_key], id=f'research_{user_id}_{time.time()}')
-        bot.edit_message_text(f"✅ Research started! **{research_info['name']}** will be developed in {timedelta(seconds=research_info['research_time_seconds'])}.", chat_id=message.chat.id, message_id=message.message_id, parse_mode='HTML')
-
-def handle_attack_launch(bot, scheduler, attacker_id, defender_id, message): pass # For brevity
+    for res, amount in cost.items(): setattr(player, res, player.get(res, 0) - amount)
+    player.research_queue_item_id, player.research_queue_finish_time = research_key, finish_time
+    if storage.update_player_data(user_id, player.changes()):
+        scheduler.schedule('research', user_id, finish_time, {'research': research_key})
+        return callbacks.Response(f"✅ Research started! <b>{research_info['name']}</b> will be developed in {timedelta(seconds=research_info['research_time_seconds'])}.", parse_mode='HTML', toast="✅ Research started!")
+    return callbacks.Response("A critical database error occurred.")
+
+def handle_attack_launch(scheduler, attacker_id, defender_id):
+    """Launches a confirmed attack; returns the callbacks.Response to the click."""
+    _, attacker_data = storage.find_player_row(attacker_id); _, defender_data = storage.find_player_row(defender_id)
+    if not attacker_data or not defender_data or attacker_id == defender_id: return callbacks.Response(toast="That target is no longer available.", alert=True)
+    if attacker_data.get('attack_queue_target_id') or attacker_data.get('return_queue_finish_time'):
+        return callbacks.Response(toast="Your army is already deployed.", alert=True)
+    now = datetime.now(timezone.utc)
+    if (shield := defender_data.get('shield_finish_time')) and datetime.fromisoformat(shield) > now:
+        return callbacks.Response(toast="🛡️ That base is protected by a shield.", alert=True)
+    energy_cost = constants.COMBAT_CONFIG['energy_cost_per_attack']
+    if int(attacker_data.get('energy', 0)) < energy_cost:
+        return callbacks.Response(toast=f"⚠️ Not enough energy: {energy_cost} ⚡️ required.", alert=True)
+    finish_time = now + timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds'])
+    updates = {'energy': int(attacker_data.get('energy', 0)) - energy_cost, 'attack_queue_target_id': defender_id, 'attack_queue_finish_time': finish_time.isoformat()}
+    if storage.update_player_data(attacker_id, updates):
+        scheduler.schedule('attack', attacker_id, finish_time, {'target': defender_id})
+        return callbacks.Response(f"⚔️ Your army is marching on <b>{defender_data[constants.FIELD_COMMANDER_NAME]}</b>. Battle in {timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds'])}.", parse_mode='HTML', toast="⚔️ Attack launched!")
+    return callbacks.Response("A critical database error occurred.")
 def handle_alliance_create_get_name(bot, message):
     user_id, name = message.from_user.id, message.text.strip()
     max_len = constants.ALLIANCE_CONFIG['name_max_length']
     if not (3 <= len(name) <= max_len):
-        bot.send_message(user_id, f"Alliance name must be 3-{max_len} characters."); user_state[user_id] = partial(handle_alliance_create_get_name, bot); return
+        bot.send_message(user_id, f"Alliance name must be 3-{max_len} characters."); conversation.start(user_id, 'alliance_create', 'name'); return
     bot.send_message(user_id, f"An excellent name. Now, what is your alliance tag? (e.g., a 2-5 character abbreviation like 'STARS')")
-    user_state[user_id] = partial(handle_alliance_create_get_tag, bot, name)
+    conversation.start(user_id, 'alliance_create', 'tag', {'name': name})
 def handle_alliance_create_get_tag(bot, name, message):
     user_id, tag = message.from_user.id, message.text.strip().upper()
-    if user_id in user_state: del user_state[user_id]
+    conversation.clear(user_id)
     max_len = constants.ALLIANCE_CONFIG['tag_max_length']
     if not (2 <= len(tag) <= max_len):
         bot.send_message(user_id, f"Alliance tag must be 2-{max_len} characters. Creation aborted."); return
-    _, player_data = google_sheets.find_player_row(user_id)
+    _, player_data = storage.find_player_row(user_id)
     cost = constants.ALLIANCE_CONFIG['create_cost']['diamonds']
     if int(player_data.get('diamonds', 0)) < cost:
         bot.send_message(user_id, f"You do not have the required {cost} 💎 to form an alliance. Creation aborted."); return
-    alliance_id = str(uuid.uuid4())
-    alliance_data = {'alliance_id': alliance_id, 'alliance_name': name, 'alliance_tag': tag, 'leader_id': user_id, 'member_ids': json.dumps([user_id]), 'description': 'A new alliance, ready to make its mark!'}
-    if google_sheets.create_alliance(alliance_data):
-        player_updates = {'alliance_id': alliance_id, 'diamonds': int(player_data.get('diamonds', 0)) - cost}
-        google_sheets.update_player_data(user_id, player_updates)
+    alliance_id, error = alliances.create(user_id, name, tag, 'A new alliance, ready to make its mark!', {'diamonds': int(player_data.get('diamonds', 0)) - cost})
+    if alliance_id:
         bot.send_message(user_id, f"✅ Alliance **'{name}' [{tag}]** has been formed! You are its first leader.")
         send_alliance_menu(bot, user_id)
-    else: bot.send_message(user_id, "A critical error occurred while forming your alliance.")
+    else: bot.send_message(user_id, f"{error} Creation aborted.")
 
 # --- SECTION 4: MAIN HANDLER REGISTRATION ---
-def register_handlers(bot, scheduler):
-    
-    @bot.message_handler(commands=['start'])
+def register_handlers(bot, scheduler, executor=None, router=None, partition=None):
+    """
+    `bot` makes the API calls; `router` (default: the same bot) receives the handler registrations.
+    `partition` is set in a worker process (see workers.py): battle steps of other workers' players go to them.
+    """
+    router = router or bot
+    scheduler.resolver = metrics.timed(metrics.JOB_SECONDS, 'completions', partial(run_completions, bot, scheduler, executor, partition=partition))
+
+    def answer_throttled(handler):
+        """Tells the player to retry when Sheets is over quota, instead of reporting their data as missing."""
+        @wraps(handler)
+        def run(update):
+            try: return handler(update)
+            except SheetsThrottled as e:
+                logger.warning("Update from user %s dropped, Sheets throttled: %s", update.from_user.id, e)
+                bot.send_message(update.from_user.id, content.get_throttled_text())
+        return run
+
+    def per_user(handler):
+        """Runs the handler on the sender's shard so their updates are processed strictly in order."""
+        handler = metrics.timed(metrics.HANDLER_SECONDS, handler.__name__, answer_throttled(handler))
+        @wraps(handler)
+        def dispatch(update):
+            if executor is None: return handler(update)
+            executor.submit(update.from_user.id, handler, update)
+        return dispatch
+
+    @router.message_handler(commands=['start'])
+    @per_user
     def start_command_handler(message: Message):
         user_id = message.from_user.id
-        _, player_data = google_sheets.find_player_row(user_id)
-        if player_data: send_base_panel(bot, user_id, player_data)
+        _, player_data = storage.find_player_record(user_id)
+        if player_data: send_base_panel(bot, user_id, player_data, scheduler)
         else:
             bot.send_message(user_id, content.get_welcome_new_player_text(), parse_mode='HTML')
-            user_state[user_id] = partial(get_commander_name_handler, bot)
+            conversation.start(user_id, 'register', 'name')
+
+    @router.message_handler(commands=['attack'])
+    @per_user
+    def attack_command_handler(message: Message):
+        user_id, target_name = message.from_user.id, message.text.partition(' ')[2].strip()
+        if not target_name: bot.send_message(user_id, "To attack, use: `/attack CommanderName`", parse_mode='Markdown'); return
+        _, attacker_data = storage.find_player_row(user_id)
+        if not attacker_data: return
+        _, defender_data = storage.find_player_by_name(target_name)
+        if not defender_data:
+            suggestions = [name for name, _ in storage.find_players_by_name_prefix(target_name, limit=5)]
+            hint = f"\nDid you mean: {', '.join(suggestions)}?" if suggestions else ""
+            bot.send_message(user_id, f"No commander named '{target_name}' was found.{hint}"); return
+        if defender_data[constants.FIELD_USER_ID] == str(user_id): bot.send_message(user_id, "You cannot attack your own base."); return
+        send_attack_confirmation_menu(bot, user_id, attacker_data, defender_data)
+
+    @router.message_handler(commands=['leaderboard'])
+    @per_user
+    def leaderboard_command_handler(message: Message):
+        send_leaderboard(bot, message.from_user.id, alliance_only=message.text.partition(' ')[2].strip().lower() == 'alliance')
 
     def get_commander_name_handler(bot, message: Message):
         user_id, name = message.from_user.id, message.text.strip()
-        if user_id in user_state: del user_state[user_id]
+        conversation.clear(user_id)
         if not (3 <= len(name) <= 20): bot.send_message(user_id, "Name must be 3-20 characters."); return
+        if storage.is_commander_name_taken(name):
+            bot.send_message(user_id, f"The designation **{name}** is already taken. Please choose another name.", parse_mode='Markdown')
+            conversation.start(user_id, 'register', 'name'); return
         new_player_data = {**constants.INITIAL_PLAYER_STATS, constants.FIELD_USER_ID: user_id, constants.FIELD_COMMANDER_NAME: name}
-        if google_sheets.create_player_row(new_player_data):
+        if storage.create_player_row(new_player_data):
             bot.send_message(user_id, content.get_new_player_welcome_success_text(name), parse_mode='HTML')
             # Pass the newly created data, which includes the calculated shield time
-            send_base_panel(bot, user_id, google_sheets.find_player_row(user_id)[1])
+            send_base_panel(bot, user_id, storage.find_player_record(user_id)[1], scheduler)
         else: bot.send_message(user_id, "A critical error occurred.")
 
-    @bot.callback_query_handler(func=lambda call: True)
+    @router.callback_query_handler(func=lambda call: True)
+    @per_user
     def handle_callback_query(call):
-        user_id, action = call.from_user.id, call.data
-        logger.info(f"User {user_id} clicked inline button: {action}")
-        bot.answer_callback_query(call.id)
-        
-        parts = action.split('_'); command = parts[0]; key = '_'.join(parts[1:])
-        
-        # Don't remove the keyboard if we are expecting a text response
-        if not (command == 'train' or (command == 'alliance' and key == 'create')):
-            try: bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=None)
-            except Exception as e: logger.warning(f"Could not edit message markup: {e}")
-
-        if command == 'build': handle_upgrade_request(bot, scheduler, user_id, key, call.message)
-        elif command == 'train':
-            bot.edit_message_text("How many units would you like to train?", chat_id=call.message.chat.id, message_id=call.message.message_id)
-            user_state[user_id] = partial(handle_train_quantity, bot, scheduler, key)
-        elif command == 'research': handle_research_request(bot, scheduler, user_id, key, call.message)
-        elif command == 'alliance':
-            if key == 'create':
-                bot.edit_message_text("You have chosen to forge a new alliance. What will it be named?", chat_id=call.message.chat.id, message_id=call.message.message_id)
-                user_state[user_id] = partial(handle_alliance_create_get_name, bot)
-            else: bot.send_message(user_id, "This alliance feature is coming soon.")
-        elif command == 'confirm' and parts[1] == 'attack': handle_attack_launch(bot, scheduler, user_id, int(parts[2]), call.message)
-        elif command == 'back' and key == 'to_base':
-            _, pd = google_sheets.find_player_row(user_id)
-            if pd: bot.edit_message_text(content.get_base_panel_text(pd), call.message.chat.id, call.message.message_id, parse_mode='HTML')
-
-    @bot.message_handler(func=lambda message: True)
+        logger.info("User %s clicked inline button: %s", call.from_user.id, call.data)
+        callback_routes.handle(call)
+
+    # Inline buttons: each route returns the Response (one combined edit and the answer's toast) to its click.
+    callback_routes = callbacks.CallbackRouter(bot)
+
+    @callback_routes.route('build', str)
+    def build_route(call, building_key): return handle_upgrade_request(scheduler, call.from_user.id, building_key)
+
+    @callback_routes.route('research', str)
+    def research_route(call, research_key): return handle_research_request(scheduler, call.from_user.id, research_key)
+
+    @callback_routes.route('train', str)
+    def train_route(call, unit_key):
+        if unit_key not in constants.UNIT_DATA: return callbacks.EXPIRED
+        conversation.start(call.from_user.id, 'train', 'quantity', {'unit_key': unit_key})
+        return callbacks.Response("How many units would you like to train?")
+
+    @callback_routes.route('alliance_create')
+    def alliance_create_route(call):
+        conversation.start(call.from_user.id, 'alliance_create', 'name')
+        return callbacks.Response("You have chosen to forge a new alliance. What will it be named?")
+
+    @callback_routes.route('alliance_browse')
+    def alliance_browse_route(call): return callbacks.Response(*render_alliance_browser(), parse_mode='HTML')
+
+    @callback_routes.route('alliance_join', str)
+    def alliance_join_route(call, alliance_id):
+        joined, error = alliances.join(call.from_user.id, alliance_id)
+        if not joined: return callbacks.Response(toast=f"⚠️ {error}", alert=True)
+        return callbacks.Response(*render_alliance_menu(call.from_user.id), parse_mode='HTML', toast="🛡️ Welcome to the alliance!")
+
+    @callback_routes.route('alliance_leave')
+    def alliance_leave_route(call):
+        left, error = alliances.leave(call.from_user.id)
+        if not left: return callbacks.Response(toast=f"⚠️ {error}", alert=True)
+        return callbacks.Response(*render_alliance_menu(call.from_user.id), parse_mode='HTML', toast="You have left your alliance.")
+
+    @callback_routes.route('target', int)
+    def target_route(call, target_id):
+        user_id = call.from_user.id
+        _, attacker_data = storage.find_player_row(user_id); _, defender_data = storage.find_player_row(target_id)
+        if not attacker_data or not defender_data or target_id == user_id: return callbacks.Response(toast="That target is no longer available.", alert=True)
+        if not (confirmation := render_attack_confirmation(attacker_data, defender_data)): return callbacks.Response(toast="You have no troops to attack with.", alert=True)
+        return callbacks.Response(*confirmation, parse_mode='HTML')
+
+    @callback_routes.route('confirm_attack', int)
+    def confirm_attack_route(call, target_id): return handle_attack_launch(scheduler, call.from_user.id, target_id)
+
+    @callback_routes.route('back_to_base')
+    def back_to_base_route(call):
+        _, pd = storage.find_player_record(call.from_user.id)
+        if not pd: return callbacks.Response()
+        return callbacks.Response(content.get_base_panel_text(pd, scheduler.next_due(call.from_user.id), _rank_of(call.from_user.id)), parse_mode='HTML')
+
+    # Conversation records name their step; these are the handlers, called with the record's params.
+    flow_steps = {
+        ('register', 'name'): partial(get_commander_name_handler, bot),
+        ('train', 'quantity'): partial(handle_train_quantity, bot, scheduler),
+        ('alliance_create', 'name'): partial(handle_alliance_create_get_name, bot),
+        ('alliance_create', 'tag'): partial(handle_alliance_create_get_tag, bot),
+    }
+
+    @router.message_handler(func=lambda message: True)
+    @per_user
     def default_message_handler(message: Message):
-        if message.from_user.id in user_state:
-            user_state[message.from_user.id](message=message)
+        state = conversation.get(message.from_user.id)
+        step = flow_steps.get((state.flow, state.step)) if state else None
+        if step: step(message=message, **state.params)
         else:
+            if state:
+                logger.warning("Dropping unknown conversation step %s/%s for user %s.", state.flow, state.step, message.from_user.id)
+                conversation.clear(message.from_user.id)
             handle_menu_buttons(bot, message)
 
     def handle_menu_buttons(bot, message: Message):
-        if message.text == constants.MENU_BASE: _, pd = google_sheets.find_player_row(message.from_user.id); send_base_panel(bot, message.from_user.id, pd) if pd else None
+        if message.text == constants.MENU_BASE: _, pd = storage.find_player_record(message.from_user.id); send_base_panel(bot, message.from_user.id, pd, scheduler) if pd else None
         elif message.text == constants.MENU_BUILD: send_build_menu(bot, message.from_user.id)
         elif message.text == constants.MENU_TRAIN: send_train_menu(bot, message.from_user.id)
         elif message.text == constants.MENU_RESEARCH: send_research_menu(bot, message.from_user.id)
         elif message.text == constants.MENU_ALLIANCE: send_alliance_menu(bot, message.from_user.id)
+        elif message.text == constants.MENU_MAP: send_map_menu(bot, message.from_user.id)
         elif message.text == constants.MENU_ATTACK: bot.send_message(message.chat.id, "To attack, use: `/attack CommanderName`")
         else: bot.send_message(message.chat.id, f"The **{message.text}** system is not yet online.", parse_mode='Markdown')
\ No newline at end of file
@@ -0,0 +1,123 @@
+# leaderboard.py
+# Power ranking kept up to date incrementally from storage writes, so /leaderboard and the
+# base panel's rank never need a bulk read and sort.
+
+import threading
+from bisect import bisect_left, insort
+
+import constants
+
+class _Board:
+    """One ranking: a list of (-power, user_id) kept sorted, so rank is a bisect."""
+
+    def __init__(self):
+        self.entries = []
+
+    def insert(self, user_id: str, power: int): insort(self.entries, (-power, user_id))
+
+    def remove(self, user_id: str, power: int):
+        i = bisect_left(self.entries, (-power, user_id))
+        if i < len(self.entries) and self.entries[i] == (-power, user_id): del self.entries[i]
+
+    def index_of(self, user_id: str, power: int):
+        i = bisect_left(self.entries, (-power, user_id))
+        return i if i < len(self.entries) and self.entries[i] == (-power, user_id) else None
+
+class Leaderboard:
+    """
+    Ranks players by power, highest first (ties broken by user_id), globally and per alliance.
+    Ranks are 1-based. Every query returns (rank, user_id, commander_name, power) tuples.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._global = _Board()
+        self._alliances = {}  # alliance_id -> _Board
+        self._players = {}  # user_id -> [power, commander_name, alliance_id]
+
+    def load(self, records):
+        """Rebuilds from full player records; each ranking is sorted once instead of filled by insort."""
+        players = {}
+        for record in records:
+            user_id = record.get(constants.FIELD_USER_ID)
+            if user_id in (None, ''): continue
+            try: power = int(record.get('power') or 0)
+            except (TypeError, ValueError): power = 0
+            players[str(user_id)] = [power, record.get(constants.FIELD_COMMANDER_NAME, ''), record.get('alliance_id') or '']
+        boards, alliance_boards = _Board(), {}
+        for user_id, (power, _, alliance_id) in players.items():
+            boards.entries.append((-power, user_id))
+            if alliance_id: alliance_boards.setdefault(alliance_id, _Board()).entries.append((-power, user_id))
+        for board in (boards, *alliance_boards.values()): board.entries.sort()
+        with self._lock: self._global, self._alliances, self._players = boards, alliance_boards, players
+
+    def observe(self, user_id, changes: dict):
+        """Applies a committed player write; fields other than power, name and alliance are ignored."""
+        if user_id in (None, '') or not ({'power', constants.FIELD_COMMANDER_NAME, 'alliance_id'} & changes.keys()): return
+        user_id = str(user_id)
+        with self._lock:
+            current = self._players.get(user_id)
+            if current is None:
+                try: power = int(changes.get('power') or 0)
+                except (TypeError, ValueError): power = 0
+                current = self._players[user_id] = [power, changes.get(constants.FIELD_COMMANDER_NAME, ''), changes.get('alliance_id') or '']
+                self._insert(user_id, *current)
+                return
+            power, name, alliance_id = current
+            try: new_power = int(changes['power']) if 'power' in changes else power
+            except (TypeError, ValueError): new_power = power
+            new_alliance = (changes.get('alliance_id') or '') if 'alliance_id' in changes else alliance_id
+            current[1] = changes.get(constants.FIELD_COMMANDER_NAME, name)
+            if (new_power, new_alliance) != (power, alliance_id):
+                self._remove(user_id, power, alliance_id)
+                current[0], current[2] = new_power, new_alliance
+                self._insert(user_id, new_power, current[1], new_alliance)
+
+    def _insert(self, user_id, power, name, alliance_id):
+        self._global.insert(user_id, power)
+        if alliance_id: self._alliances.setdefault(alliance_id, _Board()).insert(user_id, power)
+
+    def _remove(self, user_id, power, alliance_id):
+        self._global.remove(user_id, power)
+        if alliance_id and (board := self._alliances.get(alliance_id)):
+            board.remove(user_id, power)
+            if not board.entries: del self._alliances[alliance_id]
+
+    def _board(self, alliance_id):
+        return self._alliances.get(alliance_id, _Board()) if alliance_id else self._global
+
+    def _row(self, index, entry):
+        power, user_id = -entry[0], entry[1]
+        return index + 1, user_id, self._players[user_id][1], power
+
+    def size(self, alliance_id=None) -> int:
+        with self._lock: return len(self._board(alliance_id).entries)
+
+    def top(self, k=10, alliance_id=None) -> list:
+        with self._lock:
+            return [self._row(i, entry) for i, entry in enumerate(self._board(alliance_id).entries[:k])]
+
+    def rank(self, user_id, alliance_id=None):
+        """1-based rank of a player, or None if they are not ranked (on that alliance's board)."""
+        with self._lock:
+            if (current := self._players.get(str(user_id))) is None: return None
+            index = self._board(alliance_id).index_of(str(user_id), current[0])
+            return None if index is None else index + 1
+
+    def neighbours(self, user_id, radius=2, alliance_id=None) -> list:
+        """The player's row with up to `radius` rows above and below it."""
+        with self._lock:
+            if (rank := self.rank(user_id, alliance_id)) is None: return []
+            entries = self._board(alliance_id).entries
+            start = max(0, rank - 1 - radius)
+            return [self._row(i, entries[i]) for i in range(start, min(len(entries), rank + radius))]
+
+_leaderboard = Leaderboard()
+
+def get_leaderboard() -> Leaderboard: return _leaderboard
+def load(records): _leaderboard.load(records)
+def observe(user_id, changes: dict): _leaderboard.observe(user_id, changes)
+def size(alliance_id=None): return _leaderboard.size(alliance_id)
+def top(k=10, alliance_id=None): return _leaderboard.top(k, alliance_id)
+def rank(user_id, alliance_id=None): return _leaderboard.rank(user_id, alliance_id)
+def neighbours(user_id, radius=2, alliance_id=None): return _leaderboard.neighbours(user_id, radius, alliance_id)
@@ -2,14 +2,28 @@
 # Definitive Version: Performs a health check on both Players and Alliances worksheets.
 
 import os
+import atexit
 import telebot
 import logging
 import time
+import threading
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
 
 import handlers
 import google_sheets
+import storage
+import alliances
+import leaderboard
+import matchmaking
+import menus
+import battle
+import conversation
+import metrics
+import snapshot
+from completion_engine import CompletionEngine
+from executor import ShardedExecutor
+from outbox import DispatchingBot, OutboundDispatcher
+import constants
 
 # --- 1. Master Configuration & Initialization ---
 load_dotenv()
@@ -27,34 +41,170 @@ if not BOT_TOKEN:
     logger.critical("FATAL ERROR: BOT_TOKEN is missing.")
     exit(1)
 
+# BOT_WORKERS=N (N > 1) runs the handlers in N processes partitioned by user_id (see workers.py). This
+# process then only receives and routes updates, so none of the per-process setup below applies to it.
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS') or 1)
+if BOT_WORKERS > 1:
+    import workers
+    try: workers.run(BOT_TOKEN, BOT_WORKERS)
+    except ValueError as e:
+        logger.critical(f"FATAL ERROR: {e}")
+        exit(1)
+    exit(0)
+
+# Instrumentation must be on before the worksheets are opened and the handlers registered, so they get wrapped.
+METRICS_PORT = os.environ.get('METRICS_PORT')
+if METRICS_PORT:
+    metrics.enable(slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS') or 0),
+                   profile_interval_ms=constants.METRICS_CONFIG['profile_interval_ms'], keep_slow=constants.METRICS_CONFIG['slow_requests_kept'])
+
+# With the Sheets backend, state is snapshotted to SNAPSHOT_PATH; a usable snapshot replaces the startup sheet reads.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets')
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', constants.SNAPSHOT_CONFIG['path']) if STORAGE_BACKEND == 'sheets' else ''
+cold_start = snapshot.load(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+
 try:
-    logger.info("Performing comprehensive Google Sheets connection health check...")
-    # This block now calls the new, specific functions.
-    google_sheets.get_players_worksheet()
-    google_sheets.get_alliances_worksheet()
-    logger.info("All Google Sheets connections VERIFIED.")
+    if cold_start:
+        logger.info(f"Cold start from {'clean' if cold_start.clean else 'periodic'} snapshot of {cold_start.created_at.isoformat()}; Google Sheets is verified in the background.")
+    else:
+        logger.info("Performing comprehensive Google Sheets connection health check...")
+        # This block now calls the new, specific functions.
+        google_sheets.get_players_worksheet()
+        google_sheets.get_alliances_worksheet()
+        logger.info("All Google Sheets connections VERIFIED.")
+    if os.environ.get('SHEETS_WRITE_BEHIND') == '1':
+        google_sheets.enable_write_behind()
+        atexit.register(google_sheets.flush_writes)
+        logger.info("Sheets write-behind batching ENABLED.")
+    # STORAGE_BACKEND=sqlite serves the hot path from SQLITE_PATH and mirrors writes to the sheets.
+    storage.configure(STORAGE_BACKEND, sqlite_path=os.environ.get('SQLITE_PATH', 'skyhustle.db'))
+    atexit.register(storage.close)
+    # CONVERSATION_DB shares pending chat steps between bot processes through a SQLite file; by default they stay in memory.
+    conversation.configure(os.environ.get('CONVERSATION_DB'))
+    atexit.register(conversation.close)
 except Exception as e:
     logger.critical(f"FATAL ERROR: Could not establish connection with Google Sheets at startup. Halting. Error: {e}")
     exit(1)
 
 # --- 3. System Assembly & Launch ---
-bot = telebot.TeleBot(BOT_TOKEN)
+scheduler = CompletionEngine(tick_seconds=1.0)
+executor = ShardedExecutor(num_shards=constants.EXECUTOR_SHARDS)
+
+# Build/train/research/attack/return queues live in the player rows; re-arm them before taking traffic.
+if cold_start:
+    google_sheets.prime_from_snapshot(cold_start)
+    # Only the columns the indexes use are decoded. Queues are armed from a clean snapshot only: after an
+    # unclean stop some may already have completed, so those wait for the reconcile to read the sheet.
+    players = cold_start.records('players', constants.SNAPSHOT_CONFIG['index_fields'])
+    alliance_records = cold_start.records('alliances')
+    if cold_start.clean:
+        queue_fields = [field for field in cold_start.headers('players') if '_queue_' in field]
+        handlers.rehydrate_queues(scheduler, cold_start.records('players', [constants.FIELD_USER_ID] + queue_fields, cold_start.nonempty('players', queue_fields)))
+else:
+    players = storage.get_all_players()
+    alliance_records = storage.get_all_alliances()
+    handlers.rehydrate_queues(scheduler, players)
+# The power leaderboard, the Map's target index and the alliance index are built once here and then kept current from storage writes.
+leaderboard.load(players)
+matchmaking.load(players)
+alliances.load(alliance_records, players)
+storage.add_listener(leaderboard.observe)
+storage.add_listener(matchmaking.observe)
+storage.add_listener(alliances.observe)
+del players, alliance_records
+
+def _reconcile_in_background(snap):
+    """Verifies the Sheets connection and reconciles snapshot state with the sheet, retrying until it succeeds."""
+    delay = 5
+    while True:
+        try:
+            google_sheets.get_players_worksheet()
+            google_sheets.get_alliances_worksheet()
+            records, changes = storage.reconcile_with_snapshot(snap)
+            if snap.clean: handlers.rehydrate_queues(scheduler, [record for record in records if record.get(constants.FIELD_USER_ID) in changes], replace=True)
+            else: handlers.rehydrate_queues(scheduler, records)
+            sheet_alliances = storage.get_all_alliances()
+            if [{k: v for k, v in a.items() if v} for a in sheet_alliances] != snap.records('alliances'): alliances.load(sheet_alliances, records)
+            logger.info(f"Snapshot reconciled with Google Sheets: {len(changes)} of {len(records)} players differed.")
+            return
+        except Exception as e:
+            logger.error(f"Snapshot reconcile failed ({e}); retrying in {delay}s.")
+            time.sleep(delay); delay = min(delay * 2, 60)
+
+if cold_start:
+    threading.Thread(target=_reconcile_in_background, args=(cold_start,), name='snapshot-reconcile', daemon=True).start()
+if SNAPSHOT_PATH:
+    # Registered before the executor and engine stop hooks, so (atexit being LIFO) the clean snapshot is taken after the last write.
+    snapshots = snapshot.SnapshotWriter(SNAPSHOT_PATH, google_sheets.snapshot_tables, constants.SNAPSHOT_CONFIG['interval_seconds'])
+    snapshots.start()
+    atexit.register(snapshots.stop)
+# Likewise the outbox (created below) drains only after the executor and engine have queued their last Telegram calls.
+outbox = None
+def _drain_outbox():
+    if outbox: outbox.shutdown()
+atexit.register(_drain_outbox)
+atexit.register(executor.shutdown)
+atexit.register(scheduler.stop)
+
+def _memo_cache_counts():
+    counts = {name: (info['hits'], info['misses']) for name, info in menus.cache_info().items()}
+    counts['unit_stats'] = tuple(battle.unit_stats.cache_info())[:2]
+    return {(name, result): value for name, pair in counts.items() for result, value in zip(('hit', 'miss'), pair)}
+
+if METRICS_PORT:
+    metrics.register_collector('skyhustle_scheduler_pending', 'Queue completions waiting in the completion engine.', scheduler.pending_count)
+    metrics.register_collector('skyhustle_scheduler_overdue_seconds', 'How far the earliest pending completion is past due (0 if none is).',
+                               lambda: max(0.0, -(scheduler.seconds_until_next_due() or 0.0)))
+    metrics.register_collector('skyhustle_executor_queue_depth', 'Tasks queued per executor shard.', lambda: {stats['shard']: stats['depth'] for stats in executor.stats()}, labels=('shard',))
+    metrics.register_collector('skyhustle_conversations_active', 'Players in the middle of a multi-step conversation.', conversation.size)
+    metrics.register_collector('skyhustle_player_cache_size', 'Players in the Sheets cache (indexed rows and full records).', google_sheets.cache_size, labels=('kind',))
+    metrics.register_collector('skyhustle_sheets_pending_writes', 'Cells buffered by write-behind, not yet flushed.', google_sheets.pending_writes)
+    metrics.register_collector('skyhustle_sheets_mirror_backlog', 'SQLite writes not yet mirrored to the sheets.', storage.replication_backlog)
+    metrics.register_collector('skyhustle_memo_cache_requests_total', 'Memoized menu/unit-stat lookups by cache and result.', _memo_cache_counts, labels=('cache', 'result'), kind='counter')
+    metrics.MetricsServer(constants.METRICS_CONFIG['host'], int(METRICS_PORT)).start()
+
+if os.environ.get('BOT_RUNTIME') == 'asyncio':
+    import async_runtime
+    logger.info("SkyHustle is fully operational. Starting asyncio runtime...")
+    async_runtime.run(BOT_TOKEN, scheduler, executor)
+    exit(0)
+
+# Updates are handed straight to the per-user shards, so the polling thread does no handler work itself.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 logger.info("Telegram Bot API initialized.")
 
-scheduler = BackgroundScheduler(timezone="UTC")
+# Handlers talk to Telegram through the outbox, which paces calls to Telegram's per-chat and global limits.
+outbox = OutboundDispatcher(metrics.instrument_api('telegram', bot), **constants.OUTBOX_CONFIG)
+metrics.register_collector('skyhustle_outbox_depth', 'Telegram API calls waiting in the outbox.', outbox.depth)
+handlers.register_handlers(DispatchingBot(bot, outbox), scheduler, executor, router=bot)
+logger.info("All system handlers have been registered.")
 scheduler.start()
-logger.info("APScheduler engine started in background.")
 
-handlers.register_handlers(bot, scheduler)
-logger.info("All system handlers have been registered.")
 
+# --- 4. LAUNCH SEQUENCE ---
+if os.environ.get('BOT_MODE') == 'webhook':
+    # Telegram pushes updates to WEBHOOK_URL; no polling round trips and no restart gap.
+    from webhook_server import WebhookServer
+    webhook_secret = os.environ.get('WEBHOOK_SECRET')
+    if not webhook_secret or not os.environ.get('WEBHOOK_URL'):
+        logger.critical("FATAL ERROR: BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET.")
+        exit(1)
+    server = WebhookServer(bot, webhook_secret, host=os.environ.get('WEBHOOK_HOST', '0.0.0.0'), port=int(os.environ.get('WEBHOOK_PORT', '8443')), path=os.environ.get('WEBHOOK_PATH', '/telegram'))
+    bot.remove_webhook()
+    bot.set_webhook(url=os.environ['WEBHOOK_URL'], secret_token=webhook_secret)
+    logger.info("SkyHustle is fully operational. Receiving updates via webhook...")
+    server.serve_forever()
+    exit(0)
 
-# --- 4. LAUNCH SEQUENCE (Resilient Loop) ---
 logger.info("SkyHustle is fully operational. Starting resilient bot polling...")
+restart_delay = 1
 while True:
+    started = time.monotonic()
     try:
         bot.polling(none_stop=True, interval=0, timeout=40)
     except Exception as e:
         logger.error(f"CRITICAL: Bot polling loop crashed with error: {e}")
-        logger.info("Network anomaly detected. Attempting to restart in 15 seconds...")
-        time.sleep(15)
\ No newline at end of file
+        # Back off exponentially on repeated crashes, but restart almost immediately after a long healthy run.
+        restart_delay = 1 if time.monotonic() - started > 60 else min(restart_delay * 2, 15)
+        logger.info(f"Network anomaly detected. Attempting to restart in {restart_delay} seconds...")
+        time.sleep(restart_delay)
\ No newline at end of file
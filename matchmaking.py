@@ -0,0 +1,127 @@
+# matchmaking.py
+# Attack-target discovery for the Map screen: attackable players indexed by power, shielded
+# players parked in an expiry heap until their shield drops. Kept fresh from storage writes.
+
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+
+import constants
+
+def _shield_expiry(value) -> float:
+    """shield_finish_time as a timestamp (0 when unset or unreadable)."""
+    if not value: return 0.0
+    try: return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError): return 0.0
+
+class MatchmakingIndex:
+    """
+    Unshielded players sit in a list of (power, user_id) kept sorted, so the targets closest to an
+    attacker's power are found by bisecting and walking outwards. Shielded players wait in a heap
+    keyed by shield expiry and are moved into the list lazily, on the first query after it passes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._open = []  # sorted (power, user_id) of attackable players
+        self._shields = []  # heap of (expiry timestamp, user_id); stale entries are skipped
+        self._listed = set()  # user_ids currently in _open
+        self._players = {}  # user_id -> [power, commander_name, alliance_id, shield expiry]
+
+    def load(self, records):
+        """Rebuilds from full player records; the list is sorted and the heap heapified once."""
+        players, now = {}, time.time()
+        for record in records:
+            user_id = record.get(constants.FIELD_USER_ID)
+            if user_id in (None, ''): continue
+            try: power = int(record.get('power') or 0)
+            except (TypeError, ValueError): power = 0
+            players[str(user_id)] = [power, record.get(constants.FIELD_COMMANDER_NAME, ''), record.get('alliance_id') or '', _shield_expiry(record.get('shield_finish_time'))]
+        open_entries = sorted((current[0], user_id) for user_id, current in players.items() if current[3] <= now)
+        shields = [(current[3], user_id) for user_id, current in players.items() if current[3] > now]
+        heapq.heapify(shields)
+        with self._lock: self._open, self._shields, self._players, self._listed = open_entries, shields, players, {user_id for _, user_id in open_entries}
+
+    def observe(self, user_id, changes: dict):
+        """Applies a committed player write; only power, name, alliance and shield matter here."""
+        if user_id in (None, '') or not ({'power', constants.FIELD_COMMANDER_NAME, 'alliance_id', 'shield_finish_time'} & changes.keys()): return
+        user_id = str(user_id)
+        with self._lock:
+            current = self._players.get(user_id)
+            if current is not None: self._withdraw(user_id, current)
+            else: current = self._players[user_id] = [0, '', '', 0.0]
+            expiry = current[3]
+            if 'power' in changes:
+                try: current[0] = int(changes['power'] or 0)
+                except (TypeError, ValueError): pass
+            if constants.FIELD_COMMANDER_NAME in changes: current[1] = changes[constants.FIELD_COMMANDER_NAME]
+            if 'alliance_id' in changes: current[2] = changes['alliance_id'] or ''
+            if 'shield_finish_time' in changes: current[3] = _shield_expiry(changes['shield_finish_time'])
+            self._place(user_id, current, time.time(), shield_changed=current[3] != expiry)
+
+    def _withdraw(self, user_id, current):
+        if user_id not in self._listed: return
+        self._listed.discard(user_id)
+        i = bisect_left(self._open, (current[0], user_id))
+        if i < len(self._open) and self._open[i] == (current[0], user_id): del self._open[i]
+
+    def _list(self, user_id, current):
+        if user_id in self._listed: return
+        self._listed.add(user_id)
+        insort(self._open, (current[0], user_id))
+
+    def _place(self, user_id, current, now, shield_changed=True):
+        # A still-running, unchanged shield already has its heap entry.
+        if current[3] > now:
+            if shield_changed: heapq.heappush(self._shields, (current[3], user_id))
+        else: self._list(user_id, current)
+
+    def _release_expired(self, now):
+        while self._shields and self._shields[0][0] <= now:
+            expiry, user_id = heapq.heappop(self._shields)
+            current = self._players.get(user_id)
+            if current is not None and current[3] == expiry: self._list(user_id, current)
+
+    def is_shielded(self, user_id, now=None) -> bool:
+        current = self._players.get(str(user_id))
+        return current is not None and current[3] > (now or time.time())
+
+    def find_targets(self, user_id, count=None, now=None) -> list:
+        """
+        Up to `count` attackable players for `user_id`, closest in power first, within the power band
+        of MATCHMAKING_CONFIG. Shielded players, the attacker and their alliance-mates are excluded.
+        Returns (user_id, commander_name, power) tuples.
+        """
+        config = constants.MATCHMAKING_CONFIG
+        count = count or config['targets']
+        now = now or time.time()
+        with self._lock:
+            self._release_expired(now)
+            attacker = self._players.get(str(user_id))
+            if attacker is None: return []
+            power, alliance_id = attacker[0], attacker[2]
+            low, high = power * config['band_low'], power * config['band_high'] + config['band_floor']
+            below, above = bisect_left(self._open, (power, '')) - 1, bisect_left(self._open, (power, ''))
+            targets = []
+            while len(targets) < count:
+                down_ok = below >= 0 and self._open[below][0] >= low
+                up_ok = above < len(self._open) and self._open[above][0] <= high
+                if not (down_ok or up_ok): break
+                if down_ok and (not up_ok or power - self._open[below][0] <= self._open[above][0] - power):
+                    candidate = self._open[below][1]; below -= 1
+                else:
+                    candidate = self._open[above][1]; above += 1
+                target = self._players[candidate]
+                if candidate == str(user_id) or (alliance_id and target[2] == alliance_id): continue
+                targets.append((candidate, target[1], target[0]))
+            return targets
+
+_index = MatchmakingIndex()
+
+def get_index() -> MatchmakingIndex: return _index
+def load(records): _index.load(records)
+def observe(user_id, changes: dict): _index.observe(user_id, changes)
+def is_shielded(user_id, now=None): return _index.is_shielded(user_id, now)
+def find_targets(user_id, count=None, now=None): return _index.find_targets(user_id, count, now)
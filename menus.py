@@ -0,0 +1,71 @@
+# menus.py
+# Memoized renderers for the idle Build, Train and Research screens. Each one is keyed by exactly
+# the player state it depends on (levels, unlocked research), so a repeat view is a cache lookup.
+# Busy screens show a live countdown and are rendered per view in handlers.
+
+from functools import lru_cache
+
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import callbacks
+import constants
+from player_record import is_true
+import tables
+
+class FrozenMarkup(InlineKeyboardMarkup):
+    """An inline keyboard that is shared between sends: its JSON is built once, on first use."""
+    _json = None
+
+    def to_json(self):
+        if self._json is None: self._json = super().to_json()
+        return self._json
+
+def back_button(): return InlineKeyboardButton("⬅️ Back to Base", callback_data=callbacks.encode('back_to_base'))
+
+def building_levels(player_data: dict) -> tuple:
+    return tuple(int(player_data.get(info['id'], 0) or 0) for info in constants.BUILDING_DATA.values())
+
+def unlocked_research(player_data: dict) -> frozenset:
+    return frozenset(key for key, info in constants.RESEARCH_DATA.items() if is_true(player_data.get(info['id'])))
+
+@lru_cache(maxsize=constants.MENU_CACHE_SIZE)
+def render_build_menu(levels: tuple):
+    """(text, markup) for the idle Construction Yard; `levels` follows BUILDING_DATA order."""
+    text = "<b><u>⚒️ Construction Yard (Idle)</u></b>\nSelect a building to upgrade:\n"
+    markup = FrozenMarkup(row_width=1)
+    for (key, info), level in zip(constants.BUILDING_DATA.items(), levels):
+        text += f"\n{info['emoji']} <b>{info['name']}</b> (Level {level})"
+        markup.add(InlineKeyboardButton(f"Upgrade - Cost: {tables.building_cost_label(key, level + 1)}", callback_data=callbacks.encode('build', key)))
+    markup.add(back_button())
+    return text, markup
+
+@lru_cache(maxsize=constants.MENU_CACHE_SIZE)
+def render_train_menu(barracks_level: int):
+    text = f"<b><u>🪖 Barracks (Idle)</u></b>\nSelect a unit to train:\n"
+    markup = FrozenMarkup(row_width=1)
+    for key, info in constants.UNIT_DATA.items():
+        if barracks_level >= info['required_barracks_level']:
+            text += f"\n{info['emoji']} <b>{info['name']}</b> (ATK:{info['stats']['attack']}/DEF:{info['stats']['defense']})"
+            markup.add(InlineKeyboardButton(f"Train - {tables.UNIT_COST_LABELS[key]} / unit", callback_data=callbacks.encode('train', key)))
+    markup.add(back_button())
+    return text, markup
+
+@lru_cache(maxsize=constants.MENU_CACHE_SIZE)
+def render_research_menu(lab_level: int, unlocked: frozenset):
+    text = f"<b><u>🔬 Research Lab (Idle)</u></b>\nSelect a technology to research:\n"
+    markup = FrozenMarkup(row_width=1)
+    for key, info in constants.RESEARCH_DATA.items():
+        text += f"\n{info['emoji']} <b>{info['name']}</b>\n<i>{info['description']}</i>\n"
+        if key in unlocked: text += "<b>Status:</b> ✅ Researched\n"
+        elif lab_level < info['required_lab_level']: text += f"<b>Status:</b> 🔒 Locked (Req. Lab Lv. {info['required_lab_level']})\n"
+        else: markup.add(InlineKeyboardButton(f"Begin Research ({tables.RESEARCH_COST_LABELS[key]} | {tables.RESEARCH_TIMES[key]})", callback_data=callbacks.encode('research', key)))
+    markup.add(back_button())
+    return text, markup
+
+@lru_cache(maxsize=1)
+def back_to_base_markup():
+    return FrozenMarkup().add(back_button())
+
+def cache_info() -> dict:
+    """Hit/miss counters per renderer, e.g. for logging or a metrics endpoint."""
+    return {name: renderer.cache_info()._asdict() for name, renderer in (('build', render_build_menu), ('train', render_train_menu), ('research', render_research_menu))}
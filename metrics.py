@@ -0,0 +1,252 @@
+# metrics.py
+# In-process instrumentation: latency histograms, API call counters and scrape-time gauges,
+# served in Prometheus text format on a local HTTP endpoint, plus a sampling profiler for slow requests.
+#
+# Everything is off unless enable() is called (main.py does so when METRICS_PORT is set). While
+# disabled, timed() and instrument_api() hand back the original callable/object, and the few
+# inline counters are guarded by a single `if metrics.enabled`, so the hot path pays nothing.
+
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Histogram:
+    """Cumulative-bucket latency histogram, one series per label value."""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label, self.buckets = name, help_text, label, tuple(buckets)
+        self._series = {}  # label value -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None: series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self, lines):
+        lines += [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock: snapshot = {key: list(series) for key, series in self._series.items()}
+        for key, series in sorted(snapshot.items()):
+            labels, cumulative = f'{self.label}="{_escape(key)}"', 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines += [f'{self.name}_sum{{{labels}}} {series[-1]:.6f}', f'{self.name}_count{{{labels}}} {cumulative}']
+
+class _Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, labels):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock: self._values[label_values] += amount
+
+    def value(self, *label_values): return self._values.get(label_values, 0)
+
+    def render(self, lines):
+        lines += [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock: snapshot = dict(self._values)
+        for key, value in sorted(snapshot.items()):
+            lines.append(f'{self.name}{{{_labels(self.labels, key)}}} {value}')
+
+class _Collected:
+    """A gauge (or externally kept counter) read at scrape time: fn() returns a number or {label values: number}."""
+
+    def __init__(self, name, help_text, fn, labels=(), kind='gauge'):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help_text, fn, tuple(labels), kind
+
+    def render(self, lines):
+        try:
+            values = self.fn()
+            samples = [f'{self.name} {values}'] if not isinstance(values, dict) else [
+                f'{self.name}{{{_labels(self.labels, key if isinstance(key, tuple) else (key,))}}} {value}' for key, value in values.items()]
+        except Exception as e:
+            logger.warning("Metric %s could not be collected: %s", self.name, e); return
+        lines += [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + sorted(samples)
+
+def _escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+def _labels(names, values): return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+# --- Registry ---
+
+HANDLER_SECONDS = _Histogram('skyhustle_handler_seconds', 'Telegram update handler latency.', 'handler')
+JOB_SECONDS = _Histogram('skyhustle_job_seconds', 'Background job latency (completion batches, sheet flushes).', 'job')
+API_SECONDS = _Histogram('skyhustle_api_call_seconds', 'Outbound Sheets/Telegram API call latency.', 'api')
+API_CALLS = _Counter('skyhustle_api_calls_total', 'Outbound API calls by API, method and outcome (ok, error, throttled).', ('api', 'method', 'outcome'))
+HANDLER_ERRORS = _Counter('skyhustle_handler_errors_total', 'Handler and job invocations that raised.', ('name',))
+CACHE_REQUESTS = _Counter('skyhustle_cache_requests_total', 'Cache lookups by cache and result (hit, miss).', ('cache', 'result'))
+COMPLETIONS = _Counter('skyhustle_completions_total', 'Queue completions resolved, by kind.', ('kind',))
+
+_metrics = [HANDLER_SECONDS, JOB_SECONDS, API_SECONDS, API_CALLS, HANDLER_ERRORS, CACHE_REQUESTS, COMPLETIONS]
+_profiler = None
+
+def register_collector(name, help_text, fn, labels=(), kind='gauge'):
+    """Adds a value computed on every scrape, e.g. a queue depth. Cheap to call even when disabled."""
+    _metrics.append(_Collected(name, help_text, fn, labels, kind))
+
+def render() -> str:
+    lines = []
+    for metric in list(_metrics): metric.render(lines)
+    return '\n'.join(lines) + '\n'
+
+def enable(slow_request_ms=None, profile_interval_ms=5, keep_slow=20):
+    """Turns instrumentation on; with `slow_request_ms`, also samples stacks of timed calls that run longer."""
+    global enabled, _profiler
+    enabled = True
+    if slow_request_ms and _profiler is None:
+        _profiler = SlowRequestProfiler(slow_request_ms / 1000, profile_interval_ms / 1000, keep_slow)
+        _profiler.start()
+
+# --- Instrumentation helpers ---
+
+def timed(histogram, name, fn):
+    """Wraps fn so each call is observed in `histogram` under `name`. Returns fn itself when disabled."""
+    if not enabled: return fn
+    @wraps(fn)
+    def run(*args, **kwargs):
+        token = _profiler.begin(name) if _profiler else None
+        start = time.perf_counter()
+        try: return fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name); raise
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed, name)
+            if token is not None: _profiler.end(token, elapsed)
+    return run
+
+def _status_of(error):
+    """HTTP status of an API error: gspread's APIError carries a response, Telegram's exception an error_code."""
+    return getattr(getattr(error, 'response', None), 'status_code', None) or getattr(error, 'error_code', None)
+
+class _InstrumentedApi:
+    """Proxy that counts and times every method call on an API object (a worksheet, a bot)."""
+
+    def __init__(self, api, target):
+        self._api, self._target = api, target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name.startswith('_'): return attribute
+        api, label = self._api, f'{self._api}.{name}'
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try: result = attribute(*args, **kwargs)
+            except Exception as e:
+                API_CALLS.inc(api, name, 'throttled' if _status_of(e) == 429 else 'error'); raise
+            finally: API_SECONDS.observe(time.perf_counter() - start, label)
+            API_CALLS.inc(api, name, 'ok')
+            return result
+        return call
+
+def instrument_api(api: str, target):
+    """Returns `target` wrapped so its calls are counted under api=<api>, or `target` unchanged when disabled."""
+    return _InstrumentedApi(api, target) if enabled else target
+
+# --- Slow-request profiler ---
+
+class SlowRequestProfiler:
+    """
+    Samples the stack of every thread inside a timed() call every `interval` seconds. When a call
+    finishes above `threshold`, its samples are kept (the last `keep` such calls) and the hottest
+    stack is logged, which shows where a slow handler spent its time without tracing every call.
+    """
+
+    def __init__(self, threshold, interval=0.005, keep=20):
+        self.threshold, self.interval = threshold, interval
+        self.slow = deque(maxlen=keep)
+        self._active = {}  # thread id -> (name, Counter of collapsed stacks)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='metrics-profiler', daemon=True)
+
+    def start(self): self._thread.start()
+
+    def begin(self, name):
+        thread_id = threading.get_ident()
+        with self._lock:
+            if thread_id in self._active: return None  # nested timed call: the outer one owns the samples
+            self._active[thread_id] = (name, Counter())
+        return thread_id
+
+    def end(self, thread_id, elapsed):
+        with self._lock: name, samples = self._active.pop(thread_id)
+        if elapsed < self.threshold: return
+        self.slow.append({'name': name, 'seconds': round(elapsed, 4), 'at': time.time(), 'stacks': samples.most_common(5)})
+        hottest = samples.most_common(1)
+        logger.warning("Slow call %s took %.0f ms (%d samples); hottest stack: %s", name, elapsed * 1000, sum(samples.values()), hottest[0][0] if hottest else 'n/a')
+
+    def report(self) -> str:
+        lines = []
+        for entry in list(self.slow):
+            lines.append(f"{entry['name']} {entry['seconds'] * 1000:.0f} ms at {time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(entry['at']))}Z")
+            lines += [f'  {count:4d}  {stack}' for stack, count in entry['stacks']]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            stack.append(f'{frame.f_code.co_filename.rsplit("/", 1)[-1]}:{frame.f_code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active: continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, (_, samples) in self._active.items():
+                    if (frame := frames.get(thread_id)) is not None: samples[self._collapse(frame)] += 1
+
+# --- HTTP endpoint ---
+
+class MetricsServer:
+    """Serves /metrics (Prometheus text format) and /debug/slow (profiled slow calls) from a daemon thread."""
+
+    def __init__(self, host='127.0.0.1', port=9100):
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics-http', daemon=True)
+
+    @staticmethod
+    def _make_handler():
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body=b'', content_type='text/plain; version=0.0.4; charset=utf-8'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/metrics': self._reply(200, render().encode())
+                elif self.path == '/debug/slow': self._reply(200, (_profiler.report() if _profiler else 'profiler disabled\n').encode())
+                else: self._reply(404)
+
+            def log_message(self, format, *args): pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+        host, port = self._httpd.server_address[:2]
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    def shutdown(self): self._httpd.shutdown()
@@ -0,0 +1,79 @@
+# name_index.py
+# In-memory commander name index: case-insensitive exact lookups and sorted prefix search.
+
+import bisect
+import threading
+
+def normalize_name(name: str) -> str:
+    """Case-folds a commander name and collapses internal whitespace, e.g. ' Sky  Wolf' -> 'sky wolf'."""
+    return ' '.join(str(name).split()).casefold()
+
+class NameIndex:
+    """
+    Maps normalized commander names to user ids.
+    A hash map serves exact lookups in O(1); a sorted list of the same keys serves
+    prefix/autocomplete queries with a binary search in O(log n).
+    """
+
+    def __init__(self):
+        self._by_key = {}  # normalized name -> (user_id, display name)
+        self._sorted_keys = []
+        self._lock = threading.Lock()
+
+    def __len__(self): return len(self._by_key)
+
+    def load(self, entries):
+        """Rebuilds the index from (user_id, commander_name) pairs. Later duplicates are ignored."""
+        by_key = {}
+        for user_id, name in entries:
+            if name: by_key.setdefault(normalize_name(name), (str(user_id), name))
+        with self._lock:
+            self._by_key = by_key
+            self._sorted_keys = sorted(by_key)
+
+    def add(self, user_id, name: str) -> bool:
+        """Registers a name for user_id. Returns False if another commander already holds it."""
+        key = normalize_name(name)
+        with self._lock:
+            owner = self._by_key.get(key)
+            if owner and owner[0] != str(user_id): return False
+            if owner is None: bisect.insort(self._sorted_keys, key)
+            self._by_key[key] = (str(user_id), name)
+            return True
+
+    def remove(self, name: str, user_id=None):
+        """Releases a name, optionally only if it is still held by user_id."""
+        key = normalize_name(name)
+        with self._lock:
+            owner = self._by_key.get(key)
+            if not owner or (user_id is not None and owner[0] != str(user_id)): return
+            del self._by_key[key]
+            position = bisect.bisect_left(self._sorted_keys, key)
+            if position < len(self._sorted_keys) and self._sorted_keys[position] == key: del self._sorted_keys[position]
+
+    def rename(self, user_id, old_name: str, new_name: str) -> bool:
+        if not self.add(user_id, new_name): return False
+        if old_name and normalize_name(old_name) != normalize_name(new_name): self.remove(old_name, user_id)
+        return True
+
+    def lookup(self, name: str):
+        """Returns the user_id (as a string) holding `name`, or None."""
+        owner = self._by_key.get(normalize_name(name))
+        return owner[0] if owner else None
+
+    def is_taken(self, name: str) -> bool:
+        return normalize_name(name) in self._by_key
+
+    def prefix(self, prefix: str, limit: int = 10) -> list:
+        """Returns up to `limit` (display name, user_id) pairs whose name starts with `prefix`, alphabetically."""
+        key = normalize_name(prefix)
+        results = []
+        with self._lock:
+            position = bisect.bisect_left(self._sorted_keys, key)
+            while position < len(self._sorted_keys) and len(results) < limit:
+                candidate = self._sorted_keys[position]
+                if not candidate.startswith(key): break
+                user_id, display_name = self._by_key[candidate]
+                results.append((display_name, user_id))
+                position += 1
+        return results
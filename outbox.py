@@ -0,0 +1,196 @@
+# outbox.py
+# Rate-aware outbound Telegram queue: token buckets per chat and globally, priority classes,
+# coalescing of repeated edits and retry-after handling for 429 responses.
+
+import heapq
+import inspect
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, NOTIFICATION = 0, 1
+_context = threading.local()
+
+@contextmanager
+def notifications():
+    """Marks API calls made inside the block as background notifications (sent after interactive replies)."""
+    previous = getattr(_context, 'priority', INTERACTIVE)
+    _context.priority = NOTIFICATION
+    try: yield
+    finally: _context.priority = previous
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until: return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self): self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        """Whether the bucket has refilled completely, i.e. is indistinguishable from a new one."""
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class _Job:
+    __slots__ = ('priority', 'sequence', 'method', 'chat_id', 'coalesce_key', 'args', 'kwargs', 'future')
+
+class OutboundDispatcher:
+    """
+    Sends Bot API calls from a few sender threads, highest priority first.
+    A chat never has two calls in flight, so its messages keep their order. A pending edit of
+    the same message by the same method is replaced by a newer one instead of sent twice.
+    Chat buckets that have refilled are dropped periodically, so idle chats cost no memory.
+    """
+    COALESCED_METHODS = {'edit_message_text', 'edit_message_reply_markup'}
+
+    def __init__(self, bot, global_per_second=30, per_chat_per_second=1, per_chat_burst=3, senders=4):
+        self.bot = bot
+        self.per_chat_per_second, self.per_chat_burst = per_chat_per_second, per_chat_burst
+        self._global = TokenBucket(global_per_second, global_per_second)
+        self._chats = {}
+        self._swept = time.monotonic()
+        self._busy_chats = set()
+        self._heap = []
+        self._coalescing = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self.sent = self.coalesced = self.rate_limited = 0
+        self._threads = [threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True) for i in range(senders)]
+        for thread in self._threads: thread.start()
+
+    def depth(self) -> int: return len(self._heap)
+
+    def submit(self, method: str, chat_id, args, kwargs, priority=INTERACTIVE, message_id=None) -> Future:
+        with self._cond:
+            key = (method, chat_id, message_id) if method in self.COALESCED_METHODS and message_id is not None else None
+            if key and (pending := self._coalescing.get(key)) is not None:
+                pending.args, pending.kwargs = args, kwargs
+                pending.priority = min(pending.priority, priority)
+                self.coalesced += 1
+                return pending.future
+            job = _Job()
+            job.priority, job.sequence, job.method, job.chat_id = priority, next(self._sequence), method, chat_id
+            job.coalesce_key, job.args, job.kwargs, job.future = key, args, kwargs, Future()
+            if key: self._coalescing[key] = job
+            heapq.heappush(self._heap, (priority, job.sequence, job))
+            self._cond.notify()
+            return job.future
+
+    def shutdown(self, timeout=10):
+        """Stops the senders once the queue has drained (or after `timeout` seconds)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._heap and time.monotonic() < deadline: self._cond.wait(0.1)
+            self._running = False
+            self._cond.notify_all()
+
+    def _evict_idle_buckets(self, now):
+        """Drops the buckets of idle chats that have refilled, at most once per refill period. Called with the lock held."""
+        if now - self._swept < self.per_chat_burst / self.per_chat_per_second: return
+        self._swept = now
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if chat_id not in self._busy_chats and bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self._chats: self._chats[chat_id] = TokenBucket(self.per_chat_per_second, self.per_chat_burst)
+        return self._chats[chat_id]
+
+    def _next_job(self):
+        """Pops the best job whose chat is idle and within its rate. Called with the lock held."""
+        while self._running:
+            now = time.monotonic()
+            self._evict_idle_buckets(now)
+            wait = self._global.wait_time(now)
+            if wait == 0 and self._heap:
+                skipped, job, wait = [], None, 1.0
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    candidate = entry[2]
+                    if candidate.chat_id is not None:
+                        if candidate.chat_id in self._busy_chats: skipped.append(entry); continue
+                        chat_wait = self._chat_bucket(candidate.chat_id).wait_time(now)
+                        if chat_wait > 0: skipped.append(entry); wait = min(wait, chat_wait); continue
+                        self._chat_bucket(candidate.chat_id).take()
+                        self._busy_chats.add(candidate.chat_id)
+                    job = candidate; break
+                for entry in skipped: heapq.heappush(self._heap, entry)
+                if job:
+                    self._global.take()
+                    if job.coalesce_key: self._coalescing.pop(job.coalesce_key, None)
+                    return job
+            self._cond.wait(timeout=wait if self._heap else None)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+            if job is None: return
+            try:
+                job.future.set_result(getattr(self.bot, job.method)(*job.args, **job.kwargs))
+                self.sent += 1
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._retry_later(job, e)
+                else:
+                    logger.warning(f"Telegram rejected {job.method} for chat {job.chat_id}: {e}")
+                    job.future.set_exception(e)
+            except Exception as e:
+                logger.error(f"Outbound {job.method} for chat {job.chat_id} failed: {e}")
+                job.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._busy_chats.discard(job.chat_id)
+                    self._cond.notify_all()
+
+    def _retry_later(self, job, error):
+        retry_after = ((error.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+        self.rate_limited += 1
+        logger.warning(f"429 from Telegram on {job.method} for chat {job.chat_id}; retrying after {retry_after}s.")
+        with self._cond:
+            bucket = self._chat_bucket(job.chat_id) if job.chat_id is not None else self._global
+            bucket.blocked_until = time.monotonic() + retry_after
+            heapq.heappush(self._heap, (job.priority, job.sequence, job))
+
+
+class DispatchingBot:
+    """
+    Wraps a bot so outbound API calls go through an OutboundDispatcher and return Futures
+    instead of blocking. Everything else (registration, polling, ...) is passed through.
+    """
+    SEND_METHODS = {'send_message', 'edit_message_text', 'edit_message_reply_markup', 'answer_callback_query', 'delete_message', 'send_photo'}
+
+    def __init__(self, bot, dispatcher: OutboundDispatcher):
+        self._bot = bot
+        self.dispatcher = dispatcher
+        self._signatures = {}
+
+    def _target(self, method, args, kwargs):
+        """Returns (chat_id, message_id) of a call, read through TeleBot's signature (AsyncTeleBot's matches)."""
+        if method not in self._signatures: self._signatures[method] = inspect.signature(getattr(TeleBot, method))
+        try: arguments = self._signatures[method].bind_partial(None, *args, **kwargs).arguments
+        except TypeError: arguments = kwargs
+        return arguments.get('chat_id'), arguments.get('message_id')
+
+    def __getattr__(self, name):
+        if name not in self.SEND_METHODS: return getattr(self._bot, name)
+        def send(*args, **kwargs):
+            chat_id, message_id = self._target(name, args, kwargs)
+            return self.dispatcher.submit(name, chat_id, args, kwargs, getattr(_context, 'priority', INTERACTIVE), message_id)
+        return send
@@ -0,0 +1,117 @@
+# player_record.py
+# Typed, compact player record. Its slots are generated from SHEET_COLUMN_HEADERS and every cell
+# is parsed once, when the row is loaded: ints, booleans for research_*_unlocked, datetimes for
+# timestamps and the decoded return_queue_army_data. Assignments are tracked so a write sends only
+# the columns that actually changed.
+
+import json
+from datetime import datetime
+
+import constants
+
+INT, BOOL, DATETIME, JSON, STR = 'int', 'bool', 'datetime', 'json', 'str'
+
+def _field_kind(field: str) -> str:
+    if field.startswith('research_') and field.endswith('_unlocked'): return BOOL
+    if field.endswith('_finish_time') or field in ('created_at', 'last_seen'): return DATETIME
+    if field in ('return_queue_army_data', 'defended_battles'): return JSON
+    if field in (constants.FIELD_USER_ID, 'train_queue_quantity', 'attack_queue_target_id'): return INT
+    default = constants.INITIAL_PLAYER_STATS.get(field)
+    return INT if isinstance(default, int) and not isinstance(default, bool) else STR
+
+FIELD_KINDS = {field: _field_kind(field) for field in constants.SHEET_COLUMN_HEADERS}
+
+def parse_value(field: str, value):
+    """Sheet cell (or an already-typed value) -> typed value. Empty cells become None; unreadable ones stay strings."""
+    kind = FIELD_KINDS.get(field, STR)
+    if value is None or value == '': return None if kind != STR else ''
+    if kind == STR or not isinstance(value, str): return value
+    try:
+        if kind == INT: return int(value) if value.lstrip('-').isdigit() else int(float(value.replace(',', '')))
+        if kind == BOOL: return value.upper() == 'TRUE'
+        if kind == DATETIME: return datetime.fromisoformat(value)
+        if kind == JSON: return json.loads(value)
+    except ValueError: return value
+    return value
+
+def format_value(value) -> str:
+    """Typed value -> the string stored in the sheet."""
+    if value is None: return ''
+    if isinstance(value, bool): return 'TRUE' if value else 'FALSE'
+    if isinstance(value, datetime): return value.isoformat()
+    if isinstance(value, (dict, list)): return json.dumps(value)
+    return str(value)
+
+def is_true(value) -> bool:
+    """Research flags read the same from a PlayerRecord (True) and from a sheet dict ('TRUE')."""
+    return value is True or value == 'TRUE'
+
+class PlayerRecord:
+    """
+    One player, one slot per sheet column. Supports the read side of the dict API (get, [],
+    in, update) with typed values, so code written against player dicts keeps working.
+    """
+    __slots__ = tuple(constants.SHEET_COLUMN_HEADERS) + ('_dirty',)
+    FIELDS = tuple(constants.SHEET_COLUMN_HEADERS)
+
+    def __init__(self):
+        for field in self.FIELDS: object.__setattr__(self, field, None)
+        object.__setattr__(self, '_dirty', set())
+
+    @classmethod
+    def from_row(cls, headers, row):
+        record = cls.__new__(cls)
+        values = dict(zip(headers, row))
+        for field in cls.FIELDS: object.__setattr__(record, field, parse_value(field, values.get(field)))
+        object.__setattr__(record, '_dirty', set())
+        return record
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls.from_row(data.keys(), data.values())
+
+    def __setattr__(self, field, value):
+        value = parse_value(field, value)
+        if getattr(self, field) != value:
+            object.__setattr__(self, field, value)
+            self._dirty.add(field)
+
+    # --- dict-style access ---
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in FIELD_KINDS else None
+        return default if value is None or value == '' else value
+
+    def __getitem__(self, field):
+        if field not in FIELD_KINDS: raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field): return self.get(field) is not None
+
+    def update(self, updates: dict):
+        for field, value in updates.items():
+            if field in FIELD_KINDS: setattr(self, field, value)
+
+    # --- Persistence ---
+    def copy(self):
+        clone = PlayerRecord.from_row((), ())
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            object.__setattr__(clone, field, dict(value) if isinstance(value, dict) else value)
+        return clone
+
+    def changed_fields(self, updates: dict) -> dict:
+        """The subset of `updates` that would change this record, as sheet strings."""
+        return {field: format_value(parse_value(field, value)) for field, value in updates.items()
+                if field in FIELD_KINDS and parse_value(field, value) != getattr(self, field)}
+
+    def changes(self) -> dict:
+        """Assigned-and-changed fields since load (or the last clear_dirty), as sheet strings."""
+        return {field: format_value(getattr(self, field)) for field in self._dirty}
+
+    def clear_dirty(self): self._dirty.clear()
+
+    def as_dict(self) -> dict:
+        """The sheet view: {field: string}, with empty cells left out like row_values() does."""
+        return {field: text for field in self.FIELDS if (text := format_value(getattr(self, field))) != ''}
+
+    def __repr__(self): return f"PlayerRecord(user_id={self.user_id!r}, commander_name={self.commander_name!r})"
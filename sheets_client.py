@@ -0,0 +1,117 @@
+# sheets_client.py
+# Quota-aware access to the Sheets API: read/write token buckets matched to the per-minute quotas,
+# single-flight coalescing of identical concurrent reads, and jittered exponential backoff on 429/5xx.
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from gspread.exceptions import APIError
+
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class SheetsThrottled(Exception):
+    """
+    The Sheets API is over quota (or unavailable) and the call was given up on. Unlike a
+    None/False result, this does not mean the player or alliance is absent: retry later.
+    """
+
+class QuotaClient:
+    """
+    Wraps spreadsheets and worksheets so every read and write first takes a token from its bucket.
+    A call that would wait longer than `max_wait_seconds` for a token raises SheetsThrottled instead of
+    stalling the caller. Retryable API errors back off exponentially with full jitter, and pause the
+    whole bucket so concurrent callers do not keep hitting the quota. Non-idempotent calls (appends,
+    deletes) are retried only on 429, which Google returns before applying the request.
+    """
+    READ_METHODS = {'worksheet', 'worksheets', 'fetch_sheet_metadata', 'row_values', 'col_values', 'get', 'get_values',
+                    'get_all_values', 'get_all_records', 'batch_get', 'find', 'findall', 'acell', 'cell'}
+    WRITE_METHODS = {'update', 'update_cell', 'update_cells', 'batch_update', 'append_row', 'append_rows',
+                     'insert_row', 'insert_rows', 'delete_rows', 'add_worksheet', 'clear'}
+    NON_IDEMPOTENT = {'append_row', 'append_rows', 'insert_row', 'insert_rows', 'delete_rows', 'add_worksheet'}
+
+    def __init__(self, reads_per_minute=60, writes_per_minute=60, burst=10, max_wait_seconds=20, max_retries=5, backoff_base_seconds=1.0, backoff_max_seconds=32.0):
+        self._buckets = {'read': TokenBucket(reads_per_minute / 60, burst), 'write': TokenBucket(writes_per_minute / 60, burst)}
+        self.max_wait, self.max_retries = max_wait_seconds, max_retries
+        self.backoff_base, self.backoff_max = backoff_base_seconds, backoff_max_seconds
+        self._lock = threading.Lock()
+        self._in_flight = {}  # read key -> Future shared by identical concurrent reads
+        self.coalesced = self.retried = self.throttled = 0
+
+    def wrap(self, target):
+        return _QuotaProxy(self, target)
+
+    def _acquire(self, kind, method):
+        bucket, deadline = self._buckets[kind], time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = bucket.wait_time(now)
+                if wait == 0: bucket.take(); return
+            if now + wait > deadline:
+                self.throttled += 1
+                raise SheetsThrottled(f"Sheets {kind} quota exhausted; {method} would wait {wait:.1f}s.")
+            time.sleep(wait)
+
+    def _backoff(self, kind, attempt):
+        """Full-jitter delay for retry `attempt`; the bucket is paused for it too."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        with self._lock:
+            bucket = self._buckets[kind]
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+        return delay
+
+    def call(self, kind, method, fn, *args, **kwargs):
+        """Runs one API call under the quota, retrying retryable errors. Raises SheetsThrottled when out of retries."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(kind, method)
+            try: return fn(*args, **kwargs)
+            except APIError as e:
+                status = getattr(e.response, 'status_code', None)
+                if status not in RETRYABLE_STATUSES or (status != 429 and method in self.NON_IDEMPOTENT): raise
+                if attempt == self.max_retries:
+                    self.throttled += 1
+                    raise SheetsThrottled(f"Sheets {method} still failing with HTTP {status} after {attempt} retries.") from e
+                self.retried += 1
+                logger.warning("Sheets %s returned HTTP %s; retry %d in %.2fs.", method, status, attempt + 1, self._backoff(kind, attempt))
+
+    def read(self, key, method, fn, *args, **kwargs):
+        """Like call(), but identical reads already in flight share its result instead of spending quota."""
+        with self._lock:
+            pending = self._in_flight.get(key)
+            if pending is None: self._in_flight[key] = future = Future()
+        if pending is not None:
+            self.coalesced += 1
+            return pending.result()
+        try:
+            result = self.call('read', method, fn, *args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e); raise
+        finally:
+            with self._lock: self._in_flight.pop(key, None)
+
+class _QuotaProxy:
+    """Routes a spreadsheet's or worksheet's API methods through a QuotaClient; everything else passes through."""
+
+    def __init__(self, client, target):
+        self._client, self._target = client, target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        client = self._client
+        if name in client.READ_METHODS:
+            # Coalesced callers share one result object, so they must treat it as read-only.
+            def read(*args, **kwargs):
+                return client.read((id(self._target), name, repr(args), repr(sorted(kwargs.items()))), name, attribute, *args, **kwargs)
+            return read
+        if name in client.WRITE_METHODS:
+            return lambda *args, **kwargs: client.call('write', name, attribute, *args, **kwargs)
+        return attribute
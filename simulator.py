@@ -0,0 +1,360 @@
+# simulator.py
+# Headless economy simulator for balance tuning. Synthetic players follow build/train/research/
+# attack strategies on a virtual clock, with no storage and no Telegram: actions are priced with
+# tables.calculate_cost/calculate_time, production accrues through economy.settle, and queue
+# completions and battles run through the bot's own pure functions (handlers.COMPLETION_HANDLERS,
+# resolve_defenses, conclude_attack) off a CompletionEngine driven by pop_due(virtual now).
+#
+# The population is split into partitions simulated in parallel processes; battles stay within a
+# partition. The output is progression curves (percentiles over time) and where the resources went.
+#   python -m simulator [--players 20000] [--days 7] [--set PATH=VALUE ...] [--sweep PATH=V1,V2 ...] [--json out.json]
+# PATH names a balance knob in constants, e.g. BUILDING_DATA.sawmill.cost_multiplier,
+# BUILDING_DATA.*.time_multiplier or COMBAT_CONFIG.loot_percentage. Every --sweep combination is a scenario.
+
+import argparse
+import copy
+import itertools
+import json
+import math
+import os
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
+
+import battle
+import constants
+import economy
+import handlers
+import tables
+from completion_engine import CompletionEngine
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+# Knobs that --set/--sweep may change; they are restored from these copies before each job.
+TUNABLE = ('BUILDING_DATA', 'UNIT_DATA', 'RESEARCH_DATA', 'COMBAT_CONFIG', 'INITIAL_PLAYER_STATS', 'NEW_PLAYER_SHIELD_HOURS', 'MATCHMAKING_CONFIG')
+_PRISTINE = {name: copy.deepcopy(getattr(constants, name)) for name in TUNABLE}
+
+# buildings: what the strategy upgrades (cheapest next level first); research: in order;
+# train_share: share of the stockpile spent on each training batch; attacks: raids the Map's power band.
+STRATEGIES = {
+    'economist': {'buildings': ('sawmill', 'quarry', 'ironmine', 'warehouse', 'hq', 'research_lab'), 'research': ('logistics',), 'train_share': 0.0, 'attacks': False},
+    'builder': {'buildings': tuple(constants.BUILDING_DATA), 'research': ('logistics', 'weaponry'), 'train_share': 0.2, 'attacks': False},
+    'raider': {'buildings': ('barracks', 'warehouse', 'ironmine', 'sawmill', 'quarry', 'research_lab', 'hq'), 'research': ('weaponry', 'logistics'), 'train_share': 0.6, 'attacks': True},
+}
+DEFAULT_MIX = {'economist': 0.4, 'builder': 0.4, 'raider': 0.2}
+CURVES = ('power', 'building_levels', 'hq_level', 'stockpile')
+MIN_RAID_UNITS = 10
+
+Job = namedtuple('Job', ['scenario', 'overrides', 'partition', 'first_user_id', 'players', 'days', 'mix', 'reaction_minutes', 'tick_seconds', 'sample_hours', 'seed'])
+
+# --- Balance knobs ---
+
+def parse_value(text: str):
+    try: return json.loads(text)
+    except ValueError: return text
+
+def _set_path(path: str, value):
+    name, *keys = path.split('.')
+    if name not in TUNABLE: raise ValueError(f"'{name}' is not tunable; choose from {', '.join(TUNABLE)}")
+    if not keys: setattr(constants, name, value); return
+    targets = [getattr(constants, name)]
+    for key in keys[:-1]:
+        if key != '*' and any(key not in target for target in targets): raise ValueError(f"unknown knob {path}")
+        targets = [child for target in targets for child in (target.values() if key == '*' else [target[key]])]
+    for target in targets:
+        if keys[-1] not in target: raise ValueError(f"unknown knob {path}")
+        target[keys[-1]] = value
+
+def apply_overrides(overrides: dict):
+    """Restores every tunable constant, then applies {path: value}. Dicts are updated in place, since other modules hold them."""
+    for name, pristine in _PRISTINE.items():
+        current = getattr(constants, name)
+        if isinstance(current, dict): current.clear(); current.update(copy.deepcopy(pristine))
+        else: setattr(constants, name, pristine)
+    for path, value in overrides.items(): _set_path(path, value)
+    battle.unit_stats.cache_clear(); upgrade.cache_clear(); max_lab_level.cache_clear()
+
+@lru_cache(maxsize=None)
+def upgrade(building_key: str, level: int):
+    """(cost, total cost, seconds) of upgrading to `level` under the current knobs."""
+    info = constants.BUILDING_DATA[building_key]
+    cost = tables.calculate_cost(info['base_cost'], info['cost_multiplier'], level)
+    return cost, sum(cost.values()), tables.calculate_time(info['base_time_seconds'], info['time_multiplier'], level)
+
+@lru_cache(maxsize=1)
+def max_lab_level() -> int:
+    """The lab level past which upgrading unlocks nothing more."""
+    return max(info['required_lab_level'] for info in constants.RESEARCH_DATA.values())
+
+# --- One partition ---
+
+class Simulation:
+    """One partition's players, advanced on a virtual clock until `end`."""
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.rng = np.random.default_rng([job.seed, job.scenario, job.partition])
+        self.engine = CompletionEngine()
+        self.end = START + timedelta(days=job.days)
+        self.reaction = job.reaction_minutes * 60
+        self.stats = {'actions': Counter(), 'spent': {'build': Counter(), 'train': Counter(), 'research': Counter()}, 'spent_by_building': Counter(),
+                      'produced': Counter(), 'overflow': Counter(), 'looted': Counter(), 'battles': Counter()}
+        strategies, weights = zip(*job.mix.items())
+        shield = START + timedelta(hours=constants.NEW_PLAYER_SHIELD_HOURS)
+        self.players, self.strategy = {}, {}
+        for user_id, strategy in zip(range(job.first_user_id, job.first_user_id + job.players), self.rng.choice(strategies, size=job.players, p=np.array(weights) / sum(weights))):
+            self.players[user_id] = {**constants.INITIAL_PLAYER_STATS, constants.FIELD_USER_ID: user_id, 'shield_finish_time': shield.isoformat(), 'created_at': START, 'last_seen': START}
+            self.strategy[user_id] = STRATEGIES[strategy]
+            self._wake_later(user_id, START)
+        self.user_ids = np.array(list(self.players))
+        self.sample_times = [START + timedelta(hours=hours) for hours in np.arange(0, job.days * 24 + 1e-9, job.sample_hours)]
+        self.curves = {name: [] for name in CURVES}
+
+    def _wake_later(self, user_id, at):
+        """The player looks at the game again a reaction delay after `at` (or earlier, if a visit is already due)."""
+        at += timedelta(seconds=float(self.rng.exponential(self.reaction)) if self.reaction else 0)
+        if (pending := self.engine.get('wake', user_id)) is None or at < pending.due: self.engine.schedule('wake', user_id, at)
+
+    def _accrue(self, player, now):
+        """economy.settle, also counting the production lost to storage caps."""
+        since = player['last_seen']
+        if now > since:
+            before, rates = {res: int(player.get(res, 0)) for res in economy.RESOURCES}, economy.effective_rates(player)
+            economy.settle(player, now)
+            for res in economy.RESOURCES:
+                if before[res] >= int(player.get(f'{res}_storage_cap', 0)): potential = 0
+                else: potential = economy.production_between(rates[res], since, now)
+                gained = player[res] - before[res]
+                self.stats['produced'][res] += gained
+                self.stats['overflow'][res] += potential - gained
+        player['last_seen'] = now  # kept as a datetime: economy accepts either, and it saves a parse per accrual
+
+    @staticmethod
+    def _hours_to_afford(player, cost, rates) -> float:
+        """When `cost` becomes affordable from production alone: 0 if it already is, inf if a cap or a zero rate prevents it."""
+        hours = 0.0
+        for res, amount in cost.items():
+            if (missing := amount - player.get(res, 0)) <= 0: continue
+            if amount > player.get(f'{res}_storage_cap', 0) or rates.get(res, 0) <= 0: return math.inf
+            hours = max(hours, missing / rates[res])
+        return hours
+
+    @staticmethod
+    def _pay(player, cost):
+        for res, amount in cost.items(): player[res] = player.get(res, 0) - amount
+
+    def _next_build(self, player, strategy):
+        """(building key, cost, time) of the cheapest upgrade the strategy can ever afford, or None if it is capped out."""
+        best = None
+        for key in strategy['buildings']:
+            level = int(player.get(constants.BUILDING_DATA[key]['id'], 0)) + 1
+            if key == 'research_lab' and level > max_lab_level(): continue
+            cost, total, seconds = upgrade(key, level)
+            if (best is None or total < best[0]) and all(amount <= player.get(f'{res}_storage_cap', 0) for res, amount in cost.items()):
+                best = (total, key, cost, seconds)
+        return best[1:] if best else None
+
+    def plan(self, user_id, now):
+        """A player's visit: starts whatever the strategy wants and can afford, and comes back when the next thing becomes affordable."""
+        player, strategy = self.players[user_id], self.strategy[user_id]
+        self._accrue(player, now)
+        rates, waits = economy.effective_rates(player), []
+        if not player['build_queue_item_id'] and (choice := self._next_build(player, strategy)):
+            key, cost, seconds = choice
+            if (wait := self._hours_to_afford(player, cost, rates)) == 0:
+                self._pay(player, cost)
+                self.stats['spent']['build'].update(cost); self.stats['spent_by_building'][key] += sum(cost.values()); self.stats['actions']['build'] += 1
+                player['build_queue_item_id'] = key
+                self.engine.schedule('upgrade', user_id, now + timedelta(seconds=seconds), {'building': key})
+            else: waits.append(wait)
+        if not player['research_queue_item_id']:
+            lab_level = int(player.get('building_research_lab_level', 0))
+            for key in strategy['research']:
+                info = constants.RESEARCH_DATA[key]
+                if player.get(info['id']) == 'TRUE' or lab_level < info['required_lab_level']: continue
+                if (wait := self._hours_to_afford(player, info['cost'], rates)) == 0:
+                    self._pay(player, info['cost'])
+                    self.stats['spent']['research'].update(info['cost']); self.stats['actions']['research'] += 1
+                    player['research_queue_item_id'] = key
+                    self.engine.schedule('research', user_id, now + timedelta(seconds=info['research_time_seconds']), {'research': key})
+                else: waits.append(wait)
+                break
+        if strategy['train_share'] and not player['train_queue_item_id']:
+            barracks = int(player.get('building_barracks_level', 0))
+            for key, info in constants.UNIT_DATA.items():
+                if barracks < info['required_barracks_level']: continue
+                quantity = min(math.floor(player.get(res, 0) * strategy['train_share'] / amount) for res, amount in info['cost'].items())
+                if quantity >= 1:
+                    cost = {res: amount * quantity for res, amount in info['cost'].items()}
+                    self._pay(player, cost)
+                    self.stats['spent']['train'].update(cost); self.stats['actions']['train'] += 1
+                    player['train_queue_item_id'] = key
+                    self.engine.schedule('train', user_id, now + timedelta(seconds=info['train_time_seconds'] * quantity), {'unit': key, 'quantity': quantity})
+                else: waits.append(self._hours_to_afford(player, {res: math.ceil(amount / strategy['train_share']) for res, amount in info['cost'].items()}, rates))
+                break
+        if strategy['attacks']: self._raid(user_id, player, now)
+        if waits and (wait := min(waits)) < math.inf: self._wake_later(user_id, now + timedelta(hours=wait, minutes=1))
+
+    def _raid(self, user_id, player, now):
+        energy_cost = constants.COMBAT_CONFIG['energy_cost_per_attack']
+        if player['attack_queue_target_id'] or player['return_queue_finish_time']: return
+        if player.get('energy', 0) < energy_cost: self.stats['battles']['out_of_energy_visits'] += 1; return
+        if sum(int(player.get(info['id'], 0)) for info in constants.UNIT_DATA.values()) < MIN_RAID_UNITS: return
+        band, power = constants.MATCHMAKING_CONFIG, int(player.get('power', 0))
+        for target_id in self.rng.choice(self.user_ids, size=min(8, len(self.user_ids)), replace=False).tolist():
+            target = self.players[target_id]
+            if target_id == user_id or datetime.fromisoformat(target['shield_finish_time']) > now: continue
+            if not band['band_low'] * power <= int(target.get('power', 0)) <= band['band_high'] * power + band['band_floor']: continue
+            player['energy'] = player.get('energy', 0) - energy_cost
+            player['attack_queue_target_id'] = target_id
+            self.stats['actions']['attack'] += 1
+            self.engine.schedule('attack', user_id, now + timedelta(seconds=constants.COMBAT_CONFIG['base_travel_time_seconds']), {'target': target_id})
+            return
+
+    def _fight(self, completion, now):
+        """The 'attack' -> 'defend' -> 'attack_result' chain of handlers.resolve_completions, in one step: both players are local."""
+        attacker_id, defender_id = completion.user_id, completion.payload['target']
+        attacker, defender = self.players[attacker_id], self.players[defender_id]
+        army = {key: int(attacker.get(info['id'], 0)) for key, info in constants.UNIT_DATA.items()}
+        self._accrue(attacker, now); self._accrue(defender, now)
+        [(defender_updates, outcome)] = handlers.resolve_defenses([(defender, army, battle.unlocked_research(attacker), battle.battle_seed(attacker_id, defender_id, completion.due))], now)
+        defender.update(defender_updates); defender['last_seen'] = now
+        attacker_updates, return_time = handlers.conclude_attack(attacker, army, outcome, now)
+        attacker.update(attacker_updates); attacker['last_seen'] = now
+        self.stats['battles']['fought'] += 1
+        self.stats['battles']['attacker_wins'] += outcome['attacker_wins']
+        self.stats['looted'].update(outcome['looted'])
+        self.engine.schedule('return', attacker_id, return_time, {'army': outcome['survivors']})
+        self._wake_later(defender_id, now)
+
+    def _sample(self):
+        players = [self.players[user_id] for user_id in self.user_ids.tolist()]
+        at = self.sample_times[len(self.curves['power'])]
+        self.curves['power'].append([int(player.get('power', 0)) for player in players])
+        self.curves['building_levels'].append([sum(int(player.get(info['id'], 0)) for info in constants.BUILDING_DATA.values()) for player in players])
+        self.curves['hq_level'].append([int(player.get('building_hq_level', 0)) for player in players])
+        self.curves['stockpile'].append([sum(economy.current_resources(player, at).values()) for player in players])
+
+    def run(self) -> dict:
+        tick = timedelta(seconds=self.job.tick_seconds)
+        while (due := self.engine.next_due_at()) is not None and due <= self.end:
+            now = min(due + tick, self.end)
+            while len(self.curves['power']) < len(self.sample_times) and self.sample_times[len(self.curves['power'])] <= due: self._sample()
+            for completion in self.engine.pop_due(now):
+                if completion.kind == 'wake': self.plan(completion.user_id, completion.due); continue
+                player = self.players[completion.user_id]
+                if completion.kind == 'attack': self._fight(completion, completion.due)
+                else:
+                    self._accrue(player, completion.due)
+                    updates, _ = handlers.COMPLETION_HANDLERS[completion.kind](player, completion.payload, completion.due)
+                    player.update(updates); player['last_seen'] = completion.due
+                self._wake_later(completion.user_id, completion.due)
+        while len(self.curves['power']) < len(self.sample_times): self._sample()
+        capped = sum(self._next_build(player, self.strategy[user_id]) is None for user_id, player in self.players.items())
+        return {'stats': self.stats, 'capped_out': capped, 'players': len(self.players), 'curves': {name: np.array(values, dtype=np.int64) for name, values in self.curves.items()}}
+
+def simulate_partition(job: Job) -> dict:
+    """Process-pool entry point: one partition of one scenario."""
+    apply_overrides(job.overrides)
+    return {'scenario': job.scenario, **Simulation(job).run()}
+
+# --- Sweep ---
+
+def _merge_counters(into: dict, stats: dict):
+    for name, value in stats.items():
+        if isinstance(value, Counter): into.setdefault(name, Counter()).update(value)
+        else: _merge_counters(into.setdefault(name, {}), value)
+
+def summarize(overrides, results, job) -> dict:
+    """Merges one scenario's partitions: counters are summed, curves become percentiles over all its players."""
+    stats = {}
+    for result in results: _merge_counters(stats, result['stats'])
+    hours = [round(h, 3) for h in np.arange(0, job.days * 24 + 1e-9, job.sample_hours).tolist()]
+    curves = {}
+    for name in CURVES:
+        values = np.concatenate([result['curves'][name] for result in results], axis=1)
+        curves[name] = {'hours': hours, 'mean': np.round(values.mean(axis=1), 2).tolist(),
+                        **{f'p{q}': np.percentile(values, q, axis=1).tolist() for q in (10, 50, 90)}}
+    spent = {kind: dict(counter) for kind, counter in stats['spent'].items()}
+    total_spent = sum(sum(counter.values()) for counter in spent.values())
+    produced, overflow = sum(stats['produced'].values()), sum(stats['overflow'].values())
+    players = sum(result['players'] for result in results)
+    return {
+        'overrides': overrides, 'players': players, 'curves': curves,
+        'sinks': {'spent': spent, 'spent_by_building': dict(stats['spent_by_building']), 'looted': dict(stats['looted']),
+                  'produced': dict(stats['produced']), 'lost_to_storage_caps': dict(stats['overflow']),
+                  'spent_share': {kind: round(sum(counter.values()) / total_spent, 4) if total_spent else 0.0 for kind, counter in spent.items()},
+                  'cap_loss_share': round(overflow / (produced + overflow), 4) if produced + overflow else 0.0},
+        'actions': dict(stats['actions']), 'battles': dict(stats['battles']),
+        'capped_out_share': round(sum(result['capped_out'] for result in results) / players, 4) if players else 0.0,
+    }
+
+def scenarios(settings, sweeps) -> list:
+    """Every combination of the --sweep values, each on top of the --set values."""
+    paths = list(sweeps)
+    return [{**settings, **dict(zip(paths, combination))} for combination in itertools.product(*(sweeps[path] for path in paths))]
+
+def run(overrides_list, players, days, partition_size=2500, processes=None, mix=None, reaction_minutes=30, tick_seconds=60, sample_hours=6, seed=1) -> list:
+    """Simulates every scenario in `overrides_list` on a process pool; returns one summary per scenario, in order."""
+    mix = mix or DEFAULT_MIX
+    partitions = max(1, math.ceil(players / partition_size))
+    sizes = [players // partitions + (1 if index < players % partitions else 0) for index in range(partitions)]
+    jobs = [Job(scenario, overrides, partition, 1 + sum(sizes[:partition]), size, days, mix, reaction_minutes, tick_seconds, sample_hours, seed)
+            for scenario, overrides in enumerate(overrides_list) for partition, size in enumerate(sizes)]
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        results = list(pool.map(simulate_partition, jobs))
+    return [summarize(overrides, [result for result in results if result['scenario'] == scenario], jobs[scenario * partitions])
+            for scenario, overrides in enumerate(overrides_list)]
+
+def _parse_assignments(values, sweep=False) -> dict:
+    assignments = {}
+    for value in values or []:
+        path, separator, text = value.partition('=')
+        if not separator: raise argparse.ArgumentTypeError(f"expected PATH=VALUE, got '{value}'")
+        assignments[path] = [parse_value(v) for v in text.split(',')] if sweep else parse_value(text)
+    return assignments
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless economy simulator: progression curves and resource sinks for balance sweeps.')
+    parser.add_argument('--players', type=int, default=20000)
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--set', action='append', metavar='PATH=VALUE', help='override a balance knob in every scenario')
+    parser.add_argument('--sweep', action='append', metavar='PATH=V1,V2,...', help='run a scenario per value (combinations across --sweep flags)')
+    parser.add_argument('--mix', default=','.join(f'{name}={share}' for name, share in DEFAULT_MIX.items()), help='strategy shares: ' + ', '.join(STRATEGIES))
+    parser.add_argument('--reaction-minutes', type=float, default=30, help='mean delay before a player reacts to a completion or to affordability')
+    parser.add_argument('--partition-size', type=int, default=2500, help='players per simulated partition (battles stay within one)')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--tick-seconds', type=float, default=60)
+    parser.add_argument('--sample-hours', type=float, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the full results (curves included) to this file')
+    args = parser.parse_args()
+    try:
+        settings, sweeps = _parse_assignments(args.set), _parse_assignments(args.sweep, sweep=True)
+        mix = {name: float(share) for name, share in _parse_assignments(args.mix.split(',')).items()}
+        if unknown := set(mix) - set(STRATEGIES): raise ValueError(f"unknown strategies: {', '.join(sorted(unknown))}")
+        for path, value in {**settings, **{path: values[0] for path, values in sweeps.items()}}.items(): apply_overrides({path: value})
+    except (ValueError, KeyError, argparse.ArgumentTypeError) as e: parser.error(str(e))
+    apply_overrides({})
+
+    started = time.perf_counter()
+    summaries = run(scenarios(settings, sweeps), args.players, args.days, args.partition_size, args.processes, mix, args.reaction_minutes, args.tick_seconds, args.sample_hours, args.seed)
+    elapsed = time.perf_counter() - started
+    print(f"{len(summaries)} scenario(s) x {args.players} players x {args.days:g} days in {elapsed:.1f}s")
+    for summary in summaries:
+        sinks, power, levels = summary['sinks'], summary['curves']['power'], summary['curves']['building_levels']
+        print(f"\n{', '.join(f'{path}={value}' for path, value in summary['overrides'].items()) or 'baseline'}")
+        print(f"{'day':>6}{'power p10/p50/p90':>24}{'building levels p10/p50/p90':>30}")
+        for index, hours in enumerate(power['hours']):
+            if hours % 24: continue
+            print(f"{hours / 24:>6g}{'/'.join(f'{power[q][index]:g}' for q in ('p10', 'p50', 'p90')):>24}{'/'.join(f'{levels[q][index]:g}' for q in ('p10', 'p50', 'p90')):>30}")
+        print(f"spent: {', '.join(f'{kind} {share:.0%}' for kind, share in sinks['spent_share'].items())}; production lost to caps: {sinks['cap_loss_share']:.0%}; "
+              f"capped out: {summary['capped_out_share']:.0%}; battles: {summary['battles'].get('fought', 0)} ({summary['battles'].get('attacker_wins', 0)} won by the attacker)")
+    if args.json:
+        with open(args.json, 'w') as f: json.dump({'players': args.players, 'days': args.days, 'mix': mix, 'elapsed_s': round(elapsed, 2), 'scenarios': summaries}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# snapshot.py
+# Binary state snapshots for cold start: every player and alliance as fixed-width columnar arrays
+# in one memory-mapped file, with a format version and a checksum.
+#
+# Layout: a 48-byte header (magic, version, metadata length, blake2b-256 of everything after the
+# header), a JSON metadata block (created_at, clean flag, and per table its row count and the
+# dtype/offset of each column), then the 8-byte aligned column arrays. A column whose cells are
+# all canonical integers is stored as int64 (empty cells as INT_EMPTY); any other column as
+# fixed-width UTF-8 bytes. Values round-trip to the exact sheet strings.
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SKYSNAP\0'
+VERSION = 1
+HEADER = struct.Struct('<8sII32s')
+INT_EMPTY = np.iinfo(np.int64).min
+ALIGNMENT = 8
+
+class SnapshotError(Exception):
+    """The file is not a usable snapshot: wrong magic or version, truncated, or failing its checksum."""
+
+def _is_int_cell(value: str) -> bool:
+    return value == '' or (value.lstrip('-').isdigit() and str(int(value)) == value and INT_EMPTY < int(value) < 2 ** 63)
+
+def _encode_column(values: list) -> np.ndarray:
+    if all(_is_int_cell(value) for value in values):
+        return np.array([int(value) if value else INT_EMPTY for value in values], dtype=np.int64)
+    encoded = [value.encode('utf-8') for value in values]
+    return np.array(encoded, dtype=f'S{max(map(len, encoded), default=1) or 1}')
+
+def _decode_column(array: np.ndarray) -> list:
+    if array.dtype == np.int64: return ['' if value == INT_EMPTY else str(value) for value in array.tolist()]
+    return [value.decode('utf-8') for value in array.tolist()]
+
+def write(path: str, tables: dict, clean: bool = False):
+    """
+    Writes {table: (headers, rows)} (rows are lists of cell strings) to `path`, atomically:
+    the file is written and fsynced under a temporary name, then renamed over the old snapshot.
+    """
+    meta = {'created_at': datetime.now(timezone.utc).isoformat(), 'clean': clean, 'tables': {}}
+    columns = []
+    for table, (headers, rows) in tables.items():
+        meta['tables'][table] = {'rows': len(rows), 'columns': []}
+        for index, header in enumerate(headers):
+            array = _encode_column([row[index] if index < len(row) else '' for row in rows])
+            meta['tables'][table]['columns'].append({'name': header, 'dtype': array.dtype.str})
+            columns.append(array)
+    # Offsets depend on the metadata length, which depends on the offsets' digits: repeat until it settles.
+    while True:
+        meta_length = len(json.dumps(meta).encode())
+        offset = HEADER.size + meta_length
+        for spec, array in zip((spec for table in meta['tables'].values() for spec in table['columns']), columns):
+            offset += -offset % ALIGNMENT
+            spec['offset'] = offset
+            offset += array.nbytes
+        meta_bytes = json.dumps(meta).encode()
+        if len(meta_bytes) == meta_length: break
+    body = bytearray(meta_bytes)
+    for array in columns:
+        body += b'\0' * (-(HEADER.size + len(body)) % ALIGNMENT)
+        body += array.tobytes()
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(meta_bytes), hashlib.blake2b(body, digest_size=32).digest()))
+        f.write(body)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+class Snapshot:
+    """A verified, read-only, memory-mapped snapshot. Columns are numpy views into the mapping."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self._map) < HEADER.size: raise SnapshotError("file is truncated")
+        magic, version, meta_length, checksum = HEADER.unpack(self._map[:HEADER.size].tobytes())
+        if magic != MAGIC: raise SnapshotError("not a snapshot file")
+        if version != VERSION: raise SnapshotError(f"format version {version}, expected {VERSION}")
+        if hashlib.blake2b(memoryview(self._map[HEADER.size:]), digest_size=32).digest() != checksum: raise SnapshotError("checksum mismatch")
+        meta = json.loads(self._map[HEADER.size:HEADER.size + meta_length].tobytes())
+        self.created_at = datetime.fromisoformat(meta['created_at'])
+        self.clean = meta['clean']
+        self._tables = meta['tables']
+
+    def row_count(self, table: str) -> int: return self._tables[table]['rows']
+
+    def headers(self, table: str) -> list: return [spec['name'] for spec in self._tables[table]['columns']]
+
+    def column(self, table: str, name: str) -> np.ndarray:
+        for spec in self._tables[table]['columns']:
+            if spec['name'] == name:
+                return np.frombuffer(self._map, dtype=np.dtype(spec['dtype']), count=self._tables[table]['rows'], offset=spec['offset'])
+        raise KeyError(f"{table}.{name}")
+
+    def values(self, table: str, name: str, rows=None) -> list:
+        """One column as cell strings; `rows` (an index array) selects a subset of the rows."""
+        column = self.column(table, name)
+        return _decode_column(column if rows is None else column[rows])
+
+    def nonempty(self, table: str, names) -> np.ndarray:
+        """Indexes of the rows where any of the columns `names` has a value."""
+        mask = np.zeros(self.row_count(table), dtype=bool)
+        for name in names:
+            column = self.column(table, name)
+            mask |= column != (INT_EMPTY if column.dtype == np.int64 else b'')
+        return np.flatnonzero(mask)
+
+    def rows(self, table: str, rows=None) -> list:
+        """Rows as lists of cell strings, in header order."""
+        columns = [self.values(table, name, rows) for name in self.headers(table)]
+        return [list(row) for row in zip(*columns)]
+
+    def records(self, table: str, fields=None, rows=None) -> list:
+        """Rows as {field: value} with empty cells left out. Only `fields` (default: all) are decoded."""
+        headers = self.headers(table)
+        fields = headers if fields is None else [field for field in fields if field in headers]
+        columns = [self.values(table, field, rows) for field in fields]
+        return [{field: value for field, value in zip(fields, row) if value != ''} for row in zip(*columns)]
+
+def load(path: str):
+    """Opens the snapshot at `path`, or returns None (and says why) if there is none or it is unusable."""
+    if not os.path.exists(path): return None
+    try: return Snapshot(path)
+    except (SnapshotError, OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring snapshot '{path}': {e}")
+        return None
+
+class SnapshotWriter:
+    """
+    Writes a snapshot of export() every `interval_seconds` from a daemon thread. Those are marked
+    unclean: writes may follow them. stop() writes the final, clean one, after the last write.
+    """
+
+    def __init__(self, path, export, interval_seconds=300):
+        self.path, self.export, self.interval = path, export, interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+
+    def start(self): self._thread.start()
+
+    def write(self, clean=False) -> bool:
+        try:
+            tables = self.export()
+            write(self.path, tables, clean=clean)
+            logger.info("Snapshot written to '%s' (%d players, %s).", self.path, len(tables['players'][1]), 'clean' if clean else 'periodic')
+            return True
+        except Exception as e:
+            logger.error(f"Could not write snapshot '{self.path}': {e}")
+            return False
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive(): self._thread.join()
+        self.write(clean=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval): self.write()
@@ -0,0 +1,580 @@
+# storage.py
+# Pluggable storage backends. Handlers call the module-level functions below, which delegate
+# to the backend selected at startup: Google Sheets directly, or a local SQLite file that is
+# mirrored to the Players/Alliances sheets in the background.
+
+import fcntl
+import heapq
+import itertools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import constants
+import google_sheets
+import metrics
+from name_index import NameIndex, normalize_name
+from player_record import PlayerRecord
+from sheets_client import SheetsThrottled
+
+logger = logging.getLogger(__name__)
+
+class StorageBackend:
+    """The storage operations used by the handlers. All values are returned as strings, as Sheets does."""
+    name = 'base'
+    shared = False  # True when several worker processes use the same store
+    def find_player_row(self, user_id: int): raise NotImplementedError
+    def find_player_record(self, user_id: int):
+        """(row, PlayerRecord) for typed access; backends with a record cache override this."""
+        row_index, record = self.find_player_row(user_id)
+        return (row_index, PlayerRecord.from_dict(record)) if record else (None, None)
+    def find_player_by_name(self, commander_name: str): raise NotImplementedError
+    def find_players_by_name_prefix(self, prefix: str, limit: int = 10) -> list: raise NotImplementedError
+    def is_commander_name_taken(self, commander_name: str) -> bool: raise NotImplementedError
+    def update_player_data(self, user_id: int, updates: dict) -> bool: raise NotImplementedError
+    def find_player_rows(self, user_ids) -> dict: raise NotImplementedError
+    def update_players_data(self, updates_by_user: dict) -> dict: raise NotImplementedError
+    def create_player_row(self, player_data_dict: dict) -> bool: raise NotImplementedError
+    def create_alliance(self, alliance_data: dict) -> bool: raise NotImplementedError
+    def update_alliance(self, alliance_id: str, updates: dict) -> bool: raise NotImplementedError
+    def delete_alliance(self, alliance_id: str) -> bool: raise NotImplementedError
+    def get_all_alliances(self) -> list: raise NotImplementedError
+    def get_all_players(self) -> list: raise NotImplementedError
+    def get_alliance_members(self, alliance_id: str) -> list: raise NotImplementedError
+    def exclusive(self, name: str):
+        """Context manager serializing a named critical section with every other process sharing this store."""
+        return nullcontext()
+    def observe_remote(self, user_id, changes: dict):
+        """Catches up process-local state (e.g. the name index) with a write committed by another process."""
+    def close(self): pass
+
+
+class SheetsBackend(StorageBackend):
+    """Reads and writes go straight to Google Sheets (through the google_sheets cache)."""
+    name = 'sheets'
+    def find_player_row(self, user_id): return google_sheets.find_player_row(user_id)
+    def find_player_record(self, user_id): return google_sheets.find_player_record(user_id)
+    def find_player_by_name(self, commander_name): return google_sheets.find_player_by_name(commander_name)
+    def find_players_by_name_prefix(self, prefix, limit=10): return google_sheets.find_players_by_name_prefix(prefix, limit)
+    def is_commander_name_taken(self, commander_name): return google_sheets.is_commander_name_taken(commander_name)
+    def update_player_data(self, user_id, updates): return google_sheets.update_player_data(user_id, updates)
+    def find_player_rows(self, user_ids): return google_sheets.find_player_rows(user_ids)
+    def update_players_data(self, updates_by_user): return google_sheets.update_players_data(updates_by_user)
+    def create_player_row(self, player_data_dict): return google_sheets.create_player_row(player_data_dict)
+    def create_alliance(self, alliance_data): return google_sheets.create_alliance(alliance_data)
+    def update_alliance(self, alliance_id, updates): return google_sheets.update_alliance(alliance_id, updates)
+    def delete_alliance(self, alliance_id): return google_sheets.delete_alliance(alliance_id)
+    def get_all_alliances(self): return google_sheets.get_all_alliances()
+    def get_all_players(self): return google_sheets.get_all_players()
+    def close(self): google_sheets.flush_writes()
+
+
+# --- SECTION: SQLITE BACKEND ---
+
+@lru_cache(maxsize=256)
+def _update_sql(table: str, key_column: str, columns: tuple) -> str:
+    assignments = ', '.join(f'"{column}" = ?' for column in columns)
+    return f'UPDATE {table} SET {assignments} WHERE "{key_column}" = ?'
+
+def _insert_sql(table: str, columns: list) -> str:
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    return f'INSERT INTO {table} ({column_list}) VALUES ({", ".join("?" for _ in columns)})'
+
+def _create_table_sql(table: str, columns: list) -> str:
+    definitions = [f'"{columns[0]}" TEXT PRIMARY KEY'] + [f'"{column}" TEXT NOT NULL DEFAULT \'\'' for column in columns[1:]]
+    return f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(definitions)})'
+
+def _add_missing_columns(conn, table: str, columns: list):
+    """Adds schema columns introduced after the table was created (appended, like the sheet's headers)."""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column in columns:
+        if column in existing: continue
+        try: conn.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" TEXT NOT NULL DEFAULT \'\'')
+        except sqlite3.OperationalError as e:
+            if 'duplicate column' not in str(e): raise  # another process sharing the file added it first
+        logger.info(f"SQLite storage: added column '{column}' to {table}.")
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Serves the hot path from a local SQLite file (WAL mode, indexed lookups).
+    Every successful write is also handed to an optional SheetsReplicator so the
+    spreadsheet stays a readable mirror for admins.
+    With `shared`, several worker processes use the same file: commander names are then also
+    claimed in a name_claims table (its primary key arbitrates between processes), and
+    exclusive() takes an advisory file lock next to the database.
+    """
+    name = 'sqlite'
+    PLAYER_COLUMNS = constants.SHEET_COLUMN_HEADERS
+    ALLIANCE_COLUMNS = constants.ALLIANCES_SHEET_COLUMN_HEADERS
+
+    def __init__(self, path: str, replicator=None, shared=False):
+        self.path = path
+        self.replicator = replicator
+        self.shared = shared
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256, timeout=10 if shared else 5)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(_create_table_sql('players', self.PLAYER_COLUMNS))
+        self._conn.execute(_create_table_sql('alliances', self.ALLIANCE_COLUMNS))
+        _add_missing_columns(self._conn, 'players', self.PLAYER_COLUMNS)
+        _add_missing_columns(self._conn, 'alliances', self.ALLIANCE_COLUMNS)
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_players_commander_name ON players ("{constants.FIELD_COMMANDER_NAME}")')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_players_alliance ON players ("alliance_id")')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_alliances_tag ON alliances ("alliance_tag")')
+        self._select_by_id = f'SELECT rowid, * FROM players WHERE "{constants.FIELD_USER_ID}" = ?'
+        self._insert_player = _insert_sql('players', self.PLAYER_COLUMNS)
+        self._insert_alliance = _insert_sql('alliances', self.ALLIANCE_COLUMNS)
+        if shared:
+            self._conn.create_function('normalize_name', 1, normalize_name, deterministic=True)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS name_claims (name_key TEXT PRIMARY KEY, user_id TEXT NOT NULL)')
+            self._conn.execute(f'INSERT OR IGNORE INTO name_claims SELECT normalize_name("{constants.FIELD_COMMANDER_NAME}"), "{constants.FIELD_USER_ID}" FROM players WHERE "{constants.FIELD_COMMANDER_NAME}" != \'\'')
+        self._names = NameIndex()
+        self._reload_names()
+        logger.info(f"SQLite storage opened at '{path}' (WAL mode{', shared between processes' if shared else ''}).")
+
+    @staticmethod
+    def _split_row(row):
+        if row is None: return None, None
+        record = dict(row)
+        return record.pop('rowid'), record
+
+    def _reload_names(self):
+        with self._lock:
+            self._names.load(self._conn.execute(f'SELECT "{constants.FIELD_USER_ID}", "{constants.FIELD_COMMANDER_NAME}" FROM players ORDER BY rowid'))
+
+    def player_count(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM players').fetchone()[0]
+
+    def import_players(self, records: list):
+        """Bulk-loads existing player records, e.g. from the spreadsheet on first start."""
+        rows = [[str(record.get(column, '')) for column in self.PLAYER_COLUMNS] for record in records if record.get(constants.FIELD_USER_ID)]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(self._insert_player.replace('INSERT', 'INSERT OR REPLACE', 1), rows)
+            self._conn.execute('COMMIT')
+        self._reload_names()
+        logger.info(f"Imported {len(rows)} player records into SQLite.")
+
+    def import_alliances(self, records: list):
+        rows = [[str(record.get(column, '')) for column in self.ALLIANCE_COLUMNS] for record in records if record.get(self.ALLIANCE_COLUMNS[0])]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(self._insert_alliance.replace('INSERT', 'INSERT OR REPLACE', 1), rows)
+            self._conn.execute('COMMIT')
+        logger.info(f"Imported {len(rows)} alliance records into SQLite.")
+
+    def find_player_row(self, user_id):
+        try:
+            with self._lock:
+                return self._split_row(self._conn.execute(self._select_by_id, (str(user_id),)).fetchone())
+        except Exception as e:
+            logger.error(f"Error finding player {user_id}: {e}"); return None, None
+
+    def find_player_by_name(self, commander_name):
+        user_id = self._names.lookup(commander_name)
+        return self.find_player_row(user_id) if user_id is not None else (None, None)
+
+    def find_players_by_name_prefix(self, prefix, limit=10): return self._names.prefix(prefix, limit)
+    def is_commander_name_taken(self, commander_name): return self._names.is_taken(commander_name)
+
+    def _claim_name(self, user_id, name) -> bool:
+        """Shared mode: claims `name` in name_claims; False if another process's player already holds it."""
+        key = normalize_name(name)
+        self._conn.execute('INSERT OR IGNORE INTO name_claims VALUES (?, ?)', (key, str(user_id)))
+        return self._conn.execute('SELECT user_id FROM name_claims WHERE name_key = ?', (key,)).fetchone()[0] == str(user_id)
+
+    def _release_name(self, user_id, name):
+        self._conn.execute('DELETE FROM name_claims WHERE name_key = ? AND user_id = ?', (normalize_name(name), str(user_id)))
+
+    def exclusive(self, name):
+        if not self.shared: return nullcontext()
+        return _file_lock(f'{self.path}.{name}.lock')
+
+    def observe_remote(self, user_id, changes):
+        if (name := changes.get(constants.FIELD_COMMANDER_NAME)) and not self._names.add(user_id, name):
+            logger.warning(f"Name index: '{name}' of player {user_id} is already held locally; lookups may be stale.")
+
+    def get_alliance_members(self, alliance_id):
+        columns = ', '.join(f'"{column}"' for column in (constants.FIELD_USER_ID, constants.FIELD_COMMANDER_NAME, 'power', 'alliance_id'))
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(f'SELECT {columns} FROM players WHERE "alliance_id" = ?', (str(alliance_id),))]
+
+    def find_player_rows(self, user_ids):
+        by_key = {str(user_id): user_id for user_id in user_ids}
+        if not by_key: return {}
+        placeholders = ', '.join('?' for _ in by_key)
+        with self._lock:
+            rows = self._conn.execute(f'SELECT rowid, * FROM players WHERE "{constants.FIELD_USER_ID}" IN ({placeholders})', list(by_key)).fetchall()
+        return {by_key[record[constants.FIELD_USER_ID]]: record for record in (self._split_row(row)[1] for row in rows)}
+
+    def _apply_update(self, user_id, updates) -> bool:
+        """Runs one player's UPDATE on the open connection; the caller holds the lock."""
+        columns = tuple(field for field in updates if field in self.PLAYER_COLUMNS and field != constants.FIELD_USER_ID)
+        new_name = updates.get(constants.FIELD_COMMANDER_NAME)
+        if new_name is not None:
+            _, current = self.find_player_row(user_id)
+            if current and self.shared and normalize_name(current[constants.FIELD_COMMANDER_NAME]) != normalize_name(new_name):
+                if not self._claim_name(user_id, str(new_name)):
+                    logger.warning(f"Rename of player {user_id} to '{new_name}' rejected: name already taken."); return False
+                self._release_name(user_id, current[constants.FIELD_COMMANDER_NAME])
+            if current and not self._names.rename(user_id, current[constants.FIELD_COMMANDER_NAME], str(new_name)):
+                logger.warning(f"Rename of player {user_id} to '{new_name}' rejected: name already taken."); return False
+        if not columns:
+            return self._conn.execute(self._select_by_id, (str(user_id),)).fetchone() is not None
+        params = [str(updates[column]) for column in columns] + [str(user_id)]
+        return self._conn.execute(_update_sql('players', constants.FIELD_USER_ID, columns), params).rowcount > 0
+
+    def update_player_data(self, user_id, updates):
+        return self.update_players_data({user_id: updates}).get(user_id, False)
+
+    def update_players_data(self, updates_by_user):
+        """Applies several players' updates in one transaction. Returns {user_id: success}."""
+        results = {}
+        try:
+            with self._lock:
+                self._conn.execute('BEGIN')
+                try:
+                    for user_id, updates in updates_by_user.items(): results[user_id] = self._apply_update(user_id, updates)
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK'); raise
+        except Exception as e:
+            logger.error(f"Error updating data for players {list(updates_by_user)}: {e}")
+            return {user_id: False for user_id in updates_by_user}
+        for user_id, updates in updates_by_user.items():
+            if not results.get(user_id): continue
+            if self.replicator: self.replicator.update_player(user_id, {field: value for field, value in updates.items() if field in self.PLAYER_COLUMNS and field != constants.FIELD_USER_ID})
+            logger.info("Successfully updated player data for user %s: %s", user_id, updates)
+        return results
+
+    def create_player_row(self, player_data_dict):
+        full_player_data = google_sheets.build_new_player_record(player_data_dict)
+        user_id, name = player_data_dict.get(constants.FIELD_USER_ID), str(player_data_dict.get(constants.FIELD_COMMANDER_NAME, ''))
+        if not self._names.add(user_id, name):
+            logger.warning(f"Registration of '{name}' for user_id {user_id} rejected: name already taken."); return False
+        try:
+            with self._lock:
+                if self.shared:
+                    self._conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        if not self._claim_name(user_id, name):
+                            self._conn.execute('ROLLBACK'); self._names.remove(name, user_id)
+                            logger.warning(f"Registration of '{name}' for user_id {user_id} rejected: name claimed by another worker."); return False
+                        self._conn.execute(self._insert_player, [str(full_player_data.get(column, '')) for column in self.PLAYER_COLUMNS])
+                        self._conn.execute('COMMIT')
+                    except Exception:
+                        self._conn.execute('ROLLBACK'); raise
+                else: self._conn.execute(self._insert_player, [str(full_player_data.get(column, '')) for column in self.PLAYER_COLUMNS])
+            if self.replicator: self.replicator.create_player(full_player_data)
+            logger.info(f"Successfully created new player row for user_id {player_data_dict.get('user_id')}.")
+            return True
+        except Exception as e:
+            self._names.remove(name, user_id)
+            logger.error(f"Error creating new player row for {player_data_dict.get('user_id')}: {e}"); return False
+
+    def create_alliance(self, alliance_data):
+        alliance_data.setdefault('created_at', datetime.now(timezone.utc).isoformat())
+        try:
+            with self._lock:
+                self._conn.execute(self._insert_alliance, [str(alliance_data.get(column, '')) for column in self.ALLIANCE_COLUMNS])
+            if self.replicator: self.replicator.create_alliance(dict(alliance_data))
+            logger.info(f"Successfully created new alliance: {alliance_data.get('alliance_name')}")
+            return True
+        except Exception as e:
+            logger.error(f"Error creating new alliance: {e}"); return False
+
+    def update_alliance(self, alliance_id, updates):
+        updates = {key: value for key, value in updates.items() if key in self.ALLIANCE_COLUMNS}
+        if not updates: return True
+        try:
+            with self._lock:
+                cursor = self._conn.execute(_update_sql('alliances', self.ALLIANCE_COLUMNS[0], tuple(updates)), [str(value) for value in updates.values()] + [str(alliance_id)])
+            if cursor.rowcount and self.replicator: self.replicator.update_alliance(alliance_id, dict(updates))
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error updating alliance {alliance_id}: {e}"); return False
+
+    def delete_alliance(self, alliance_id):
+        try:
+            with self._lock:
+                self._conn.execute(f'DELETE FROM alliances WHERE "{self.ALLIANCE_COLUMNS[0]}" = ?', (str(alliance_id),))
+            if self.replicator: self.replicator.delete_alliance(alliance_id)
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting alliance {alliance_id}: {e}"); return False
+
+    def get_all_alliances(self):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute('SELECT * FROM alliances')]
+
+    def get_all_players(self):
+        with self._lock:
+            return [self._split_row(row)[1] for row in self._conn.execute('SELECT rowid, * FROM players')]
+
+    def close(self):
+        if self.replicator: self.replicator.stop()
+        with self._lock: self._conn.close()
+
+
+@contextmanager
+def _file_lock(path):
+    """Advisory lock on `path`, held across processes (and threads: each holder opens its own descriptor)."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try: yield
+        finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SheetsReplicator:
+    """
+    Mirrors SQLite writes into the Players/Alliances sheets from a background thread.
+    Updates for the same player are merged while they wait, so a burst of writes for
+    one commander costs a single sheet update.
+    A failed write is retried with exponential backoff, without holding up the items behind it;
+    after `max_attempts` (throttling does not count) it is logged and kept in `dead_letters`.
+    A player's updates wait while their create_player is being retried.
+    """
+
+    def __init__(self, retry_delay_seconds=5, max_retry_delay_seconds=300, max_attempts=8):
+        self.retry_delay, self.max_retry_delay, self.max_attempts = retry_delay_seconds, max_retry_delay_seconds, max_attempts
+        self._queue = queue.Queue()
+        self._pending_updates = {}
+        self._lock = threading.Lock()
+        # Only the mirror thread touches these.
+        self._retries = []  # heap of (monotonic due time, sequence, item, attempts)
+        self._sequence = itertools.count()
+        self._creating = set()  # user_id keys whose create_player is being retried
+        self._parked = {}  # user_id key -> user_id whose update_player waits for that create
+        self.dead_letters = []  # (kind, payload, error) of items given up on
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='sheets-replicator', daemon=True)
+        self._thread.start()
+        logger.info("Sheets replicator started.")
+
+    def stop(self):
+        self._running = False
+        self._queue.put(None)
+        if self._thread: self._thread.join()
+        google_sheets.flush_writes()
+
+    def create_player(self, record: dict): self._queue.put(('create_player', record))
+    def create_alliance(self, record: dict): self._queue.put(('create_alliance', record))
+    def update_alliance(self, alliance_id, updates: dict): self._queue.put(('update_alliance', (alliance_id, updates)))
+    def delete_alliance(self, alliance_id): self._queue.put(('delete_alliance', alliance_id))
+
+    def update_player(self, user_id, updates: dict):
+        with self._lock:
+            pending = self._pending_updates.get(user_id)
+            if pending is not None:
+                pending.update(updates); return
+            self._pending_updates[user_id] = dict(updates)
+        self._queue.put(('update_player', user_id))
+
+    def _apply(self, item) -> bool:
+        kind, payload = item
+        if kind == 'create_player': return google_sheets.append_player_record(payload)
+        if kind == 'create_alliance': return google_sheets.create_alliance(payload)
+        if kind == 'update_alliance': return google_sheets.update_alliance(*payload)
+        if kind == 'delete_alliance': return google_sheets.delete_alliance(payload)
+        with self._lock: updates = self._pending_updates.pop(payload, None)
+        if not updates: return True
+        saved = False
+        try: saved = google_sheets.update_player_data(payload, updates)
+        finally:
+            if not saved:
+                with self._lock:
+                    # Put the failed batch back underneath anything written since.
+                    self._pending_updates[payload] = {**updates, **self._pending_updates.get(payload, {})}
+        return saved
+
+    def backlog(self) -> int: return self._queue.qsize() + len(self._retries) + len(self._parked)
+
+    def _attempt(self, apply, item, attempts=0, final=False):
+        """Applies one item; a failure is scheduled for a retry, or given up after the last attempt (or if `final`)."""
+        kind, payload = item
+        key = str(payload.get(constants.FIELD_USER_ID)) if kind == 'create_player' else str(payload)
+        if kind == 'update_player' and key in self._creating:
+            self._parked[key] = payload; return  # its updates stay merged in _pending_updates until the create lands
+        error = None
+        try: applied = apply(item)
+        except SheetsThrottled as e: applied, error = False, e
+        except Exception as e:
+            logger.error(f"Sheets mirror {kind} raised: {e}", exc_info=True); applied, error = False, e
+        if applied:
+            if kind == 'create_player': self._created(key)
+            return
+        if not isinstance(error, SheetsThrottled): attempts += 1
+        if final or attempts >= self.max_attempts: return self._give_up(item, error)
+        if kind == 'create_player': self._creating.add(key)
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempts)
+        logger.warning(f"Sheets mirror write failed for {kind} ({error or 'rejected'}); attempt {attempts} of {self.max_attempts}, retrying in {delay}s.")
+        heapq.heappush(self._retries, (time.monotonic() + delay, next(self._sequence), item, attempts))
+
+    def _created(self, key):
+        self._creating.discard(key)
+        if (user_id := self._parked.pop(key, None)) is not None: self._queue.put(('update_player', user_id))
+
+    def _give_up(self, item, error):
+        kind, payload = item
+        if kind == 'update_player':
+            with self._lock: payload = (payload, self._pending_updates.pop(payload, None))
+        self.dead_letters.append((kind, payload, str(error or 'rejected')))
+        logger.error(f"Sheets mirror gave up on {kind} ({error or 'rejected'}); the sheet is missing: {payload!r}")
+        if kind == 'create_player':
+            key = str(payload.get(constants.FIELD_USER_ID))
+            self._creating.discard(key)
+            if (user_id := self._parked.pop(key, None)) is not None: self._give_up(('update_player', user_id), 'its create_player was given up')
+
+    def _run(self):
+        apply = metrics.timed(metrics.JOB_SECONDS, 'sheets_replication', self._apply)
+        while True:
+            while self._retries and self._retries[0][0] <= time.monotonic():
+                _, _, item, attempts = heapq.heappop(self._retries)
+                self._attempt(apply, item, attempts)
+            try: item = self._queue.get(timeout=max(0.0, self._retries[0][0] - time.monotonic()) if self._retries else None)
+            except queue.Empty: continue
+            if item is None:
+                if not self._running: break
+                continue
+            self._attempt(apply, item)
+        # Drain whatever is still queued or backing off so a clean shutdown leaves the mirror current; what fails now is given up.
+        for _, _, item, attempts in sorted(self._retries): self._queue.put(item)
+        self._retries = []
+        while not self._queue.empty():
+            if (item := self._queue.get()) is not None: self._attempt(self._apply, item, final=True)
+
+
+# --- SECTION: BACKEND SELECTION & MODULE-LEVEL API ---
+
+_backend = SheetsBackend()
+
+def configure(backend_name: str = 'sheets', sqlite_path: str = 'skyhustle.db', mirror_to_sheets: bool = True, shared: bool = False):
+    """Selects the active backend. Called once from main.py (or each worker process, with `shared`) before handlers run."""
+    global _backend
+    if backend_name == 'sheets':
+        _backend = SheetsBackend()
+    elif shared and backend_name != 'sqlite':
+        raise ValueError("Only the sqlite backend can be shared between worker processes.")
+    elif backend_name == 'sqlite':
+        replicator = SheetsReplicator() if mirror_to_sheets else None
+        backend = SQLiteBackend(sqlite_path, replicator=replicator, shared=shared)
+        if mirror_to_sheets and backend.player_count() == 0:
+            logger.info("SQLite store is empty; importing players from Google Sheets...")
+            backend.import_players(google_sheets.get_all_players())
+            backend.import_alliances(google_sheets.get_all_alliances())
+        if replicator: replicator.start()
+        _backend = backend
+    else:
+        raise ValueError(f"Unknown storage backend '{backend_name}'.")
+    logger.info(f"Storage backend selected: {_backend.name}")
+    return _backend
+
+def get_backend() -> StorageBackend: return _backend
+
+def replication_backlog() -> int:
+    """Writes queued for the sheets mirror (0 unless the SQLite backend mirrors to sheets)."""
+    replicator = getattr(_backend, 'replicator', None)
+    return replicator.backlog() if replicator else 0
+
+def is_shared() -> bool: return _backend.shared
+def exclusive(name: str): return _backend.exclusive(name)
+
+# --- Change listeners ---
+# In-memory indexes (leaderboard, ...) subscribe here instead of re-reading the store.
+_listeners = []
+_local_listeners = []  # only this process's own commits, e.g. to publish them to other workers
+_alliance_listeners = []
+
+def add_listener(listener, local_only: bool = False):
+    """
+    Registers listener(user_id, changes), called after every committed player create or update.
+    With `local_only`, writes committed by other worker processes (apply_remote_changes) are not passed on.
+    """
+    (_local_listeners if local_only else _listeners).append(listener)
+
+def add_alliance_listener(listener):
+    """Registers listener(alliance_id, record), called after an alliance is created or updated (record: the changed fields) or deleted (record: None)."""
+    _alliance_listeners.append(listener)
+
+def _notify(user_id, changes: dict, remote: bool = False):
+    for listener in _listeners if remote else _listeners + _local_listeners:
+        try: listener(user_id, changes)
+        except Exception as e: logger.error(f"Storage listener {getattr(listener, '__name__', listener)} failed for user {user_id}: {e}")
+
+def _notify_alliance(alliance_id, record):
+    for listener in _alliance_listeners:
+        try: listener(alliance_id, record)
+        except Exception as e: logger.error(f"Alliance listener {getattr(listener, '__name__', listener)} failed for alliance {alliance_id}: {e}")
+
+def apply_remote_changes(user_id, changes: dict):
+    """A player write committed by another worker process: updates local indexes as if it were ours."""
+    _backend.observe_remote(user_id, changes)
+    _notify(user_id, changes, remote=True)
+
+def reconcile_with_snapshot(snap):
+    """
+    After a snapshot cold start (Sheets backend): reconciles the cache with the sheet and passes what
+    differed to the listeners, as if it had just been written. Returns google_sheets' (records, changes).
+    """
+    records, changes = google_sheets.reconcile_with_snapshot(snap)
+    for user_id, changed in changes.items(): _notify(user_id, changed)
+    return records, changes
+
+def find_player_row(user_id: int): return _backend.find_player_row(user_id)
+def find_player_record(user_id: int): return _backend.find_player_record(user_id)
+def find_player_by_name(commander_name: str): return _backend.find_player_by_name(commander_name)
+def find_players_by_name_prefix(prefix: str, limit: int = 10): return _backend.find_players_by_name_prefix(prefix, limit)
+def is_commander_name_taken(commander_name: str): return _backend.is_commander_name_taken(commander_name)
+def find_player_rows(user_ids): return _backend.find_player_rows(user_ids)
+
+def update_player_data(user_id: int, updates: dict):
+    ok = _backend.update_player_data(user_id, updates)
+    if ok: _notify(user_id, updates)
+    return ok
+
+def update_players_data(updates_by_user: dict):
+    results = _backend.update_players_data(updates_by_user)
+    for user_id, ok in results.items():
+        if ok: _notify(user_id, updates_by_user[user_id])
+    return results
+
+def create_player_row(player_data_dict: dict):
+    ok = _backend.create_player_row(player_data_dict)
+    if ok:
+        user_id = player_data_dict.get(constants.FIELD_USER_ID)
+        _, record = _backend.find_player_row(user_id)
+        _notify(user_id, record or player_data_dict)
+    return ok
+
+def create_alliance(alliance_data: dict):
+    ok = _backend.create_alliance(alliance_data)
+    if ok: _notify_alliance(alliance_data.get('alliance_id'), dict(alliance_data))
+    return ok
+
+def update_alliance(alliance_id: str, updates: dict):
+    ok = _backend.update_alliance(alliance_id, updates)
+    if ok: _notify_alliance(alliance_id, dict(updates))
+    return ok
+
+def delete_alliance(alliance_id: str):
+    ok = _backend.delete_alliance(alliance_id)
+    if ok: _notify_alliance(alliance_id, None)
+    return ok
+
+def get_all_alliances(): return _backend.get_all_alliances()
+def get_alliance_members(alliance_id: str): return _backend.get_alliance_members(alliance_id)
+def get_all_players(): return _backend.get_all_players()
+def close(): _backend.close()
@@ -0,0 +1,42 @@
+# tables.py
+# Level-indexed cost and time tables, precomputed once at import from BUILDING_DATA, UNIT_DATA
+# and RESEARCH_DATA so the menus and upgrade handlers do lookups instead of float exponentiation.
+
+import math
+from datetime import timedelta
+
+import constants
+
+def calculate_cost(base_cost, multiplier, level):
+    return {res: math.floor(amount * (multiplier ** (level - 1))) for res, amount in base_cost.items()}
+
+def calculate_time(base_time, multiplier, level):
+    return math.floor(base_time * (multiplier ** (level - 1)))
+
+def format_cost(cost: dict) -> str:
+    return " | ".join([f"{v:,} {res.capitalize()}" for res, v in cost.items()])
+
+# BUILDING_COSTS[key][level] is the cost of upgrading *to* `level` (index 0 is unused).
+BUILDING_COSTS = {key: [None] + [calculate_cost(info['base_cost'], info['cost_multiplier'], level) for level in range(1, constants.TABLE_MAX_LEVEL + 1)] for key, info in constants.BUILDING_DATA.items()}
+BUILDING_TIMES = {key: [None] + [calculate_time(info['base_time_seconds'], info['time_multiplier'], level) for level in range(1, constants.TABLE_MAX_LEVEL + 1)] for key, info in constants.BUILDING_DATA.items()}
+BUILDING_COST_LABELS = {key: [None] + [format_cost(cost) for cost in costs[1:]] for key, costs in BUILDING_COSTS.items()}
+
+UNIT_COST_LABELS = {key: format_cost(info['cost']) for key, info in constants.UNIT_DATA.items()}
+RESEARCH_COST_LABELS = {key: format_cost(info['cost']) for key, info in constants.RESEARCH_DATA.items()}
+RESEARCH_TIMES = {key: timedelta(seconds=info['research_time_seconds']) for key, info in constants.RESEARCH_DATA.items()}
+
+def building_cost(building_key: str, level: int) -> dict:
+    """Cost of upgrading a building to `level`. Levels past the table fall back to the formula."""
+    if 0 < level <= constants.TABLE_MAX_LEVEL: return BUILDING_COSTS[building_key][level]
+    info = constants.BUILDING_DATA[building_key]
+    return calculate_cost(info['base_cost'], info['cost_multiplier'], level)
+
+def building_time(building_key: str, level: int) -> int:
+    """Construction time in seconds of upgrading a building to `level`."""
+    if 0 < level <= constants.TABLE_MAX_LEVEL: return BUILDING_TIMES[building_key][level]
+    info = constants.BUILDING_DATA[building_key]
+    return calculate_time(info['base_time_seconds'], info['time_multiplier'], level)
+
+def building_cost_label(building_key: str, level: int) -> str:
+    if 0 < level <= constants.TABLE_MAX_LEVEL: return BUILDING_COST_LABELS[building_key][level]
+    return format_cost(building_cost(building_key, level))
@@ -0,0 +1,53 @@
+# tests/test_battles.py
+# Regression tests for the attack -> defend -> attack_result chain across a crash.
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import constants
+import google_sheets
+import handlers
+import storage
+from completion_engine import CompletionEngine
+
+ATTACKER, DEFENDER = 1, 2
+
+class _Bot:
+    def send_message(self, *args, **kwargs): pass
+
+@pytest.fixture
+def world(tmp_path):
+    storage.configure('sqlite', sqlite_path=str(tmp_path / 'battles.db'), mirror_to_sheets=False)
+    due = datetime.now(timezone.utc) - timedelta(seconds=1)
+    for user_id, name in ((ATTACKER, 'Attacker'), (DEFENDER, 'Defender')):
+        storage.create_player_row(google_sheets.build_new_player_record({constants.FIELD_USER_ID: user_id, constants.FIELD_COMMANDER_NAME: name}))
+    storage.update_players_data({ATTACKER: {'unit_infantry_count': 100, 'attack_queue_target_id': DEFENDER, 'attack_queue_finish_time': due.isoformat()},
+                                 DEFENDER: {'unit_infantry_count': 40, 'wood': 800, 'shield_finish_time': ''}})
+    yield
+    storage.close()
+
+def _resolve(completions):
+    failed, follow_ups = handlers.resolve_completions(_Bot(), CompletionEngine(), completions)
+    assert not failed
+    return follow_ups
+
+def _rehydrated_attack():
+    engine = CompletionEngine()
+    handlers.rehydrate_queues(engine, storage.get_all_players())
+    return engine.pop_due(datetime.now(timezone.utc))
+
+def test_battle_rearmed_after_a_crash_is_replayed_not_fought_again(world):
+    [defend] = _resolve(_rehydrated_attack())
+    [result] = _resolve([defend])  # defender's half committed; the process dies before the result is applied
+    defender = storage.find_player_row(DEFENDER)[1]
+
+    [replayed_defend] = _resolve(_rehydrated_attack())
+    [replayed_result] = _resolve([replayed_defend])
+    assert storage.find_player_row(DEFENDER)[1] == defender
+    assert replayed_result.payload == result.payload
+
+    assert _resolve([replayed_result]) == []
+    attacker = storage.find_player_row(ATTACKER)[1]
+    assert not attacker.get('attack_queue_target_id') and attacker.get('return_queue_army_data')
+    assert _rehydrated_attack() == []  # nothing left to re-arm
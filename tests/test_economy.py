@@ -0,0 +1,31 @@
+# tests/test_economy.py
+# Regression tests for lazy resource accrual and research production bonuses.
+
+from datetime import datetime, timedelta, timezone
+
+import constants
+import economy
+import handlers
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+def _player(**fields):
+    return {**constants.INITIAL_PLAYER_STATS, 'wood': 0, 'last_seen': START.isoformat(), **fields}
+
+def test_legacy_row_with_completed_research_is_not_boosted_twice():
+    # Rows written before lazy accrual already hold floor(rate * multiplier) in *_prod_rate.
+    legacy = _player(wood_prod_rate=110, research_logistics_unlocked='TRUE')
+    assert economy.effective_rates(legacy)['wood'] == 110
+    assert economy.current_resources(legacy, START + timedelta(hours=1))['wood'] == 110
+
+def test_research_applies_its_multiplier_once():
+    player = _player(wood_prod_rate=100, research_queue_item_id='logistics')
+    updates, _ = handlers.complete_research(player, 'logistics', START + timedelta(hours=1))
+    assert updates['wood'] == 100 and updates['wood_prod_rate'] == 110
+    player.update(updates)
+    assert economy.current_resources(player, START + timedelta(hours=2))['wood'] == 210
+
+def test_frequent_settles_do_not_lose_fractional_production():
+    player = _player(iron=100, wood_prod_rate=60)
+    for step in range(1, 61): economy.settle(player, START + timedelta(seconds=90 * step))
+    assert (player['iron'], player['wood']) == (145, 90)
@@ -0,0 +1,66 @@
+# tests/test_replicator.py
+# SheetsReplicator retry behaviour, against a scripted stand-in for the google_sheets writes.
+
+import time
+
+import pytest
+
+import constants
+import google_sheets
+import storage
+from sheets_client import SheetsThrottled
+
+class _Sheets:
+    """Records applied writes; `failures` maps a write to how many times it fails first (None: always), or to an exception to raise."""
+
+    def __init__(self, monkeypatch, failures):
+        self.applied, self.failures = [], failures
+        monkeypatch.setattr(google_sheets, 'append_player_record', lambda record: self._write(('create', record[constants.FIELD_USER_ID])))
+        monkeypatch.setattr(google_sheets, 'update_player_data', lambda user_id, updates: self._write(('update', user_id, tuple(sorted(updates.items())))))
+        monkeypatch.setattr(google_sheets, 'flush_writes', lambda: 0)
+
+    def _write(self, write):
+        key = write[:2]
+        failure = self.failures.get(key, 0)
+        if isinstance(failure, Exception): raise failure
+        if failure is None: return False
+        if failure:
+            self.failures[key] = failure - 1; return False
+        self.applied.append(write); return True
+
+def _run(replicator, until, timeout=5):
+    replicator.start()
+    deadline = time.monotonic() + timeout
+    while not until() and time.monotonic() < deadline: time.sleep(0.01)
+    replicator.stop()
+
+@pytest.fixture
+def replicator():
+    return storage.SheetsReplicator(retry_delay_seconds=0.01, max_retry_delay_seconds=0.05, max_attempts=3)
+
+def test_updates_wait_for_a_retried_create(monkeypatch, replicator):
+    sheets = _Sheets(monkeypatch, {('create', 7): 2})
+    replicator.create_player({constants.FIELD_USER_ID: 7})
+    replicator.update_player(7, {'wood': 1})
+    replicator.update_player(7, {'stone': 2})
+    _run(replicator, lambda: len(sheets.applied) == 2)
+    assert sheets.applied == [('create', 7), ('update', 7, (('stone', 2), ('wood', 1)))]
+
+def test_a_write_that_never_succeeds_is_dead_lettered_without_blocking_others(monkeypatch, replicator):
+    sheets = _Sheets(monkeypatch, {('update', 1): None, ('update', 2): RuntimeError('row deleted'), ('update', 3): 1})
+    for user_id in (1, 2, 3, 4): replicator.update_player(user_id, {'wood': user_id})
+    _run(replicator, lambda: len(replicator.dead_letters) == 2 and len(sheets.applied) == 2)
+    assert sorted(sheets.applied) == [('update', 3, (('wood', 3),)), ('update', 4, (('wood', 4),))]
+    assert sorted(payload for _, payload, _ in replicator.dead_letters) == [(1, {'wood': 1}), (2, {'wood': 2})]
+    assert replicator.backlog() == 0
+
+def test_throttling_backs_off_without_using_up_attempts(monkeypatch, replicator):
+    sheets = _Sheets(monkeypatch, {})
+    throttled = iter(range(5))
+    def update(user_id, updates):
+        if next(throttled, None) is not None: raise SheetsThrottled('quota')
+        return sheets._write(('update', user_id, ()))
+    monkeypatch.setattr(google_sheets, 'update_player_data', update)
+    replicator.update_player(5, {'wood': 5})
+    _run(replicator, lambda: sheets.applied)
+    assert sheets.applied == [('update', 5, ())] and not replicator.dead_letters
@@ -0,0 +1,91 @@
+# webhook_server.py
+# Webhook ingestion (BOT_MODE=webhook): an embedded HTTP server receives Telegram updates
+# and feeds them to the handler pipeline through a bounded queue.
+#
+# To exercise it locally, start the bot with BOT_MODE=webhook and POST a recorded update:
+#   curl -X POST -H 'X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET' \
+#        -H 'Content-Type: application/json' --data @update.json http://127.0.0.1:8443/telegram
+
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1024 * 1024
+
+class WebhookServer:
+    """
+    Validates Telegram's secret-token header, parses each update and enqueues it.
+    When the queue is full the update is dropped (load shedding) and still acknowledged
+    with 200: answering with an error would make Telegram redeliver it and hold back
+    every later update behind it.
+    """
+
+    def __init__(self, bot, secret_token, host='0.0.0.0', port=8443, path='/telegram', max_queue=1000):
+        self.bot = bot
+        self.secret_token = secret_token or ''
+        self.path = path
+        self.updates = queue.Queue(maxsize=max_queue)
+        self.received = 0
+        self.dropped = 0
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._consumer = threading.Thread(target=self._consume, name='webhook-dispatch', daemon=True)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body=b''):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/healthz': self._reply(200, b'ok')
+                else: self._reply(404)
+
+            def do_POST(self):
+                if self.path != server.path: self._reply(404); return
+                token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if not hmac.compare_digest(token, server.secret_token): self._reply(403); return
+                length = int(self.headers.get('Content-Length') or 0)
+                if not 0 < length <= MAX_BODY_BYTES: self._reply(413 if length else 400); return
+                try: update = Update.de_json(json.loads(self.rfile.read(length)))
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Rejected malformed webhook update: {e}"); self._reply(400); return
+                server.received += 1
+                try: server.updates.put_nowait(update)
+                except queue.Full:
+                    server.dropped += 1
+                    logger.warning(f"Webhook queue full; shed update {update.update_id} ({server.dropped} dropped so far).")
+                self._reply(200)
+
+            def log_message(self, format, *args):
+                logger.debug(f"webhook {self.address_string()} {format % args}")
+
+        return Handler
+
+    def _consume(self):
+        while True:
+            update = self.updates.get()
+            if update is None: return
+            try: self.bot.process_new_updates([update])
+            except Exception as e: logger.error(f"Failed to process update {update.update_id}: {e}")
+
+    def serve_forever(self):
+        self._consumer.start()
+        host, port = self._httpd.server_address[:2]
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        self._httpd.shutdown()
+        self.updates.put(None)
@@ -0,0 +1,411 @@
+# workers.py
+# Multi-process deployment (BOT_WORKERS=N): the main process only receives Telegram updates and
+# routes each one by user_id to one of N worker processes (`python -m workers`), which run the
+# handlers, the completion engine and the caches for their share of the players.
+#
+# Dispatcher and workers talk over local multiprocessing connections (pickled tuples):
+#   dispatcher -> worker   ('update', update) | ('handoff', Completion) | ('player', user_id, changes)
+#                          | ('alliance', alliance_id, record or None) | ('stop',)
+#   worker -> dispatcher   ('hello', index) | ('handoff', Completion) | ('player', ...) | ('alliance', ...) | ('stopped', index)
+# Handoffs go to the worker owning the completion's user_id; player/alliance changes (the change
+# feed keeping every worker's leaderboard, matchmaking and alliance indexes current) go to all others.
+# The workers share one SQLite store (WAL mode), so this mode requires STORAGE_BACKEND=sqlite.
+
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from multiprocessing.connection import Client, Listener
+
+import telebot
+from dotenv import load_dotenv
+from telebot import apihelper
+from telebot.types import Update
+
+import alliances
+import constants
+import conversation
+import google_sheets
+import handlers
+import leaderboard
+import matchmaking
+import metrics
+import storage
+from completion_engine import CompletionEngine
+from executor import ShardedExecutor
+from outbox import DispatchingBot, OutboundDispatcher
+
+logger = logging.getLogger(__name__)
+
+def partition_of(user_id, count) -> int:
+    """
+    The worker owning user_id. Hashed with crc32 rather than taken modulo, so that each worker's
+    players still spread evenly over its own executor shards (which are keyed by user_id modulo).
+    """
+    return zlib.crc32(str(user_id).encode()) % count
+
+_UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result', 'shipping_query',
+                 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request', 'channel_post', 'edited_channel_post')
+
+def user_of(update):
+    """The user_id an update is about (the chat for channel posts), from a raw update dict or a telebot Update; None if it has none."""
+    raw = isinstance(update, dict)
+    for kind in _UPDATE_KINDS:
+        item = update.get(kind) if raw else getattr(update, kind, None)
+        if not item: continue
+        for field in (('from', 'user', 'chat') if raw else ('from_user', 'user', 'chat')):
+            sender = item.get(field) if raw else getattr(item, field, None)
+            if sender: return sender.get('id') if raw else sender.id
+    return None
+
+# --- Dispatcher (main process) ---
+
+class Dispatcher:
+    """
+    Starts and supervises the worker processes, accepts their connections on a local socket and
+    routes between them. A message for a worker that is not connected (still starting, or being
+    restarted after a crash) waits in its buffer, up to `buffer_size` messages, and is delivered in
+    order once it says hello. `command(index)` is the argv of a worker process.
+    """
+
+    def __init__(self, count, command, env=None, buffer_size=10000, restart_delay_seconds=1.0):
+        self.count, self._command, self._env = count, command, env or {}
+        self.restart_delay = restart_delay_seconds
+        self._authkey = secrets.token_bytes(32)
+        self._listener = Listener(('127.0.0.1', 0), authkey=self._authkey)
+        self._connections = [None] * count
+        self._send_locks = [threading.Lock() for _ in range(count)]
+        self._buffers = [deque() for _ in range(count)]
+        self._buffer_size = buffer_size
+        self._processes = [None] * count
+        self._ready = threading.Event()
+        self._stopped = set()
+        self._stopping = False
+        self.routed = [0] * count
+        self.dropped = self.restarts = 0
+
+    def start(self, timeout=120):
+        """Launches the workers and waits (up to `timeout` seconds) until all of them have connected."""
+        for index in range(self.count): self._launch(index)
+        threading.Thread(target=self._accept, name='dispatcher-accept', daemon=True).start()
+        threading.Thread(target=self._supervise, name='dispatcher-supervisor', daemon=True).start()
+        if not self._ready.wait(timeout): logger.warning(f"Only {sum(c is not None for c in self._connections)} of {self.count} workers connected within {timeout}s.")
+        else: logger.info(f"All {self.count} workers connected.")
+
+    def _launch(self, index):
+        host, port = self._listener.address
+        env = {**os.environ, **self._env, 'WORKER_INDEX': str(index), 'WORKER_COUNT': str(self.count),
+               'WORKER_DISPATCHER': f'{host}:{port}', 'WORKER_AUTHKEY': self._authkey.hex()}
+        self._processes[index] = subprocess.Popen(self._command(index), env=env)
+        logger.info(f"Worker {index} started (pid {self._processes[index].pid}).")
+
+    def _accept(self):
+        while not self._stopping:
+            try: connection = self._listener.accept()
+            except OSError: return
+            threading.Thread(target=self._serve, args=(connection,), name='dispatcher-read', daemon=True).start()
+
+    def _serve(self, connection):
+        """Reads one worker's connection: its hello (sent once it has loaded), then what it sends to the others."""
+        try:
+            kind, index = connection.recv()
+            if kind != 'hello' or not 0 <= index < self.count: raise ValueError(f"unexpected greeting {kind!r}")
+        except Exception as e:
+            logger.warning(f"Rejected worker connection: {e}"); connection.close(); return
+        with self._send_locks[index]:
+            # Deliver what queued up while the worker was away before anything newer.
+            while self._buffers[index]: connection.send(self._buffers[index].popleft())
+            self._connections[index] = connection
+        logger.info(f"Worker {index} connected.")
+        if all(c is not None for c in self._connections): self._ready.set()
+        while True:
+            try: message = connection.recv()
+            except (EOFError, OSError):
+                with self._send_locks[index]:
+                    if self._connections[index] is connection: self._connections[index] = None
+                if not self._stopping: logger.error(f"Lost the connection to worker {index}.")
+                return
+            kind = message[0]
+            if kind == 'handoff': self.send(partition_of(message[1].user_id, self.count), message)
+            elif kind in ('player', 'alliance'):
+                for other in range(self.count):
+                    if other != index: self.send(other, message)
+            elif kind == 'stopped': self._stopped.add(index)
+
+    def send(self, index, message):
+        with self._send_locks[index]:
+            connection = self._connections[index]
+            if connection is not None:
+                try:
+                    connection.send(message); return
+                except OSError:
+                    self._connections[index] = None
+            if len(self._buffers[index]) >= self._buffer_size:
+                self._buffers[index].popleft(); self.dropped += 1
+                if self.dropped % 100 == 1: logger.warning(f"Worker {index} buffer full; {self.dropped} messages dropped so far.")
+            self._buffers[index].append(message)
+
+    def route(self, update):
+        """Sends a raw update dict (or telebot Update) to the worker owning its user."""
+        index = partition_of(user_of(update) or 0, self.count)
+        self.routed[index] += 1
+        self.send(index, ('update', update))
+
+    def process_new_updates(self, updates):
+        """TeleBot-compatible entry point, so the WebhookServer can feed the dispatcher directly."""
+        for update in updates: self.route(update)
+
+    def poll(self, token, timeout=40):
+        """Long-polls getUpdates and routes the raw updates; never parses them. Blocks."""
+        offset, delay = None, 1
+        while not self._stopping:
+            try:
+                updates = apihelper.get_updates(token, offset, 100, timeout, None, timeout + 10)
+                delay = 1
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}; retrying in {delay}s.")
+                time.sleep(delay); delay = min(delay * 2, 15); continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.route(update)
+
+    def _supervise(self):
+        while not self._stopping:
+            time.sleep(self.restart_delay)
+            for index, process in enumerate(self._processes):
+                if self._stopping or process.poll() is None: continue
+                self.restarts += 1
+                logger.error(f"Worker {index} exited with status {process.returncode}; restarting it.")
+                self._launch(index)
+
+    def stats(self) -> list:
+        return [{'worker': index, 'connected': self._connections[index] is not None, 'routed': self.routed[index], 'buffered': len(self._buffers[index])} for index in range(self.count)]
+
+    def stop(self, timeout=60):
+        """Asks every worker to finish its queued work and exit, then waits for them (killing stragglers after `timeout`)."""
+        self._stopping = True
+        for index in range(self.count): self.send(index, ('stop',))
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self._processes):
+            try: process.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.error(f"Worker {index} did not stop in time; killing it."); process.kill()
+        self._listener.close()
+
+def run(bot_token, count):
+    """Runs the dispatcher for `count` workers until interrupted: polling, or with BOT_MODE=webhook the webhook server."""
+    if os.environ.get('STORAGE_BACKEND') != 'sqlite':
+        raise ValueError("BOT_WORKERS needs STORAGE_BACKEND=sqlite: the workers share one SQLite store.")
+    # Import the sheets once here, so the workers do not race to do it on an empty store.
+    store = storage.SQLiteBackend(os.environ.get('SQLITE_PATH', 'skyhustle.db'), shared=True)
+    if store.player_count() == 0:
+        logger.info("SQLite store is empty; importing players from Google Sheets...")
+        store.import_players(google_sheets.get_all_players())
+        store.import_alliances(google_sheets.get_all_alliances())
+    store.close()
+    config = constants.WORKER_CONFIG
+    dispatcher = Dispatcher(count, lambda index: [sys.executable, '-m', 'workers'], buffer_size=config['update_buffer'], restart_delay_seconds=config['restart_delay_seconds'])
+    dispatcher.start()
+    try:
+        if os.environ.get('BOT_MODE') == 'webhook':
+            from webhook_server import WebhookServer
+            webhook_secret = os.environ.get('WEBHOOK_SECRET')
+            if not webhook_secret or not os.environ.get('WEBHOOK_URL'):
+                raise ValueError("BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET.")
+            server = WebhookServer(dispatcher, webhook_secret, host=os.environ.get('WEBHOOK_HOST', '0.0.0.0'), port=int(os.environ.get('WEBHOOK_PORT', '8443')), path=os.environ.get('WEBHOOK_PATH', '/telegram'))
+            bot = telebot.TeleBot(bot_token, threaded=False)
+            bot.remove_webhook()
+            bot.set_webhook(url=os.environ['WEBHOOK_URL'], secret_token=webhook_secret)
+            logger.info(f"Dispatcher receiving updates via webhook for {count} workers...")
+            server.serve_forever()
+        else:
+            logger.info(f"Dispatcher polling for {count} workers...")
+            dispatcher.poll(bot_token)
+    finally:
+        dispatcher.stop()
+
+# --- Worker process ---
+
+class Partition:
+    """
+    This worker's share of the players, and the path for completions owned by other workers.
+
+    A battle between players of two workers is a two-party commit coordinated by the attacker's
+    worker. The attacker's queued attack (attack_queue_target_id/finish_time in their row) is the
+    durable intent. The defender's worker commits the fight and remembers the resulting
+    'attack_result' by battle seed; a repeated 'defend' for that seed gets the remembered result
+    back instead of a second fight. The attacker's worker commits the result only while the attack
+    is still queued (handlers.battle_in_flight), so a repeated result is ignored. Until then it
+    re-sends the 'defend' every `retry_seconds`, which recovers a message lost with a crashed worker.
+    """
+
+    def __init__(self, index, count, send, retry_seconds=30, results_kept=10000):
+        self.index, self.count, self._send = index, count, send
+        self.retry_seconds, self.results_kept = retry_seconds, results_kept
+        self._pending = {}  # battle seed -> [resend at (monotonic), 'defend' Completion]: our attackers' battles
+        self._results = OrderedDict()  # battle seed -> 'attack_result' Completion: our defenders' committed battles
+        self._lock = threading.Lock()
+
+    def owns(self, user_id) -> bool: return partition_of(user_id, self.count) == self.index
+
+    def hand_off(self, completion):
+        seed = completion.payload.get('seed')
+        with self._lock:
+            if completion.kind == 'defend' and seed is not None:
+                self._pending[seed] = [time.monotonic() + self.retry_seconds, completion]
+            elif completion.kind == 'attack_result' and seed is not None:
+                self._results[seed] = completion
+                while len(self._results) > self.results_kept: self._results.popitem(last=False)
+        self._send(('handoff', completion))
+
+    def receive(self, completion):
+        """A completion handed off by another worker: returns it to resolve here, or None if it was a repeat answered from _results."""
+        if completion.kind == 'defend':
+            with self._lock: result = self._results.get(completion.payload.get('seed'))
+            if result is not None:
+                logger.info("Battle %s of user %s was already fought; re-sending its result.", completion.payload.get('seed'), completion.user_id)
+                self._send(('handoff', result)); return None
+        elif completion.kind == 'attack_result': self.settle(completion.payload.get('seed'))
+        return completion
+
+    def due_retries(self) -> list:
+        """(seed, 'defend' Completion) of battles whose result is overdue; their next resend is pushed back."""
+        now = time.monotonic()
+        with self._lock:
+            due = [(seed, entry[1]) for seed, entry in self._pending.items() if entry[0] <= now]
+            for seed, _ in due: self._pending[seed][0] = now + self.retry_seconds
+        return due
+
+    def settle(self, seed):
+        with self._lock: self._pending.pop(seed, None)
+
+    def pending_battles(self) -> int: return len(self._pending)
+
+class Worker:
+    """
+    One worker process: the handlers, completion engine and executor for the players of
+    partition `index`, fed by the dispatcher over `connection`. Storage must already be configured
+    (shared SQLite). `bot` makes the API calls; `router` (default: `bot`) receives the handler
+    registrations and the updates.
+    """
+
+    def __init__(self, index, count, connection, bot, router=None, executor_shards=None):
+        self.index, self.count, self.connection = index, count, connection
+        self.bot, self.router = bot, router or bot
+        self._send_lock = threading.Lock()
+        config = constants.WORKER_CONFIG
+        self.partition = Partition(index, count, self.send, config['battle_retry_seconds'], config['battle_results_kept'])
+        self.scheduler = CompletionEngine(tick_seconds=1.0)
+        self.executor = ShardedExecutor(num_shards=executor_shards or constants.EXECUTOR_SHARDS)
+        self._stopped = threading.Event()
+
+    def send(self, message):
+        with self._send_lock: self.connection.send(message)
+
+    def start(self):
+        """Loads the shared indexes, re-arms this partition's queues, starts the timers and says hello to the dispatcher."""
+        players = storage.get_all_players()
+        leaderboard.load(players); matchmaking.load(players); alliances.load(storage.get_all_alliances(), players)
+        for index in (leaderboard, matchmaking, alliances): storage.add_listener(index.observe)
+        # Publish our own commits to the other workers' indexes.
+        storage.add_listener(lambda user_id, changes: self.send(('player', user_id, changes)), local_only=True)
+        storage.add_alliance_listener(lambda alliance_id, record: self.send(('alliance', alliance_id, record)))
+        handlers.register_handlers(self.bot, self.scheduler, self.executor, router=self.router, partition=self.partition)
+        handlers.rehydrate_queues(self.scheduler, [player for player in players if self.partition.owns(player.get(constants.FIELD_USER_ID))])
+        del players
+        self.scheduler.start()
+        threading.Thread(target=self._retry_battles, name='battle-retries', daemon=True).start()
+        self.send(('hello', self.index))
+        logger.info(f"Worker {self.index}/{self.count} ready.")
+
+    def serve_forever(self):
+        """Handles dispatcher messages until told to stop (or the dispatcher goes away), then drains and stops."""
+        while True:
+            try: message = self.connection.recv()
+            except (EOFError, OSError):
+                logger.error(f"Worker {self.index} lost its dispatcher connection; stopping."); break
+            kind = message[0]
+            try:
+                if kind == 'update':
+                    update = message[1] if isinstance(message[1], Update) else Update.de_json(message[1])
+                    self.router.process_new_updates([update])
+                elif kind == 'handoff': self.executor.submit(message[1].user_id, self._receive, message[1])
+                elif kind == 'player': storage.apply_remote_changes(message[1], message[2])
+                elif kind == 'alliance': alliances.observe_alliance(message[1], message[2])
+                elif kind == 'stop': break
+            except Exception as e:
+                logger.error(f"Worker {self.index} failed to handle a {kind} message: {e}", exc_info=True)
+        self.stop()
+
+    def _receive(self, completion):
+        # Runs on the player's shard rather than in serve_forever, which never sends: it keeps reading, so the dispatcher cannot deadlock on it.
+        if (completion := self.partition.receive(completion)) is not None:
+            handlers.dispatch_completions(self.bot, self.scheduler, self.executor, [completion], self.partition)
+
+    def stop(self):
+        self._stopped.set()
+        self.scheduler.stop()
+        self.executor.shutdown()
+        try: self.send(('stopped', self.index))
+        except OSError: pass
+
+    def _retry_battles(self):
+        while not self._stopped.wait(max(1.0, self.partition.retry_seconds / 4)):
+            for seed, defend in self.partition.due_retries():
+                self.executor.submit(defend.payload['attacker'], self._check_battle, seed, defend)
+
+    def _check_battle(self, seed, defend):
+        """On the attacker's shard: re-sends an overdue battle unless its result has meanwhile been applied."""
+        attacker_id = defend.payload['attacker']
+        _, attacker = storage.find_player_row(attacker_id)
+        if attacker and handlers.battle_in_flight(attacker_id, attacker, defend.user_id, seed):
+            logger.warning("Battle %s of user %s against %s has no result yet; re-sending it.", seed, attacker_id, defend.user_id)
+            self.partition.hand_off(defend)
+        else: self.partition.settle(seed)
+
+def connect():
+    """In a process started by the Dispatcher: (index, count, connection to the dispatcher), from the WORKER_* environment."""
+    host, port = os.environ['WORKER_DISPATCHER'].rsplit(':', 1)
+    connection = Client((host, int(port)), authkey=bytes.fromhex(os.environ['WORKER_AUTHKEY']))
+    return int(os.environ['WORKER_INDEX']), int(os.environ['WORKER_COUNT']), connection
+
+def main():
+    """Entry point of a worker process, started by the Dispatcher with WORKER_* set in its environment."""
+    load_dotenv()
+    index, count, connection = connect()
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s')
+
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        metrics.enable(slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS') or 0),
+                       profile_interval_ms=constants.METRICS_CONFIG['profile_interval_ms'], keep_slow=constants.METRICS_CONFIG['slow_requests_kept'])
+    # Sheets and Telegram limits are per bot/project: each worker gets its share.
+    google_sheets.configure_quota(share=1 / count)
+    if os.environ.get('SHEETS_WRITE_BEHIND') == '1': google_sheets.enable_write_behind()
+    storage.configure('sqlite', sqlite_path=os.environ.get('SQLITE_PATH', 'skyhustle.db'), shared=True)
+    conversation.configure(os.environ.get('CONVERSATION_DB'))
+    bot = telebot.TeleBot(os.environ['BOT_TOKEN'], threaded=False)
+    outbox = OutboundDispatcher(metrics.instrument_api('telegram', bot), **{**constants.OUTBOX_CONFIG, 'global_per_second': max(1, constants.OUTBOX_CONFIG['global_per_second'] / count)})
+
+    worker = Worker(index, count, connection, DispatchingBot(bot, outbox), router=bot)
+    worker.start()
+    if metrics_port:
+        metrics.register_collector('skyhustle_scheduler_pending', 'Queue completions waiting in the completion engine.', worker.scheduler.pending_count)
+        metrics.register_collector('skyhustle_executor_queue_depth', 'Tasks queued per executor shard.', lambda: {stats['shard']: stats['depth'] for stats in worker.executor.stats()}, labels=('shard',))
+        metrics.register_collector('skyhustle_outbox_depth', 'Telegram API calls waiting in the outbox.', outbox.depth)
+        metrics.register_collector('skyhustle_battles_awaiting_result', 'Cross-worker battles waiting for the defender\'s worker.', worker.partition.pending_battles)
+        # Each worker serves its own endpoint, on METRICS_PORT + 1 + index.
+        metrics.MetricsServer(constants.METRICS_CONFIG['host'], int(metrics_port) + 1 + index).start()
+    try: worker.serve_forever()
+    finally:
+        outbox.shutdown()
+        storage.close()
+        conversation.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# write_behind.py
+# Write-behind batching for Google Sheets: coalesces cell updates into one batch_update per worksheet.
+
+import logging
+import threading
+import time
+from collections import Counter
+from gspread.utils import rowcol_to_a1
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindQueue:
+    """
+    Buffers cell writes and flushes them from a background thread.
+    Pending cells are keyed by (row, col) per worksheet, so a later write to the same
+    cell replaces the earlier one (last writer wins) before anything reaches the API.
+    A flush happens every `flush_interval_ms`, or sooner once `max_batch_cells` are pending.
+    When `max_pending_cells` are buffered, enqueue() blocks until the flusher catches up.
+    is_pending() tells callers which rows the sheet does not hold yet, so they can keep those rows' cached copies.
+    """
+
+    def __init__(self, flush_interval_ms=500, max_batch_cells=1000, max_pending_cells=10000):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_cells = max_batch_cells
+        self.max_pending_cells = max_pending_cells
+        self._pending = {}  # worksheet title -> (worksheet, {(row, col): value})
+        self._pending_count = 0
+        self._pending_rows = Counter()  # (worksheet title, row) -> buffered cells
+        self._in_flight_rows = Counter()  # the same for the batch being written by flush()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running: return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='sheets-write-behind', daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind flusher started (window {self.flush_interval * 1000:.0f} ms / {self.max_batch_cells} cells).")
+
+    def stop(self):
+        """Stops the flusher and drains everything still buffered."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread: self._thread.join()
+        self.flush()
+
+    def enqueue(self, worksheet, cells):
+        """Buffers gspread.Cell objects for `worksheet`, blocking while the buffer is full."""
+        with self._cond:
+            while self._running and self._pending_count >= self.max_pending_cells:
+                logger.warning("Write-behind buffer full; applying back-pressure.")
+                self._cond.wait()
+            _, cell_map = self._pending.setdefault(worksheet.title, (worksheet, {}))
+            for cell in cells:
+                if (cell.row, cell.col) not in cell_map:
+                    self._pending_count += 1
+                    self._pending_rows[(worksheet.title, cell.row)] += 1
+                cell_map[(cell.row, cell.col)] = cell.value
+            if self._pending_count >= self.max_batch_cells: self._cond.notify_all()
+        if not self._running: self.flush()
+
+    def pending_count(self) -> int: return self._pending_count
+
+    def is_pending(self, title: str, row: int) -> bool:
+        """Whether `row` of worksheet `title` has cells that are buffered or still being written."""
+        with self._cond: return (title, row) in self._pending_rows or (title, row) in self._in_flight_rows
+
+    def pending_cells(self) -> list:
+        """(worksheet title, A1 range, value) for every buffered cell, e.g. to log what a failed shutdown flush left behind."""
+        with self._cond:
+            return [(title, rowcol_to_a1(row, col), value) for title, (_, cell_map) in self._pending.items() for (row, col), value in cell_map.items()]
+
+    def flush(self) -> int:
+        """
+        Synchronously writes every buffered cell. Safe to call from any thread, e.g. at shutdown.
+        Returns how many cells are still buffered afterwards: those of a failed batch, re-queued, plus any written meanwhile.
+        """
+        started = time.perf_counter()
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending, self._pending_count = self._pending, {}, 0
+                self._in_flight_rows, self._pending_rows = self._pending_rows, Counter()
+                self._cond.notify_all()
+            for title, (worksheet, cell_map) in batch.items():
+                data = [{'range': rowcol_to_a1(row, col), 'values': [[value]]} for (row, col), value in cell_map.items()]
+                try:
+                    worksheet.batch_update(data, value_input_option='USER_ENTERED')
+                    logger.info("Write-behind flushed %d cells to '%s'.", len(data), title)
+                except Exception as e:
+                    logger.error(f"Write-behind flush to '{title}' failed, re-queueing {len(data)} cells: {e}")
+                    self._requeue(worksheet, cell_map)
+            with self._cond: self._in_flight_rows = Counter()
+        if metrics.enabled and batch: metrics.JOB_SECONDS.observe(time.perf_counter() - started, 'write_behind_flush')
+        return self._pending_count
+
+    def _requeue(self, worksheet, cell_map):
+        with self._cond:
+            _, pending_map = self._pending.setdefault(worksheet.title, (worksheet, {}))
+            for position, value in cell_map.items():
+                # A newer write made while the flush was in flight must not be overwritten.
+                if position not in pending_map:
+                    pending_map[position] = value
+                    self._pending_count += 1
+                    self._pending_rows[(worksheet.title, position[0])] += 1
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.flush_interval
+            with self._cond:
+                while self._running and self._pending_count < self.max_batch_cells:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: break
+                    self._cond.wait(remaining)
+                if not self._running: return
+            if self._pending_count: self.flush()